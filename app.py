@@ -1,7 +1,8 @@
 
 import os
-import logging
 import asyncio
+import secrets
+from urllib.parse import urlsplit
 
 from dotenv import load_dotenv
 load_dotenv()  # TZ Important
@@ -9,24 +10,56 @@ load_dotenv()  # TZ Important
 import time
 time.tzset()  # Set timezone
 
+from telegram.ext import Application
+
+from lib.bot import build_application, build_bot
+from lib.events import bus
 from lib.models import get_session, init as db_init
 from lib.handlers import user_handlers
-from telegram.ext import ApplicationBuilder
+import lib.timetable as timetable
+import lib.logs as logs
+import lib.tracing as tracing
+import lib.diagnostics as diagnostics
+
+
+logs.setup()  # JSON lines to stderr or LOG_DIR, written by a background thread
+
+async def post_init(application):
+    bus.start(build_bot())  # Subscribers fan out edits through the background pool
+    diagnostics.loop_monitor.start()  # Event loop lag of /stats_runtime
+
 
+async def post_shutdown(application):
+    await bus.stop()
+    await bus.bot.request.shutdown()
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 
-application = ApplicationBuilder() \
-    .token(os.environ['BOT_TOKEN']) \
-    .build()
+class TracedApplication(Application):
+    """Root span of every update (polling or webhook), as rmq_consumer.py has of every message"""
+
+    async def process_update(self, update: object):
+        with tracing.span('update', update_id=getattr(update, 'update_id', None)):
+            await super().process_update(update)
+
+
+application = build_application(post_init, post_shutdown, TracedApplication)
 
 def main(session):
     application.bot_data['session'] = session
     application.add_handlers(user_handlers)
-    application.run_polling()
+
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:  # Telegram pushes updates, they go straight to application.update_queue
+        application.run_webhook(
+            listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+            port=int(os.getenv('WEBHOOK_PORT', 8443)),
+            url_path=urlsplit(webhook_url).path.lstrip('/'),
+            webhook_url=webhook_url,
+            # Requests without the X-Telegram-Bot-Api-Secret-Token header are rejected (403)
+            secret_token=os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32),
+            max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)))
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -34,6 +67,7 @@ if __name__ == '__main__':
     try:
         session = loop.run_until_complete(get_session())
         loop.run_until_complete(db_init())
+        loop.run_until_complete(timetable.rebuild(session))
         main(session)
     finally:
         loop.close()
@@ -0,0 +1,99 @@
+"""Consumer autoscaling (lib/supervisor.py) under a synthetic evening rush, simulated time.
+
+Updates arrive at --base-rate per second, at --rush-rate during the rush; every consumer
+processes one update per --service-time seconds and crashes with --crash-rate per update.
+
+    python bench-autoscale.py --rush-rate 40 --service-time 0.2 --max-workers 10 --crash-rate 0.002
+"""
+import random
+import logging
+import argparse
+import statistics
+
+from lib.fake_broker import LocalBroker, SimulatedConsumer
+from lib.supervisor import Supervisor, ScalePolicy
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def rate_at(args, now: float) -> float:
+    return args.rush_rate if args.rush_start <= now < args.rush_end else args.base_rate
+
+
+def main(args):
+    logging.basicConfig(level=logging.ERROR)  # Restarts and scaling are in the timeline
+    rng = random.Random(args.seed)
+    clock = SimulatedClock()
+    broker = LocalBroker()
+    consumers = []
+
+    def spawn(number):
+        consumer = SimulatedConsumer(
+            broker, clock(), args.service_time,
+            startup_time=args.startup_time, crash_rate=args.crash_rate, rng=rng)
+        consumers.append(consumer)
+        return consumer
+
+    policy = ScalePolicy(
+        min_workers=args.min_workers,
+        max_workers=args.max_workers,
+        target_depth=args.target_depth,
+        target_latency=args.target_latency,
+        scale_down_delay=args.scale_down_delay)
+    supervisor = Supervisor(broker, spawn, policy, clock=clock)
+    supervisor.scale(clock(), policy.min_workers)
+
+    step = 0.01
+    next_tick = 0.0
+    next_report = 0.0
+    latencies = []
+    print('%6s %6s %6s %8s %12s' % ('time', 'rate', 'depth', 'workers', 'latency, s'))
+    while clock.now < args.duration:
+        arrivals = rng.random() < rate_at(args, clock.now) * step  # One per step at most, rates below 1/step
+        if arrivals:
+            broker.publish(clock.now)
+        for consumer in consumers:
+            consumer.step(clock.now)
+        if clock.now >= next_tick:
+            latencies.extend(broker.samples)
+            depth, latency = supervisor.tick()
+            next_tick += args.interval
+            if clock.now >= next_report:
+                print('%6.0f %6.0f %6d %8d %12s' % (
+                    clock.now, rate_at(args, clock.now), depth, len(supervisor.workers),
+                    '%.2f' % latency if latency is not None else '-'))
+                next_report += args.report
+        clock.now += step
+
+    latencies.sort()
+    print('processed %d of %d, latency median %.2f s, p95 %.2f s, max %.2f s' % (
+        broker.processed, broker.processed + broker.depth(),
+        statistics.median(latencies), latencies[int(len(latencies) * 0.95)], latencies[-1]))
+    print('supervisor: %s' % dict(supervisor.metrics))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', default=300, type=float, help='simulated seconds')
+    parser.add_argument('--base-rate', default=2, type=float, help='updates per second')
+    parser.add_argument('--rush-rate', default=40, type=float)
+    parser.add_argument('--rush-start', default=60, type=float)
+    parser.add_argument('--rush-end', default=180, type=float)
+    parser.add_argument('--service-time', default=0.2, type=float, help='seconds per update')
+    parser.add_argument('--startup-time', default=1.0, type=float, help='seconds until a consumer is ready')
+    parser.add_argument('--crash-rate', default=0.0, type=float, help='probability per update')
+    parser.add_argument('--min-workers', default=1, type=int)
+    parser.add_argument('--max-workers', default=10, type=int)
+    parser.add_argument('--target-depth', default=10, type=int)
+    parser.add_argument('--target-latency', default=1.0, type=float)
+    parser.add_argument('--scale-down-delay', default=30, type=float)
+    parser.add_argument('--interval', default=1.0, type=float, help='supervisor tick, seconds')
+    parser.add_argument('--report', default=10, type=float, help='seconds between timeline rows')
+    parser.add_argument('--seed', default=1, type=int)
+    main(parser.parse_args())
@@ -0,0 +1,94 @@
+"""Outbound Bot API throughput against the local fake server (lib/fake_bot_api.py).
+
+fan-out: concurrent edits of forms of many chats (event subscribers, cron) by pool size.
+interactive: latency of a reply during a fan-out burst, with a shared and separate pools.
+
+    python bench-bot-api.py --calls 200 --latency 0.05 --pools 1 4 8 16
+"""
+import os
+import time
+import asyncio
+import argparse
+import itertools
+import statistics
+
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+
+from telegram.error import RetryAfter, TimedOut
+
+from lib.fake_bot_api import FakeBotApi
+
+runs = itertools.count()  # Texts differ between runs, otherwise edits are 'not modified'
+
+
+async def fan_out(bot, calls: int, chats: int):
+    errors = {'retry_after': 0, 'timed_out': 0}
+    run = next(runs)
+
+    async def edit(i):
+        try:
+            await bot.edit_message_text(chat_id=i % chats + 1, message_id=i + 1, text='bench %s %s' % (run, i))
+        except RetryAfter:
+            errors['retry_after'] += 1
+        except TimedOut:
+            errors['timed_out'] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[edit(i) for i in range(calls)])
+    return time.perf_counter() - started, errors
+
+
+async def interactive(reply_bot, background_bot, calls: int, chats: int, replies: int = 10):
+    burst = asyncio.create_task(fan_out(background_bot, calls, chats))
+    latencies = []
+    for i in range(replies):
+        started = time.perf_counter()
+        await reply_bot.send_message(chat_id=chats + 1, text='reply %s' % i)
+        latencies.append(time.perf_counter() - started)
+    await burst
+    return latencies
+
+
+async def main(args):
+    api = await FakeBotApi(
+        latency=args.latency,
+        chat_rate=args.chat_rate,
+        global_rate=args.global_rate).start()
+    os.environ['BOT_API_URL'] = api.base_url
+
+    import lib.bot as bot_module
+    bot_module.base_url = api.base_url
+
+    print('fan-out: %s edits to %s chats, latency %s s' % (args.calls, args.chats, args.latency))
+    for pool_size in args.pools:
+        bot = bot_module.build_bot(pool_size)
+        await bot.get_me()  # Warm up the pool
+        elapsed, errors = await fan_out(bot, args.calls, args.chats)
+        print('  pool %3d: %7.3f s, %7.1f calls/s, 429: %d, pool timeouts: %d' % (
+            pool_size, elapsed, args.calls / elapsed, errors['retry_after'], errors['timed_out']))
+        await bot.request.shutdown()
+
+    print('interactive: reply latency during the fan-out')
+    shared = bot_module.build_bot(bot_module.interactive_pool_size)
+    reply_bot = bot_module.build_bot(bot_module.interactive_pool_size)
+    background_bot = bot_module.build_bot(bot_module.background_pool_size)
+    for name, reply, background in [('shared pool', shared, shared),
+                                    ('separate pools', reply_bot, background_bot)]:
+        latencies = await interactive(reply, background, args.calls, args.chats)
+        print('  %-14s: median %6.1f ms, max %6.1f ms' % (
+            name, statistics.median(latencies) * 1000, max(latencies) * 1000))
+    for bot in (shared, reply_bot, background_bot):
+        await bot.request.shutdown()
+
+    await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', default=200, type=int)
+    parser.add_argument('--chats', default=50, type=int)
+    parser.add_argument('--latency', default=0.05, type=float, help='fake server latency, seconds')
+    parser.add_argument('--pools', default=[1, 4, 8, 16], nargs='+', type=int)
+    parser.add_argument('--chat-rate', default=None, type=int, help='flood limit per chat')
+    parser.add_argument('--global-rate', default=None, type=int, help='flood limit of the bot')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,59 @@
+"""Encode/decode cost and size of signed callback_data (lib/callbacks.py) against legacy '<state> <value>'.
+
+    python bench-callbacks.py --number 100000
+"""
+import os
+import timeit
+import argparse
+from datetime import date, time
+
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+
+import lib.callbacks as callbacks
+from lib.models import User, AppointmentData, ReminderData, SummaryData, BookingsData
+
+user = User(id=123456, chat_id=123456)
+
+cases = [  # name, data, state, value
+    ('date', AppointmentData(id=987654, state=0, version=3), 0, date.today().isoformat()),
+    ('time', AppointmentData(id=987654, state=1, version=4), 1, time(20, 0).isoformat()),
+    ('washer', AppointmentData(id=987654, state=2, version=5), 2, '4'),
+    ('reminder', ReminderData(id=987654, state=0, version=2), 0, '86400'),
+    ('summary', SummaryData(id=987654, state=0, version=2), 0, date.today().isoformat()),
+    ('cancel', BookingsData(id=987654, state=0, version=9), 0, '1234567'),
+]
+
+
+def legacy_encode(state, value):
+    return ' '.join([str(state), value])
+
+
+def legacy_decode(callback_data):
+    state, value = callback_data.split(' ')
+    return int(state), value
+
+
+def main(args):
+    print('%-9s %6s %6s %10s %10s %10s %10s' % (
+        'button', 'legacy', 'signed', 'legacy enc', 'legacy dec', 'encode', 'decode'))
+    for name, data, state, value in cases:
+        signed = callbacks.encode(user, data, state, value)
+        legacy = legacy_encode(state, value)
+        assert callbacks.decode(signed).value == value
+
+        timings = [
+            timeit.timeit(lambda: legacy_encode(state, value), number=args.number),
+            timeit.timeit(lambda: legacy_decode(legacy), number=args.number),
+            timeit.timeit(lambda: callbacks.encode(user, data, state, value), number=args.number),
+            timeit.timeit(lambda: callbacks.decode(signed), number=args.number),
+        ]
+        print('%-9s %6d %6d %s' % (
+            name, len(legacy), len(signed),
+            ' '.join('%7.2f us' % (t / args.number * 1e6) for t in timings)))
+    print('limit of callback_data: %d bytes' % callbacks.MAX_SIZE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', default=100000, type=int, help='calls per measurement')
+    main(parser.parse_args())
@@ -0,0 +1,104 @@
+"""Days of cron ticks (cron-update.py) on a fake clock, in-memory database and the fake Bot API.
+
+Every user has bookings on the next days and a reminder an hour before; the clock is moved
+one minute per tick, so reminders, reserved and passed forms happen as in production.
+
+    python bench-cron.py --days 2 --users 20
+"""
+import os
+import time
+import asyncio
+import argparse
+import importlib.util
+from datetime import datetime, timedelta
+
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+os.environ['DATABASE_URL'] = 'sqlite+aiosqlite://'
+
+import lib.clock as clock
+import lib.constants as const
+from lib.fake_bot_api import FakeBotApi
+
+
+def load_cron():
+    spec = importlib.util.spec_from_file_location('cron_update', 'cron-update.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def seed(users: int, start: datetime):
+    from lib.models import async_session, init as db_init, \
+        User, Washer, ReminderData, Reminder, Message, AppointmentData, Appointment
+    import lib.timetable as timetable
+
+    await db_init()
+    async with async_session() as session:
+        washers = [Washer(id=i, name=str(i), available=True) for i in range(1, 5)]
+        session.add_all(washers)
+        message_ids = iter(range(1, 10 ** 6))
+        bookings = 0
+        for i in range(users):
+            user = User(first_name='F%s' % i, last_name='L%s' % i, order_number=str(i),
+                        username='u%s' % i, chat_id=1000 + i, role=const.UserRole.user)
+            session.add(user)
+            reminder_data = ReminderData(state=0)
+            session.add(reminder_data)
+            session.add(Reminder(seconds=3600, data=reminder_data, user=user))
+            for day in range(1, const.available_days):  # One slot a day, a washer per user
+                book_date = (start + timedelta(days=day)).date()
+                book_time = const.available_time[i % len(const.available_time)]
+                message = Message(id=next(message_ids), user=user)
+                data = AppointmentData(
+                    book_date=book_date, book_time=book_time, state=2, message=message)
+                session.add(Appointment(
+                    book_date=book_date, book_time=book_time, data=data, user=user,
+                    washer=washers[i % len(washers)]))
+                bookings += 1
+        await session.commit()
+        await timetable.rebuild(session)
+    return bookings
+
+
+async def main(args):
+    api = await FakeBotApi().start()
+    import lib.bot as bot_module
+    bot_module.base_url = api.base_url
+
+    fake_clock = clock.FakeClock(datetime.combine(datetime.now().date(), datetime.min.time()))
+    clock.install(fake_clock)
+    bookings = await seed(args.users, fake_clock.now())
+
+    cron = load_cron()
+    from lib.events import bus
+    bot = bot_module.build_bot()
+    bus.start(bot)
+
+    ticks = args.days * 24 * 60
+    started = time.perf_counter()
+    for tick in range(ticks):
+        with clock.freeze():
+            await cron.update(bot)
+        await bus.drain()
+        fake_clock.advance(minutes=1)
+        if args.report and (tick + 1) % args.report == 0:
+            print('  %s: %5d ticks, %6.1f s, sent %d, edited %d' % (
+                fake_clock.now(), tick + 1, time.perf_counter() - started,
+                api.count('sendMessage'), api.count('editMessageText')))
+    elapsed = time.perf_counter() - started
+
+    await bus.stop()
+    await bot.request.shutdown()
+    await api.stop()
+    print('%d days (%d ticks) of %d users, %d bookings in %.1f s: %.2f ms per tick' % (
+        args.days, ticks, args.users, bookings, elapsed, elapsed / ticks * 1000))
+    print('Bot API: %d sendMessage (reminders), %d editMessageText (reserved, passed forms)' % (
+        api.count('sendMessage'), api.count('editMessageText')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', default=2, type=int, help='simulated days, a tick per minute')
+    parser.add_argument('--users', default=20, type=int)
+    parser.add_argument('--report', default=360, type=int, help='ticks between progress rows, 0: none')
+    asyncio.run(main(parser.parse_args()))
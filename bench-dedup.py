@@ -0,0 +1,59 @@
+"""Cost of the update dedup (lib/dedup.py): process window check and memory, shared store claim.
+
+    python bench-dedup.py --updates 100000 --sizes 1000 10000 100000 --claims 1000
+"""
+import os
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+os.environ.setdefault('DATABASE_URL', 'sqlite+aiosqlite://')
+
+import lib.dedup as dedup
+from lib.models import get_session, init as db_init
+
+
+def bench_window(size: int, updates: int):
+    tracemalloc.start()
+    window = dedup.UpdateWindow(size)
+    started = time.perf_counter()
+    for update_id in range(updates):
+        window.add(update_id)
+        window.add(update_id)  # Redelivery
+    elapsed = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed / (updates * 2), memory
+
+
+async def bench_store(claims: int):
+    await db_init()
+    session = await get_session()
+    dedup.window = dedup.UpdateWindow(1)  # Every claim reaches the store
+    started = time.perf_counter()
+    for update_id in range(claims):
+        await dedup.claim(session, update_id)
+    elapsed = time.perf_counter() - started
+    duplicates = sum([not await dedup.claim(session, update_id) for update_id in range(claims)])
+    await session.close()
+    return elapsed / claims, duplicates
+
+
+def main(args):
+    print('window: %d updates, each delivered twice' % args.updates)
+    for size in args.sizes:
+        per_check, memory = bench_window(size, args.updates)
+        print('  size %7d: %6.3f us per check, %8.1f KiB' % (size, per_check * 1e6, memory / 1024))
+
+    per_claim, duplicates = asyncio.run(bench_store(args.claims))
+    print('store (%s): %6.1f us per claim, %d/%d redeliveries rejected' % (
+        os.environ['DATABASE_URL'], per_claim * 1e6, duplicates, args.claims))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', default=100000, type=int)
+    parser.add_argument('--sizes', default=[1000, 10000, 100000], nargs='+', type=int, help='window sizes')
+    parser.add_argument('--claims', default=1000, type=int, help='claims of the shared store')
+    main(parser.parse_args())
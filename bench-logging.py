@@ -0,0 +1,67 @@
+"""Cost of a log record for the handler: direct write vs the queue of lib/logs.py, slow disk.
+
+The writer sleeps --write-delay seconds per record (a redirected output.log on a busy disk);
+a direct handler makes the event loop wait for it, the queued one only renders the record.
+
+    python bench-logging.py --records 2000 --write-delay 0.0005 --rate 100
+"""
+import time
+import logging
+import argparse
+import logging.handlers
+
+import lib.logs as logs
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+        self.written = 0
+
+    def emit(self, record):
+        self.format(record)
+        time.sleep(self.delay)
+        self.written += 1
+
+
+def emit_records(logger: logging.Logger, records: int) -> float:
+    started = time.perf_counter()
+    for i in range(records):
+        logger.info('Button %s of state %s: %s', i % 4, 1, {'id': i, 'book_date': '2026-10-20'})
+    return time.perf_counter() - started
+
+
+def main(args):
+    logger = logging.getLogger('bench')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    writer = SlowHandler(args.write_delay)
+    writer.setFormatter(logs.JsonFormatter())
+    logger.handlers[:] = [writer]
+    direct = emit_records(logger, args.records)
+    print('direct:  %8.1f us per record in the handler, %d written' % (
+        direct / args.records * 1e6, writer.written))
+
+    writer = SlowHandler(args.write_delay)
+    writer.setFormatter(logs.JsonFormatter())
+    handler = logs.NonBlockingQueueHandler(args.queue_size)
+    if args.rate:
+        handler.addFilter(logs.RateLimitFilter(args.rate))
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    listener.start()
+    logger.handlers[:] = [handler]
+    queued = emit_records(logger, args.records)
+    listener.stop()
+    print('queued:  %8.1f us per record in the handler, %d written, %d dropped by the full queue' % (
+        queued / args.records * 1e6, writer.written, handler.dropped))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', default=2000, type=int)
+    parser.add_argument('--write-delay', default=0.0005, type=float, help='seconds per written record')
+    parser.add_argument('--queue-size', default=10000, type=int)
+    parser.add_argument('--rate', default=0, type=float, help='records per second per logger, 0: no limit')
+    main(parser.parse_args())
@@ -0,0 +1,205 @@
+"""Weeks of user traffic through the handlers of app.py, memory (RSS) of the process per day.
+
+Every simulated day a part of the users (new ones join daily) sends /book, /my or /remind
+and clicks the buttons of the reply, on a fake clock, the fake Bot API and a database file.
+After the warm-up days RSS must stay under the ceiling: per-user state and the identity
+map of the shared session are bounded (lib/state.py). --unbounded keeps the ORM objects
+in user_data and every user, as before.
+
+    python bench-memory.py --days 21 --active 60 --new 20 --ceiling 8
+"""
+import os
+import gc
+import sys
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+from datetime import datetime, timedelta
+
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+database_dir = tempfile.TemporaryDirectory()  # Not in memory: the database would be in RSS
+os.environ['DATABASE_URL'] = 'sqlite+aiosqlite:///%s/bench.db' % database_dir.name
+
+import lib.clock as clock
+import lib.constants as const
+from lib.fake_bot_api import FakeBotApi
+
+COMMANDS = ['/book', '/book', '/my', '/remind']
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:  # Not Linux: peak RSS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+class Traffic:
+    """Updates of the Bot API format from the users, replies are read from the fake Bot API"""
+
+    def __init__(self, application, api: FakeBotApi):
+        self.application = application
+        self.api = api
+        self.update_ids = iter(range(1, 10 ** 9))
+        self.updates = 0
+
+    @staticmethod
+    def user(chat_id: int) -> dict:
+        return {'id': chat_id, 'is_bot': False, 'first_name': 'F%s' % chat_id}
+
+    async def process(self, update: dict):
+        from telegram import Update
+
+        update['update_id'] = next(self.update_ids)
+        await self.application.process_update(Update.de_json(update, self.application.bot))
+        self.updates += 1
+
+    async def command(self, chat_id: int, text: str):
+        await self.process({'message': {
+            'message_id': next(self.update_ids), 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'}, 'from': self.user(chat_id),
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}})
+
+    async def click(self, chat_id: int, message_id: int, data: str):
+        await self.process({'callback_query': {
+            'id': str(next(self.update_ids)), 'chat_instance': str(chat_id), 'data': data,
+            'from': self.user(chat_id), 'message': {
+                'message_id': message_id, 'date': int(time.time()), 'text': '-',
+                'chat': {'id': chat_id, 'type': 'private'}}}})
+
+    def last_message(self, chat_id: int):
+        messages = [key[1] for key in self.api.messages if key[0] == chat_id]
+        return max(messages) if messages else None
+
+    async def session(self, chat_id: int, clicks: int):
+        """A command and random buttons of its reply"""
+        await self.command(chat_id, random.choice(COMMANDS))
+        message_id = self.last_message(chat_id)
+        for _ in range(clicks):
+            if message_id is None:
+                break
+            _, reply_markup = self.api.messages.get((chat_id, message_id), (None, None))
+            buttons = [button['callback_data'] for row in (reply_markup or {}).get('inline_keyboard', [])
+                       for button in row if button.get('callback_data')]
+            if not buttons:
+                break
+            await self.click(chat_id, message_id, random.choice(buttons))
+        for key in [key for key in self.api.messages if key[0] == chat_id]:  # Memory of the fake server
+            del self.api.messages[key]
+
+
+async def seed(users: int):
+    from lib.models import async_session, init as db_init, User, Washer
+
+    await db_init()
+    async with async_session() as session:
+        session.add_all(Washer(id=i, name=str(i), available=True) for i in range(1, 5))
+        session.add_all(
+            User(first_name='F%s' % i, last_name='L%s' % i, order_number=str(i), username='u%s' % i,
+                 chat_id=1000 + i, role=const.UserRole.user)
+            for i in range(users))
+        await session.commit()
+
+
+def unbound():
+    import lib.state as state
+
+    state.users.max_users = 10 ** 9
+    state.users.ttl = timedelta(days=10 ** 4)
+    state.identity_map_limit = 10 ** 9
+    state.dehydrate = lambda user_data: None  # ORM objects stay in user_data, as before lib/state.py
+
+
+async def main(args):
+    random.seed(args.seed)
+    api = await FakeBotApi().start()
+    import lib.bot as bot_module
+    bot_module.base_url = api.base_url
+
+    fake_clock = clock.FakeClock(datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=9))
+    clock.install(fake_clock)
+    users = args.users + args.new * args.days
+    await seed(users)
+
+    import lib.state as state
+    import lib.dedup as dedup
+    import lib.timetable as timetable
+    from lib.events import bus
+    from lib.handlers import user_handlers
+    from lib.models import get_session
+    if args.unbounded:
+        unbound()
+
+    application = bot_module.build_application()
+    session = application.bot_data['session'] = await get_session()
+    application.add_handlers(user_handlers)
+    await application.initialize()
+    await timetable.rebuild(session)
+    bus.start(bot_module.build_bot())
+    traffic = Traffic(application, api)
+
+    print('%-10s %8s %10s %12s %8s' % ('day', 'updates', 'user_data', 'identity map', 'RSS MB'))
+    started = time.perf_counter()
+    baseline = peak = None
+    bot_calls = 0
+    for day in range(args.days):
+        joined = args.users + args.new * (day + 1)  # Users so far
+        for _ in range(args.active):
+            chat_id = 1000 + random.randrange(joined)
+            fake_clock.advance(seconds=random.randrange(60, 600))
+            await traffic.session(chat_id, random.randrange(1, args.clicks + 1))
+        await bus.drain()
+        fake_clock.set(datetime.combine(fake_clock.now().date() + timedelta(days=1), datetime.min.time())
+                       + timedelta(hours=9))
+        await dedup.remove_passed(session, fake_clock.now())
+        bot_calls += len(api.calls)
+        api.calls.clear()
+        api.chat_sent.clear()
+
+        gc.collect()
+        rss = rss_mb()
+        print('%-10s %8d %10d %12d %8.1f' % (
+            fake_clock.now().date(), traffic.updates, len(application.user_data),
+            len(session.identity_map), rss))
+        if day + 1 == args.warmup:
+            baseline = rss
+        elif baseline is not None:
+            peak = max(peak or rss, rss)
+    elapsed = time.perf_counter() - started
+
+    await bus.stop()
+    await bus.bot.request.shutdown()
+    await application.shutdown()
+    await api.stop()
+    print('%d days, %d updates in %.1f s, %d Bot API calls; evicted users %d, identity map expunged %d times' % (
+        args.days, traffic.updates, elapsed, bot_calls, state.metrics['evicted'], state.metrics['expunged']))
+
+    if baseline is None or peak is None:
+        print('No days after the warm-up (--days > --warmup)')
+        return 0
+    growth = peak - baseline
+    print('RSS after the warm-up %.1f MB, peak %.1f MB: +%.1f MB, ceiling +%.1f MB' % (
+        baseline, peak, growth, args.ceiling))
+    if growth > args.ceiling:
+        print('FAIL: memory grows with the traffic')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', default=21, type=int, help='simulated days')
+    parser.add_argument('--users', default=50, type=int, help='users of the first day')
+    parser.add_argument('--new', default=20, type=int, help='new users per day')
+    parser.add_argument('--active', default=60, type=int, help='user sessions (a command and clicks) per day')
+    parser.add_argument('--clicks', default=4, type=int, help='max buttons clicked per session')
+    parser.add_argument('--warmup', default=3, type=int, help='days before the RSS baseline')
+    parser.add_argument('--ceiling', default=8, type=float, help='MB of RSS growth allowed after the warm-up')
+    parser.add_argument('--unbounded', action='store_true', help='no limits of lib/state.py')
+    parser.add_argument('--seed', default=1, type=int)
+    sys.exit(asyncio.run(main(parser.parse_args())))
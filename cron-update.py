@@ -1,99 +1,153 @@
-import os
+from dotenv import load_dotenv
+load_dotenv()  # TZ Important
 
-from time import time
-from app import application
-from sqlalchemy.orm import selectinload, noload
-from telegram.ext import ApplicationBuilder
+import time
+time.tzset()  # Set timezone
 
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
+
+from lib.bot import build_bot
 from lib.constants import UserRole
+import lib.clock as clock
 import lib.constants as const
-from lib.misc import timedelta_to_str
+import lib.delivery as delivery
+import lib.summaries as summaries
+import lib.reminders as reminders
+import lib.dedup as dedup
+import lib.tracing as tracing
+import lib.logs as logs
+import lib.waitlist as waitlist
+import lib.recurring as recurring
+import lib.timetable as timetable
+import lib.subscribers  # Registers event subscribers
+from lib.events import bus, emit, EventContext, AppointmentReserved, AppointmentPassed
 from lib.forms.appointment import AppointmentForm
+from lib.forms.summary import SummaryForm
 
 import asyncio
 from datetime import datetime, timedelta
 from sqlalchemy import select, func, or_
-from lib.models import async_session, User, AppointmentData, SummaryData, Appointment
+from lib.models import async_session, rollback, read_only, begin_update, User, AppointmentData, Appointment, Message
 
 
 async def main():
-    now_dt = datetime.now()
+    logs.setup()
+    bot = build_bot()  # No Application: cron only sends and edits messages
+    bus.start(bot)
+    try:
+        with tracing.span('cron'), clock.freeze():  # One "now" for the whole tick
+            await update(bot)
+            await bus.stop()  # Subscribers of events emitted by this tick
+    finally:
+        await bot.request.shutdown()  # Bot was never initialized (no get_me round trip)
+
+
+async def update(bot):
+    now_dt = clock.now()
     now_rdt = now_dt - \
         timedelta(seconds=now_dt.second,
                   microseconds=now_dt.microsecond)
     async with async_session() as session:
+        await begin_update(session)  # Replica lag
+        await waitlist.remove_passed(session, now_dt.date())
+
+        # MOVE ROLLING SUMMARIES (/today) TO THE NEXT DAY
+        context = EventContext(bot, session)
+        for summary_data, moderator in await summaries.roll(session, now_dt.date()):
+            await SummaryForm(session, moderator, summary_data).update_message(None, context, allocate=False)
+
+        # MATERIALIZE RECURRING BOOKINGS
+        created, failed = await recurring.materialize(session)
+        await recurring.notify(session, bot, created, failed)
+
         # REMIND ALL MODERATORS
         stmt = select(User) \
             .where(
-                User.role == UserRole.moderator) \
-            .options(
-                selectinload(User.reminders))
-
-        sending_messages = []
-        moderators = (await session.scalars(stmt)).unique().all()
-        for moderator in moderators:
-            for reminder in moderator.reminders:
-                reminder_td = timedelta(seconds=reminder.seconds)
-                book_rdt = now_rdt + reminder_td
-                stmt = select(func.count()).where(
-                    Appointment.book_date == book_rdt.date(),
-                    Appointment.book_time == book_rdt.time()
-                )
-                appointments_count = (await session.scalars(stmt)).unique().one_or_none()
-                if appointments_count:
-                    stmt = select(SummaryData) \
-                        .where(SummaryData.summary_date == book_rdt.date())
-                    for summary_data in (await session.scalars(stmt)).unique().all():
-                        if summary_data.message_id is not None:
-                            message = application.bot.send_message(
-                                chat_id=summary_data.message.user.chat_id,
-                                reply_to_message_id=summary_data.message.id,
-                                parse_mode='Markdown',
-                                text=f'🔔 Через *%s* назначены стирки - %s' % (
-                                    timedelta_to_str(reminder_td), appointments_count)
-                            )
-                            sending_messages.append(message)
-
-        # REMIND ALL USERS
+                User.role == UserRole.moderator)
+
+        notifications = []
+        appointments_counts = {}  # book_rdt -> count, shared by moderators
+        # Scans of reminders are read-only (replica), on the primary after writes of this tick (pinned)
+        with read_only(session):
+            moderators = (await session.scalars(stmt)).unique().all()
+            masks = await reminders.load_masks(session, [moderator.id for moderator in moderators])
+            for moderator in moderators:
+                for seconds in reminders.to_seconds(masks[moderator.id]):
+                    book_rdt = now_rdt + timedelta(seconds=seconds)
+                    if book_rdt not in appointments_counts:
+                        stmt = select(func.count()).where(
+                            Appointment.book_at == book_rdt)
+                        appointments_counts[book_rdt] = (await session.scalars(stmt)).one()
+                    if appointments_counts[book_rdt]:
+                        notifications.append(delivery.Notification(
+                            chat_id=moderator.chat_id,
+                            book_at=book_rdt,
+                            seconds=seconds,
+                            kind=const.REMINDER_MODERATOR,
+                            reply_to_message_id=await summaries.live_message_id(session, moderator, book_rdt.date()),
+                            count=appointments_counts[book_rdt]))
+
+            # REMIND ALL USERS (reminder timetable is maintained by events)
+            for scheduled_reminder, data in await timetable.due(session, now_rdt):
+                notifications.append(delivery.Notification(
+                    chat_id=scheduled_reminder.user.chat_id,
+                    book_at=datetime.combine(scheduled_reminder.book_date, scheduled_reminder.book_time),
+                    seconds=scheduled_reminder.seconds,
+                    kind=const.REMINDER_USER,
+                    reply_to_message_id=data.message_id))
+        await timetable.remove_passed(session, now_rdt)
+
+        # One digest per chat, every reminder at most once (sent-log)
+        claimed = await delivery.claim(session, notifications, now_rdt)
+        sending_messages = [delivery.send(bot, claimed)]
+        await delivery.remove_passed(session, now_rdt)
+        await dedup.remove_passed(session, now_rdt)
+
+        # CLOSE RESERVED AND PASSED FORMS (only slots that can expire around now, passed ones once)
         stmt = select(AppointmentData) \
             .where(
-                AppointmentData.book_date is not None,
-                AppointmentData.book_time is not None,
-                AppointmentData.message) \
+                AppointmentData.book_at >= now_rdt - timedelta(days=1),
+                AppointmentData.book_at <= now_rdt + timedelta(hours=const.book_time_left),
+                AppointmentData.message_id.isnot(None),
+                ~AppointmentData.finished) \
             .options(
-                selectinload(AppointmentData.message))
+                selectinload(AppointmentData.message)
+                    .selectinload(Message.user))
 
         expired_forms = []
         datas = (await session.scalars(stmt)).unique().all()
+        loaded = datas + [data.message.user for data in datas]  # Reloaded after a conflict
         for data in datas:
-            if data.message_id is not None and bool(data.appointments):
-                book_dt = datetime.combine(data.book_date, data.book_time)
+            if bool(data.appointments):
+                book_dt = data.book_at
                 if now_rdt >= book_dt - timedelta(hours=const.book_time_left):
+                    event_args = (data.message.user_id, data.id, data.book_date, data.book_time)
                     if now_rdt >= book_dt:
                         close_reason = const.APPOINTMENT_IS_PASSED  # PASSED
+                        if not data.finished:  # Also after a late or skipped tick
+                            data.finished = True
+                            emit(session, AppointmentPassed(*event_args))
+                            try:
+                                await session.commit()
+                            except StaleDataError:  # Changed meanwhile, emitted on the next pass
+                                await rollback(session, *loaded)
+                                continue
                         # TODO: Remove data
                     else:
                         close_reason = const.APPOINTMENT_IS_RESERVED  # RESERVED
                         if data.reserved:
                             continue  # NOT MODIFY MESSAGE
                         data.reserved = True
-                        await session.commit()
+                        emit(session, AppointmentReserved(*event_args))
+                        try:
+                            await session.commit()
+                        except StaleDataError:  # Changed by the user meanwhile, closed on the next pass
+                            await rollback(session, *loaded)
+                            continue
                     expired_form = AppointmentForm(session, data.message.user, data) \
-                        .close(close_reason, application.bot)
+                        .close(close_reason, bot)
                     expired_forms.append(expired_form)
-                else:
-                    user = data.message.user
-                    for reminder in user.reminders:  # REMINDERS
-                        reminder_td = timedelta(seconds=reminder.seconds)
-                        notify_dt = book_dt - reminder_td
-                        if now_rdt == notify_dt:
-                            message = application.bot.send_message(
-                                chat_id=user.chat_id,
-                                reply_to_message_id=data.message.id,
-                                parse_mode='Markdown',
-                                text=f'🔔 Через *%s* назначена ваша стирка' % (timedelta_to_str(reminder_td),)
-                            )
-                            sending_messages.append(message)
 
         await asyncio.gather(*sending_messages, *expired_forms)
 
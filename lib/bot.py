@@ -0,0 +1,84 @@
+import os
+import importlib.util
+
+# Outbound Bot API connections: interactive - replies to updates, background - fan-out
+# (event subscribers, cron); separate pools, so a burst of edits does not delay replies
+interactive_pool_size = int(os.getenv('BOT_POOL_SIZE', 8))
+background_pool_size = int(os.getenv('BOT_BACKGROUND_POOL_SIZE', 4))
+keepalive_expiry = float(os.getenv('BOT_KEEPALIVE_EXPIRY', 60))  # In seconds
+base_url = os.getenv('BOT_API_URL', 'https://api.telegram.org/bot')  # Fake server: lib/fake_bot_api.py
+
+
+class PoolStats:  # Utilisation of a pool (/stats_runtime), in flight above size: calls wait for a connection
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.in_flight = 0
+        self.peak = 0
+        self.calls = 0
+
+
+pools = []  # PoolStats of the requests of this process
+
+
+def build_request(pool_size: int, name: str = 'background'):
+    import httpx
+    from telegram.request import HTTPXRequest  # Lazy: see build_bot
+
+    import lib.tracing as tracing
+
+    async def inject_traceparent(request: httpx.Request):
+        traceparent = tracing.inject()
+        if traceparent:
+            request.headers['traceparent'] = traceparent
+
+    class PooledRequest(HTTPXRequest):
+        """HTTPXRequest with long keep-alive, and HTTP/2 if h2 is installed (httpx[http2])"""
+
+        def _build_client(self) -> httpx.AsyncClient:
+            self._client_kwargs['limits'] = httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=keepalive_expiry)
+            return httpx.AsyncClient(
+                http2=importlib.util.find_spec('h2') is not None,
+                event_hooks={'request': [inject_traceparent]},
+                **self._client_kwargs)
+
+        async def do_request(self, url: str, method: str, *args, **kwargs):
+            stats.in_flight += 1
+            stats.peak = max(stats.peak, stats.in_flight)
+            stats.calls += 1
+            try:
+                with tracing.child('bot_api', method=url.rsplit('/', 1)[-1]):  # Method only, the url has the token
+                    return await super().do_request(url, method, *args, **kwargs)
+            finally:
+                stats.in_flight -= 1
+
+    stats = PoolStats(name, pool_size)
+    pools.append(stats)
+    return PooledRequest(connection_pool_size=pool_size)
+
+
+def build_bot(pool_size: int = background_pool_size):
+    """Bare Bot for entry points that only call the Bot API (cron, prepare, updater)"""
+    from telegram import Bot  # Lazy: telegram.ext is not needed here
+
+    return Bot(os.environ['BOT_TOKEN'], base_url=base_url, request=build_request(pool_size))
+
+
+def build_application(post_init=None, post_shutdown=None, application_class=None):
+    from telegram.ext import ApplicationBuilder  # Lazy: heavy (apscheduler, httpx, ...)
+
+    builder = ApplicationBuilder() \
+        .token(os.environ['BOT_TOKEN']) \
+        .base_url(base_url) \
+        .request(build_request(interactive_pool_size, 'interactive')) \
+        .get_updates_request(build_request(1, 'polling'))  # Long polling holds its own connection
+    if post_init:
+        builder = builder.post_init(post_init)
+    if post_shutdown:
+        builder = builder.post_shutdown(post_shutdown)
+    if application_class:
+        builder = builder.application_class(application_class)
+    return builder.build()
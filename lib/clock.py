@@ -0,0 +1,68 @@
+"""Current time of the bot, one "now" per update, event dispatch and cron tick.
+
+freeze() pins now() of the current task (and of the tasks it creates) to one timestamp:
+a render is deterministic even across a minute boundary, and renders of the same data
+version in the same minute are equal (minute() is the time part of render cache keys).
+The source is the system clock, FakeClock in tests and benchmarks (install()).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, date, timedelta
+from typing import Union
+
+
+class SystemClock:
+    def now(self) -> datetime:
+        return datetime.now()
+
+
+class FakeClock:
+    """Clock moved only by the caller, e.g. days of cron ticks in seconds (bench-cron.py)"""
+
+    def __init__(self, start: datetime):
+        self.current = start
+
+    def now(self) -> datetime:
+        return self.current
+
+    def set(self, dt: datetime):
+        self.current = dt
+
+    def advance(self, **kwargs):  # timedelta arguments
+        self.current += timedelta(**kwargs)
+
+
+source: Union[SystemClock, FakeClock] = SystemClock()
+frozen: ContextVar[Union[datetime, None]] = ContextVar('frozen_now', default=None)
+
+
+def install(clock: Union[SystemClock, FakeClock]):
+    global source
+    source = clock
+
+
+def now() -> datetime:
+    return frozen.get() or source.now()
+
+
+def today() -> date:
+    return now().date()
+
+
+def minute() -> datetime:
+    """Now without seconds: renders of one data version are cached per minute"""
+    return now().replace(second=0, microsecond=0)
+
+
+def freeze_update():
+    """Frozen now for the rest of the task (an update handled by several handlers)"""
+    frozen.set(source.now())
+
+
+@contextmanager
+def freeze(at: datetime = None):
+    token = frozen.set(at or source.now())
+    try:
+        yield frozen.get()
+    finally:
+        frozen.reset(token)
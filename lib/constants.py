@@ -8,9 +8,12 @@ class UserRole(enum.Enum):
     employee = 2
 
 error_visible_duration = 2 # In seconds
+stale_data_retries = 3  # Form data changed by other writer while handling a button
 book_time_left = 0.5 # In hours (I don't know how it is in English)
 max_book_washers = 2
 available_days = 5  # Showed buttons in washer select
+profiler_max_duration = 600  # In seconds, /prof start stops itself after
+slow_updates_shown = 10  # /slow
 
 reminder_timedelta = [
     timedelta(minutes=5),
@@ -67,3 +70,18 @@ WASHER_SIGN_CHARS = {  # not_available, available
     APPOINTMENT_IS_PASSED:    ['⌛', None],
     APPOINTMENT_IS_RESERVED:  ['⌛', None]
 }
+
+RECURRING_WASHERS_ARE_BOOKED, \
+RECURRING_MAX_BOOK_WASHERS, \
+RECURRING_SLOT_IS_NOT_AVAILABLE = range(0, 3)
+
+RECURRING_REASON_LOCALE_MAP = {
+    RECURRING_WASHERS_ARE_BOOKED: 'washers_are_booked',
+    RECURRING_MAX_BOOK_WASHERS: 'max_book_washers',
+    RECURRING_SLOT_IS_NOT_AVAILABLE: 'slot_is_not_available'
+}
+
+WAITLIST_SIGN_CHAR = '⏳'  # Booked by other user, current user is in the waitlist
+
+REMINDER_USER, \
+REMINDER_MODERATOR = range(0, 2)
@@ -0,0 +1,66 @@
+import os
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import lib.clock as clock
+from lib.models import ProcessedUpdate
+
+metrics = Counter()  # 'applied', 'window' - duplicates of the process window, 'store' - of the shared store
+
+store_days = 1  # Telegram gives up redelivery of a webhook update long before
+
+
+class UpdateWindow:
+    """Last update ids seen by the process, O(1) check and bounded memory (oldest ids are forgotten)"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+
+    def add(self, update_id: int) -> bool:
+        """False if the update id is in the window (redelivered)"""
+        if update_id in self.ids:
+            return False
+        self.ids.add(update_id)
+        self.order.append(update_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
+
+
+window = UpdateWindow(int(os.getenv('UPDATE_WINDOW_SIZE', 10000)))
+
+
+async def claim(session: AsyncSession, update_id: int) -> bool:
+    """Claim the update before its handlers, False if it is already applied (here or by other process).
+
+    Checked in the window of the process first, then recorded in the shared store with one
+    INSERT that ignores recorded ids, in its own transaction (the session is not pinned,
+    lib/models.py). A claimed update which fails is not applied again (at most once).
+    """
+    if not window.add(update_id):
+        metrics['window'] += 1
+        return False
+
+    stmt = insert(ProcessedUpdate) \
+        .prefix_with('OR IGNORE', dialect='sqlite') \
+        .prefix_with('IGNORE', dialect='mysql') \
+        .values(
+            update_id=update_id,
+            processed_at=clock.now())
+    async with session.bind.begin() as conn:
+        result = await conn.execute(stmt)
+
+    claimed = bool(result.rowcount)
+    metrics['applied' if claimed else 'store'] += 1
+    return claimed
+
+
+async def remove_passed(session: AsyncSession, now_dt: datetime):
+    await session.execute(
+        delete(ProcessedUpdate).where(ProcessedUpdate.processed_at < now_dt - timedelta(days=store_days)))
+    await session.commit()
@@ -0,0 +1,121 @@
+import uuid
+import asyncio
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import lib.misc as misc
+import lib.constants as const
+from lib.misc import append_locale_arg
+from lib.models import SentReminder
+
+logger = logging.getLogger(__name__)
+
+sent_log_days = 1  # Rows of older slots are removed
+
+
+@dataclass(frozen=True)
+class Notification:
+    chat_id: int
+    book_at: datetime  # Slot
+    seconds: int  # Offset of the reminder before the slot
+    kind: int  # const.REMINDER_USER, const.REMINDER_MODERATOR
+    reply_to_message_id: int = None  # Form or summary message of the slot
+    count: int = None  # Appointments of the slot (moderator reminders)
+
+    @property
+    def key(self):
+        return self.chat_id, self.book_at, self.seconds, self.kind
+
+
+def deduplicate(notifications: list[Notification]) -> list[Notification]:
+    """One per (chat, slot, offset, kind): e.g. several forms of one slot, replies to the latest"""
+    unique = {}
+    for notification in notifications:
+        other = unique.get(notification.key)
+        if other is None or (notification.reply_to_message_id or 0) > (other.reply_to_message_id or 0):
+            unique[notification.key] = notification
+    return list(unique.values())
+
+
+async def claim(session: AsyncSession, notifications: list[Notification], now_dt: datetime) -> list[Notification]:
+    """Record the notifications in the sent-log, returns the ones which were not recorded before.
+
+    One INSERT that ignores recorded keys (unique constraint) and one SELECT of the rows
+    of this tick, so reruns and concurrent ticks never claim the same notification.
+    """
+    notifications = deduplicate(notifications)
+    if not notifications:
+        return []
+
+    tick = uuid.uuid4().hex
+    stmt = insert(SentReminder) \
+        .prefix_with('OR IGNORE', dialect='sqlite') \
+        .prefix_with('IGNORE', dialect='mysql')
+    await session.execute(stmt, [
+        dict(
+            chat_id=notification.chat_id,
+            book_at=notification.book_at,
+            seconds=notification.seconds,
+            kind=notification.kind,
+            tick=tick,
+            sent_at=now_dt)
+        for notification in notifications
+    ])
+
+    stmt = select(SentReminder.chat_id, SentReminder.book_at, SentReminder.seconds, SentReminder.kind) \
+        .where(
+            SentReminder.tick == tick)
+    claimed_keys = set((await session.execute(stmt)).all())
+    await session.commit()
+    return [notification for notification in notifications if notification.key in claimed_keys]
+
+
+@append_locale_arg('reminders')
+def digest_text(notifications: list[Notification], locale: dict) -> str:
+    lines = []
+    for notification in sorted(notifications, key=lambda n: (n.book_at, n.kind)):
+        reminder_td = misc.timedelta_to_str(timedelta(seconds=notification.seconds))
+        if notification.kind == const.REMINDER_MODERATOR:
+            line = locale['moderator'] % (reminder_td, notification.count)
+        else:
+            line = locale['user'] % reminder_td
+        if len(notifications) > 1:  # Slots of the digest
+            line += ' - %s' % misc.time_to_str(notification.book_at.time())
+        lines.append('🔔 ' + line)
+    return '\n'.join(lines)
+
+
+async def send(bot, notifications: list[Notification]) -> int:
+    """One digest message per chat of the claimed notifications, returns the number of messages"""
+    chats = defaultdict(list)
+    for notification in notifications:
+        chats[notification.chat_id].append(notification)
+
+    async def send_digest(chat_id, chat_notifications):
+        reply_to_message_ids = {n.reply_to_message_id for n in chat_notifications}
+        try:
+            await bot.send_message(
+                chat_id=chat_id,
+                # Digest of several messages replies to none of them
+                reply_to_message_id=reply_to_message_ids.pop() if len(reply_to_message_ids) == 1 else None,
+                parse_mode='Markdown',
+                text=digest_text(chat_notifications))
+        except Exception:  # Claimed: it is not sent again (at most once)
+            logger.exception('Reminders to %s are not sent', chat_id)
+
+    await asyncio.gather(*[
+        send_digest(chat_id, chat_notifications)
+        for chat_id, chat_notifications in chats.items()
+    ])
+    return len(chats)
+
+
+async def remove_passed(session: AsyncSession, now_dt: datetime):
+    await session.execute(
+        delete(SentReminder).where(SentReminder.book_at < now_dt - timedelta(days=sent_log_days)))
+    await session.commit()
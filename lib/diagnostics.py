@@ -0,0 +1,149 @@
+"""Runtime state of the process for the developer commands (/stats_runtime, /slow).
+
+Event loop lag is measured by a task sleeping `interval` seconds (the excess is the time
+the loop was busy), durations of updates by handlers around all others (lib/handlers.py).
+Everything is kept in bounded windows of recent samples.
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextvars import ContextVar
+from typing import Union
+
+import lib.tracing as tracing
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class LoopMonitor:
+
+    def __init__(self, interval: float = 0.5, window: int = 1200):
+        self.interval = interval
+        self.lags = deque(maxlen=window)  # Seconds, last 10 minutes by default
+        self.task = None
+
+    def start(self):
+        """In processes with a continuously running loop (app.py): an idle loop is not a lag"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(loop.time() - started - self.interval, 0.0))
+
+    def stats(self) -> Union[dict, None]:
+        if not self.lags:
+            return None
+        lags = list(self.lags)
+        return {'last': lags[-1], 'p99': percentile(lags, 0.99), 'max': max(lags)}
+
+
+class SlowUpdates:
+    """Durations of the last `window` updates, the slowest of them on demand"""
+
+    def __init__(self, window: int = 1000):
+        self.updates = deque(maxlen=window)  # (duration, update_id, description, finished at, trace_id)
+
+    def add(self, duration: float, update_id: int, description: str, trace_id: str = None):
+        self.updates.append((duration, update_id, description, time.time(), trace_id))
+
+    def slowest(self, limit: int = 10) -> list[tuple]:
+        return sorted(self.updates, reverse=True)[:limit]
+
+    def stats(self) -> Union[dict, None]:
+        if not self.updates:
+            return None
+        durations = [update[0] for update in self.updates]
+        return {'count': len(durations), 'p50': percentile(durations, 0.5), 'p99': percentile(durations, 0.99)}
+
+
+loop_monitor = LoopMonitor()
+slow_updates = SlowUpdates(int(os.getenv('SLOW_UPDATES_WINDOW', 1000)))
+update_started_at: ContextVar[Union[float, None]] = ContextVar('update_started_at', default=None)
+
+
+def describe(update) -> str:
+    if update.callback_query:
+        return 'callback %s' % (update.callback_query.data or '')[:16]
+    message = update.effective_message
+    if message and message.text:
+        return message.text.split(maxsplit=1)[0][:32] if message.text.startswith('/') else 'text'
+    return 'update'
+
+
+def update_finished(update):
+    started_at = update_started_at.get()
+    if started_at is None:
+        return
+    span = tracing.current_span.get()
+    slow_updates.add(time.perf_counter() - started_at, update.update_id, describe(update),
+                     span.trace_id if span is not None else None)
+
+
+def runtime_stats(application=None) -> list[tuple]:
+    """[(section, [(name, value)])] of the process"""
+    import lib.bot as bot
+    import lib.logs as logs
+    import lib.state as state
+    import lib.dedup as dedup
+    import lib.profiler as profiler
+    import lib.fingerprints as fingerprints
+    from lib.events import bus
+    from lib.forms.base import render_metrics
+    from lib.models import engine, replica
+
+    def rate(hits: int, total: int) -> str:
+        return '%.0f%% of %d' % (100 * hits / total, total) if total else '-'
+
+    def ms(seconds) -> str:
+        return '%.1f ms' % (seconds * 1000) if seconds is not None else '-'
+
+    loop = loop_monitor.stats() or {}
+    updates = slow_updates.stats() or {}
+    sections = [
+        ('process', [
+            ('pid', os.getpid()),
+            ('event loop lag', '%s, p99 %s, max %s' % (ms(loop.get('last')), ms(loop.get('p99')), ms(loop.get('max')))
+                if loop else 'not measured (loop runs only per message)'),
+            ('updates', '%s, p50 %s, p99 %s' % (updates.get('count', 0), ms(updates.get('p50')), ms(updates.get('p99')))),
+            ('profiler', 'running' if profiler.current and profiler.current.running else 'off'),
+        ]),
+        ('pools', [
+            ('bot api %s' % pool.name, '%d/%d in flight, peak %d, calls %d' % (pool.in_flight, pool.size, pool.peak, pool.calls))
+            for pool in bot.pools
+        ] + [
+            ('database', engine.sync_engine.pool.status()),
+            ('replica', 'lag %s s, %s' % (replica.lag, 'used' if replica.healthy else 'not used')
+                if replica.engine is not None else 'not configured'),
+        ]),
+        ('caches', [
+            ('render skipped (if_changed)', rate(render_metrics['skipped'], sum(render_metrics.values()))),
+            ('edit skipped (fingerprint)', rate(fingerprints.metrics['skipped'], sum(fingerprints.metrics.values()))),
+            ('duplicate updates', rate(dedup.metrics['window'] + dedup.metrics['store'], sum(dedup.metrics.values()))),
+            ('user states', '%d, evicted %d' % (len(state.users), state.metrics['evicted'])),
+        ]),
+        ('queues', [
+            ('events', bus.queue.qsize() if bus.queue is not None else '-'),
+            ('log records', logs.listener.queue.qsize() if logs.listener is not None else '-'),
+            ('span batches', tracing.processor.queue.qsize() if tracing.processor is not None else '-'),
+        ]),
+    ]
+    if application is not None and application.update_queue is not None:
+        sections[-1][1].insert(0, ('updates', application.update_queue.qsize()))
+    session = application.bot_data.get('session') if application is not None else None
+    if session is not None:
+        sections[2][1].append(('identity map', '%d objects, expunged %d' % (
+            len(session.identity_map), state.metrics['expunged'])))
+    return sections
@@ -0,0 +1,288 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, asdict, fields
+from datetime import date, time
+
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import Session
+
+import lib.clock as clock
+from lib.models import async_session
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Event:
+    pass
+
+
+@dataclass(frozen=True)
+class AppointmentEvent(Event):
+    user_id: int
+    data_id: int
+    book_date: date
+    book_time: time
+    washer_id: int = None
+
+
+@dataclass(frozen=True)
+class AppointmentBooked(AppointmentEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class AppointmentCancelled(AppointmentEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class AppointmentReserved(AppointmentEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class AppointmentPassed(AppointmentEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class WasherChanged(Event):  # Availability or maintenance windows of the washer
+    washer_id: int
+
+
+@dataclass(frozen=True)
+class ReminderEvent(Event):
+    user_id: int
+    seconds: int
+
+
+@dataclass(frozen=True)
+class ReminderSet(ReminderEvent):
+    pass
+
+
+@dataclass(frozen=True)
+class ReminderUnset(ReminderEvent):
+    pass
+
+
+EVENT_TYPES = {
+    event_type.__name__: event_type
+    for event_type in [
+        AppointmentBooked, AppointmentCancelled, AppointmentReserved, AppointmentPassed,
+        ReminderSet, ReminderUnset, WasherChanged
+    ]
+}
+
+
+def dumps(event: Event) -> bytes:
+    return json.dumps({
+        'type': event.__class__.__name__,
+        'fields': {
+            key: value.isoformat() if isinstance(value, (date, time)) else value
+            for key, value in asdict(event).items()
+        }
+    }).encode()
+
+
+def loads(body: bytes) -> Event:
+    data = json.loads(body)
+    event_type = EVENT_TYPES[data['type']]
+    kwargs = data['fields']
+    for field in fields(event_type):
+        if field.type in (date, time) and kwargs.get(field.name) is not None:
+            kwargs[field.name] = field.type.fromisoformat(kwargs[field.name])
+    return event_type(**kwargs)
+
+
+class EventContext:
+    """Context of a subscriber, compatible with what forms take from ContextTypes.DEFAULT_TYPE"""
+
+    def __init__(self, bot, session):
+        self.bot = bot
+        self.bot_data = {'session': session}
+
+
+class MemoryTransport:
+    """In-memory stand-in for RabbitTransport: delivers to all other attached buses"""
+
+    def __init__(self):
+        self.buses = []
+
+    def attach(self, bus):
+        self.buses.append(bus)
+
+    def publish(self, event: Event, origin: str):
+        body = dumps(event)  # Same serialization path as RabbitMQ
+        for bus in self.buses:
+            if bus.origin != origin:
+                bus.loop.call_soon_threadsafe(bus.receive, loads(body))
+
+    def close(self):
+        pass
+
+
+class RabbitTransport:
+    """Cross-process delivery through the 'laundry.events' fanout exchange"""
+
+    exchange = 'laundry.events'
+
+    def __init__(self, host='localhost'):
+        self.host = host
+        self.connection = None
+        self.channel = None
+
+    def attach(self, bus):
+        import pika  # Lazy: only processes behind RabbitMQ need it
+
+        self.bus = bus
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange=self.exchange, exchange_type='fanout')
+
+        thread = threading.Thread(target=self.consume, name='events-consumer', daemon=True)
+        thread.start()
+
+    def consume(self):
+        import pika
+
+        connection = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+        channel = connection.channel()
+        queue = channel.queue_declare(queue='', exclusive=True).method.queue
+        channel.queue_bind(exchange=self.exchange, queue=queue)
+
+        def receive(ch, method, properties, body):
+            if properties.app_id != self.bus.origin:  # Own events are already dispatched locally
+                self.bus.loop.call_soon_threadsafe(self.bus.receive, loads(body))
+
+        channel.basic_consume(queue=queue, auto_ack=True, on_message_callback=receive)
+        channel.start_consuming()
+
+    def publish(self, event: Event, origin: str):
+        import pika
+
+        self.channel.basic_publish(
+            exchange=self.exchange,
+            routing_key='',
+            body=dumps(event),
+            properties=pika.BasicProperties(app_id=origin))
+
+    def close(self):
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+
+
+class EventBus:
+    """Publishes committed events to async subscribers.
+
+    Events are dispatched in-process through an asyncio queue and, with a transport,
+    to the other processes. Subscribers are local-only by default (e.g. message edits
+    must happen once); remote=True subscribers also get events of other processes
+    (e.g. process caches and metrics).
+    """
+
+    def __init__(self):
+        self.origin = '%s:%s' % (os.getpid(), uuid.uuid4().hex[:8])
+        self.subscribers = defaultdict(list)  # event type -> [(handler, remote)]
+        self.transport = None
+        self.queue = None
+        self.loop = None
+        self.bot = None
+        self.task = None
+
+    def subscribe(self, *event_types, remote=False):
+        def decorator(handler):
+            for event_type in event_types:
+                self.subscribers[event_type].append((handler, remote))
+            return handler
+        return decorator
+
+    def handlers(self, event: Event, remote: bool):
+        return [
+            handler
+            for event_type, subscribers in self.subscribers.items()
+            if isinstance(event, event_type)
+            for handler, handler_remote in subscribers
+            if handler_remote or not remote
+        ]
+
+    def start(self, bot, transport=None):
+        self.bot = bot
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        if transport:
+            self.transport = transport
+            self.transport.attach(self)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        await self.drain()
+        if self.task:
+            self.task.cancel()
+        if self.transport:
+            self.transport.close()
+
+    def publish(self, event: Event):
+        if self.queue is None:  # Bus is not started in this process (e.g. scripts)
+            return
+        self.queue.put_nowait((event, False))
+        if self.transport:
+            try:
+                self.transport.publish(event, self.origin)
+            except Exception as e:
+                logger.warning('Event %s is not published to other processes: %s', event, e)
+
+    def receive(self, event: Event):  # From other processes
+        self.queue.put_nowait((event, True))
+
+    async def dispatch(self, event: Event, remote: bool = False):
+        handlers = self.handlers(event, remote)
+        if not handlers:
+            return
+
+        async def call(handler):
+            try:
+                async with async_session() as session:
+                    await handler(event, EventContext(self.bot, session))
+            except Exception:
+                logger.exception('Subscriber %s failed on %s', handler.__name__, event)
+
+        with clock.freeze():  # Subscribers of the event render at one "now"
+            await asyncio.gather(*[call(handler) for handler in handlers])
+
+    async def run(self):
+        while True:
+            event, remote = await self.queue.get()
+            try:
+                await self.dispatch(event, remote)
+            finally:
+                self.queue.task_done()
+
+    async def drain(self):
+        if self.queue is not None:
+            await self.queue.join()
+
+
+bus = EventBus()
+
+
+def emit(session, event: Event):
+    """Queue an event on the session, it is published after the next successful commit"""
+    session.info.setdefault('events', []).append(event)
+
+
+@sa_event.listens_for(Session, 'after_commit')
+def publish_committed(session):
+    for event in session.info.pop('events', []):
+        bus.publish(event)
+
+
+@sa_event.listens_for(Session, 'after_rollback')
+def drop_rolled_back(session):
+    session.info.pop('events', None)
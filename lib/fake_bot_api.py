@@ -0,0 +1,298 @@
+"""Local fake Telegram Bot API server for offline performance tests.
+
+Implements the methods used by the bot with configurable latency, flood limits
+(429 with retry_after) and recording of every call. Point the bot at it with
+BOT_API_URL=http://127.0.0.1:8081/bot
+
+    python -m lib.fake_bot_api --port 8081 --latency 0.05 --chat-rate 1 --record calls.jsonl
+"""
+import time
+import json
+import random
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict, deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, urlsplit
+
+JSON_PARAMS = {'reply_markup', 'commands', 'scope', 'entities', 'allowed_updates'}
+INT_PARAMS = {'chat_id', 'message_id', 'reply_to_message_id', 'offset', 'limit', 'timeout'}
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, parameters: dict = None):
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+class FakeBotApi:
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 chat_rate: int = None, global_rate: int = None, retry_after: int = 1,
+                 record: str = None):
+        self.latency = latency  # In seconds, per call
+        self.jitter = jitter
+        self.chat_rate = chat_rate  # Messages per second to one chat (Telegram: ~1)
+        self.global_rate = global_rate  # Messages per second of the bot (Telegram: ~30)
+        self.retry_after = retry_after
+        self.record = open(record, 'a') if record else None
+
+        self.calls = []  # Every call: {'at', 'method', 'params', 'status', 'duration'}
+        self.messages = {}  # (chat_id, message_id) -> (text, reply_markup)
+        self.updates = []  # Pending updates of getUpdates
+        self.message_ids = itertools.count(1)
+        self.chat_sent = defaultdict(deque)  # chat_id -> times of sent messages
+        self.global_sent = deque()
+        self.server = None
+        self.port = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        if self.record:
+            self.record.close()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%s/bot' % self.port
+
+    def count(self, method: str = None, status: int = None):
+        return sum(
+            1 for call in self.calls
+            if (method is None or call['method'] == method) and
+               (status is None or call['status'] == status))
+
+    def put_update(self, update: dict):  # For getUpdates (long polling)
+        update.setdefault('update_id', len(self.updates) + 1)
+        self.updates.append(update)
+
+    # HTTP/1.1 with keep-alive, enough for httpx
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self.call(target, headers.get('content-type', ''), body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    b'HTTP/1.1 %d %s\r\n' % (status, b'OK' if status == 200 else b'Error') +
+                    b'Content-Type: application/json\r\n' +
+                    b'Content-Length: %d\r\n\r\n' % len(data) + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def call(self, target: str, content_type: str, body: bytes):
+        started = time.monotonic()
+        method = urlsplit(target).path.rsplit('/', 1)[-1]
+        params = self.parse_params(content_type, body)
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        try:
+            handler = getattr(self, 'api_' + method.lower(), None)
+            if not handler:
+                raise ApiError(404, 'Not Found: method not found')
+            status, payload = 200, {'ok': True, 'result': await handler(params)}
+        except ApiError as e:
+            status, payload = e.code, {'ok': False, 'error_code': e.code, 'description': e.description}
+            if e.parameters:
+                payload['parameters'] = e.parameters
+
+        call = {
+            'at': time.time(),
+            'method': method,
+            'params': params,
+            'status': status,
+            'duration': time.monotonic() - started
+        }
+        self.calls.append(call)
+        if self.record:
+            self.record.write(json.dumps(call, ensure_ascii=False, default=str) + '\n')
+        return status, payload
+
+    @staticmethod
+    def parse_value(key: str, value: str):
+        if key in JSON_PARAMS:
+            return json.loads(value)
+        elif key in INT_PARAMS and value.lstrip('-').isdigit():
+            return int(value)
+        elif value in ('true', 'false'):
+            return value == 'true'
+        return value
+
+    @classmethod
+    def parse_params(cls, content_type: str, body: bytes) -> dict:
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):  # Files: only the name and the size are kept
+            form = BytesParser(policy=HTTP).parsebytes(b'Content-Type: %s\r\n\r\n' % content_type.encode() + body)
+            params = {}
+            for part in form.iter_parts():
+                key, content = part.get_param('name', header='content-disposition'), part.get_payload(decode=True)
+                if part.get_filename() is not None:
+                    params[key] = {'filename': part.get_filename(), 'size': len(content)}
+                else:
+                    params[key] = cls.parse_value(key, content.decode())
+            return params
+
+        return {key: cls.parse_value(key, value) for key, value in parse_qsl(body.decode())}
+
+    def check_flood(self, chat_id: int):
+        now = time.monotonic()
+        limits = [(self.global_sent, self.global_rate)]
+        if chat_id is not None:
+            limits.append((self.chat_sent[chat_id], self.chat_rate))
+
+        for sent, rate in limits:
+            while sent and now - sent[0] > 1:
+                sent.popleft()
+            if rate is not None and len(sent) >= rate:
+                raise ApiError(
+                    429, 'Too Many Requests: retry after %s' % self.retry_after,
+                    {'retry_after': self.retry_after})
+
+        for sent, _ in limits:
+            sent.append(now)
+
+    @staticmethod
+    def message(chat_id: int, message_id: int, text: str, reply_markup=None):
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text
+        }
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        return message
+
+    # Bot API methods
+
+    async def api_getme(self, params):
+        return {
+            'id': 1,
+            'is_bot': True,
+            'first_name': 'Laundry',
+            'username': 'fake_laundry_bot',
+            'can_join_groups': False,
+            'can_read_all_group_messages': False,
+            'supports_inline_queries': False
+        }
+
+    async def api_sendmessage(self, params):
+        chat_id = params['chat_id']
+        self.check_flood(chat_id)
+        message_id = next(self.message_ids)
+        self.messages[(chat_id, message_id)] = (params['text'], params.get('reply_markup'))
+        return self.message(chat_id, message_id, params['text'], params.get('reply_markup'))
+
+    async def api_senddocument(self, params):
+        chat_id = params['chat_id']
+        self.check_flood(chat_id)
+        message_id = next(self.message_ids)
+        document = params['document']
+        if not isinstance(document, dict):  # file_id or URL, not uploaded
+            document = {'filename': None, 'size': None}
+        self.messages[(chat_id, message_id)] = (params.get('caption'), params.get('reply_markup'))
+        message = self.message(chat_id, message_id, None, params.get('reply_markup'))
+        del message['text']
+        message['document'] = {
+            'file_id': 'document%d' % message_id,
+            'file_unique_id': 'document%d' % message_id,
+            'file_name': document['filename'],
+            'file_size': document['size']
+        }
+        if params.get('caption'):
+            message['caption'] = params['caption']
+        return message
+
+    async def api_editmessagetext(self, params):
+        chat_id, message_id = params['chat_id'], params['message_id']
+        content = (params['text'], params.get('reply_markup'))
+        if self.messages.get((chat_id, message_id)) == content:
+            raise ApiError(
+                400, 'Bad Request: message is not modified: specified new message content and reply '
+                     'markup are exactly the same as a current content and reply markup of the message')
+        self.check_flood(chat_id)
+        self.messages[(chat_id, message_id)] = content  # Messages unknown to the server are accepted
+        return self.message(chat_id, message_id, *content)
+
+    async def api_deletemessage(self, params):
+        self.messages.pop((params['chat_id'], params['message_id']), None)
+        return True
+
+    async def api_answercallbackquery(self, params):
+        return True
+
+    async def api_setmycommands(self, params):
+        return True
+
+    async def api_setwebhook(self, params):
+        return True
+
+    async def api_deletewebhook(self, params):
+        return True
+
+    async def api_getupdates(self, params):
+        offset = params.get('offset', 0)
+        deadline = time.monotonic() + params.get('timeout', 0)
+        while True:
+            updates = [update for update in self.updates if update['update_id'] >= offset]
+            if updates or time.monotonic() >= deadline:
+                return updates[:params.get('limit', 100)]
+            await asyncio.sleep(0.05)
+
+
+async def main(args):
+    api = await FakeBotApi(
+        latency=args.latency,
+        jitter=args.jitter,
+        chat_rate=args.chat_rate,
+        global_rate=args.global_rate,
+        retry_after=args.retry_after,
+        record=args.record).start(args.host, args.port)
+    print('Fake Bot API on http://%s:%s/bot (BOT_API_URL)' % (args.host, api.port))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8081, type=int)
+    parser.add_argument('--latency', default=0.0, type=float, help='seconds per call')
+    parser.add_argument('--jitter', default=0.0, type=float, help='random extra latency, seconds')
+    parser.add_argument('--chat-rate', default=None, type=int, help='messages per second to a chat')
+    parser.add_argument('--global-rate', default=None, type=int, help='messages per second of the bot')
+    parser.add_argument('--retry-after', default=1, type=int, help='retry_after of 429 responses')
+    parser.add_argument('--record', default=None, help='JSONL file of calls')
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,75 @@
+"""Local stand-in of the updates queue and the consumer processes of rmq_main.py.
+
+Simulated time, no RabbitMQ: supervisor tests with synthetic load (bench-autoscale.py).
+A consumer takes one message at a time (prefetch 1, manual ack), a crash or a kill
+returns its message to the queue.
+"""
+import random
+from collections import deque
+
+
+class LocalBroker:
+
+    def __init__(self):
+        self.messages = deque()  # Published at
+        self.samples = []  # Latencies of processed messages, not read by the supervisor yet
+        self.processed = 0
+
+    def publish(self, now: float):
+        self.messages.append(now)
+
+    def depth(self) -> int:
+        return len(self.messages)
+
+    def latencies(self) -> list[float]:
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class SimulatedConsumer:
+    """Popen-like consumer process: poll(), terminate(), kill(), advanced by step(now)"""
+
+    def __init__(self, broker: LocalBroker, started_at: float, service_time: float,
+                 startup_time: float = 0.0, crash_rate: float = 0.0, rng: random.Random = None):
+        self.broker = broker
+        self.ready_at = started_at + startup_time  # Imports of rmq_consumer.py
+        self.service_time = service_time  # Seconds per message
+        self.crash_rate = crash_rate  # Probability per message
+        self.rng = rng or random.Random()
+
+        self.returncode = None
+        self.stopping = False
+        self.current = None  # Published at of the message in processing
+        self.busy_until = None
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):  # SIGTERM: the current message is finished
+        self.stopping = True
+
+    def kill(self):
+        self.requeue()
+        self.returncode = -9
+
+    def requeue(self):  # Not acknowledged, redelivered
+        if self.current is not None:
+            self.broker.messages.appendleft(self.current)
+            self.current = None
+
+    def step(self, now: float):
+        if self.returncode is not None or now < self.ready_at:
+            return
+        if self.current is not None and now >= self.busy_until:
+            self.broker.samples.append(now - self.current)
+            self.broker.processed += 1
+            self.current = None
+        if self.current is None:
+            if self.stopping:
+                self.returncode = 0
+            elif self.broker.messages:
+                self.current = self.broker.messages.popleft()
+                self.busy_until = now + self.service_time
+                if self.rng.random() < self.crash_rate:
+                    self.requeue()
+                    self.returncode = 1
@@ -0,0 +1,125 @@
+"""Local stand-in of an OpenTelemetry collector for offline trace analysis.
+
+Accepts OTLP/HTTP JSON (POST /v1/traces) of every process (TRACE_OTLP_URL) and appends
+the spans to one JSONL file in the format of TRACE_FILE, for trace-report.py.
+
+    python -m lib.fake_collector --port 4318 --out spans.jsonl
+    TRACE_OTLP_URL=http://127.0.0.1:4318/v1/traces python rmq_consumer.py
+"""
+import json
+import asyncio
+import argparse
+
+
+def otlp_value(value: dict):
+    if 'intValue' in value:
+        return int(value['intValue'])
+    if 'doubleValue' in value:
+        return float(value['doubleValue'])
+    if 'boolValue' in value:
+        return bool(value['boolValue'])
+    return value.get('stringValue')
+
+
+def flatten(body: dict) -> list[dict]:
+    spans = []
+    for resource_spans in body.get('resourceSpans', []):
+        resource = {
+            attribute['key']: otlp_value(attribute['value'])
+            for attribute in resource_spans.get('resource', {}).get('attributes', [])
+        }
+        for scope_spans in resource_spans.get('scopeSpans', []):
+            for span in scope_spans.get('spans', []):
+                spans.append({
+                    'traceId': span['traceId'],
+                    'spanId': span['spanId'],
+                    'parentSpanId': span.get('parentSpanId') or None,
+                    'name': span['name'],
+                    'service': resource.get('service.name'),
+                    'start': int(span['startTimeUnixNano']),
+                    'end': int(span['endTimeUnixNano']),
+                    'attributes': {
+                        attribute['key']: otlp_value(attribute['value'])
+                        for attribute in span.get('attributes', [])
+                    }
+                })
+    return spans
+
+
+class FakeCollector:
+
+    def __init__(self, out: str):
+        self.out = open(out, 'a')
+        self.spans = 0
+        self.server = None
+        self.port = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.out.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if method == 'POST' and target.split('?')[0] == '/v1/traces':
+                    status = self.receive(body)
+                else:
+                    status = 404
+                writer.write(
+                    b'HTTP/1.1 %d %s\r\n' % (status, b'OK' if status == 200 else b'Error') +
+                    b'Content-Type: application/json\r\n' +
+                    b'Content-Length: 2\r\n\r\n{}')
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def receive(self, body: bytes) -> int:
+        try:
+            spans = flatten(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            return 400
+        self.out.write(''.join(json.dumps(span) + '\n' for span in spans))
+        self.out.flush()
+        self.spans += len(spans)
+        return 200
+
+
+async def main(args):
+    collector = await FakeCollector(args.out).start(args.host, args.port)
+    print('Fake collector on http://%s:%s/v1/traces (TRACE_OTLP_URL), spans to %s' % (
+        args.host, collector.port, args.out))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await collector.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake OTLP/HTTP collector')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=4318, type=int)
+    parser.add_argument('--out', default='spans.jsonl', help='JSONL file of spans')
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,52 @@
+import hashlib
+from collections import Counter
+
+from sqlalchemy import update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from lib.models import Message
+
+metrics = Counter()  # 'edited' - edits sent to Telegram, 'skipped' - API calls saved
+
+
+def fingerprint(text: str, parse_mode: str = None, reply_markup=None) -> int:
+    """Signed 64-bit hash of a rendered message (fits messages.fingerprint)"""
+    markup = reply_markup.to_json() if reply_markup else ''
+    digest = hashlib.blake2b(
+        '\0'.join([text, parse_mode or '', markup]).encode(),
+        digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+async def claim(session: AsyncSession, message: Message, value: int) -> bool:
+    """Store the fingerprint of the message which is going to be shown.
+
+    Returns False if it is already shown (the edit is skipped). The compare and store
+    is one conditional UPDATE in its own transaction, so all processes share the store.
+    """
+    async with session.bind.begin() as conn:
+        result = await conn.execute(
+            update(Message) \
+                .where(
+                    Message.id == message.id,
+                    Message.user_id == message.user_id,
+                    or_(
+                        Message.fingerprint.is_(None),
+                        Message.fingerprint != value)) \
+                .values(
+                    fingerprint=value))
+
+    claimed = bool(result.rowcount)
+    metrics['edited' if claimed else 'skipped'] += 1
+    return claimed
+
+
+async def forget(session: AsyncSession, message: Message):  # Edit is failed, the next one is not skipped
+    async with session.bind.begin() as conn:
+        await conn.execute(
+            update(Message) \
+                .where(
+                    Message.id == message.id,
+                    Message.user_id == message.user_id) \
+                .values(
+                    fingerprint=None))
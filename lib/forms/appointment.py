@@ -1,18 +1,37 @@
 
+import logging
 from datetime import datetime, date, time, timedelta
 
 import locales
 import lib.misc as misc
+import lib.clock as clock
+import lib.callbacks as callbacks
+import lib.waitlist as waitlist
+import lib.washers as washers
 import lib.constants as const
 from lib.misc import append_locale_arg
+from lib.events import emit, AppointmentBooked, AppointmentCancelled
 from lib.forms.base import BaseAction, BaseForm
-from lib.models import User, AppointmentData, Appointment, Washer, Message
+from lib.models import User, AppointmentData, Appointment, Message
 
-from sqlalchemy import func
+from sqlalchemy import func, inspect
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
+logger = logging.getLogger(__name__)
+
+
+async def cancel_appointment(session: AsyncSession, user: User, data: AppointmentData, appointment: Appointment):
+    """Remove the user's appointment and give the slot to its waitlist, in one commit"""
+    await session.delete(appointment)
+    if 'appointments' not in inspect(data).unloaded and appointment in data.appointments:
+        data.appointments.remove(appointment)  # Keeps the loaded collection actual without refresh
+    emit(session, AppointmentCancelled(
+        user.id, data.id, appointment.book_date, appointment.book_time, appointment.washer_id))
+    await waitlist.promote(session, appointment)  # Same transaction as the cancellation
+    await session.commit()
+
 
 class DateAppointmentAction(BaseAction):
     def __init__(self):
@@ -20,15 +39,16 @@ class DateAppointmentAction(BaseAction):
 
     @staticmethod
     async def is_available_slot(session: AsyncSession, user: User, data: AppointmentData, value: str):
-        tmp = data.book_date
-        data.book_date = date.fromisoformat(value)
+        with session.no_autoflush:  # Temporary change must not be written (and bump data version)
+            tmp = data.book_date
+            data.book_date = date.fromisoformat(value)
 
-        slots = [
-            await TimeAppointmentAction.is_available_slot(session, user, data, t.isoformat())
-            for t in const.available_time
-        ]
+            slots = [
+                await TimeAppointmentAction.is_available_slot(session, user, data, t.isoformat())
+                for t in const.available_time
+            ]
 
-        data.book_date = tmp  # Required after temporarily changes
+            data.book_date = tmp  # Required after temporarily changes
         return misc.aggregate_appointment_slots(slots)
 
     async def reply_markup(self, session: AsyncSession, user: User, data: AppointmentData, state: int):
@@ -41,7 +61,7 @@ class DateAppointmentAction(BaseAction):
             keyboard_button = InlineKeyboardButton(
                     (sign_char + ' ' if sign_char else '') +
                     misc.date_button_to_str(d),
-                    callback_data=' '.join([str(state), d.isoformat()]))
+                    callback_data=callbacks.encode(user, data, state, d.isoformat()))
             keyboard.append([keyboard_button])
         return InlineKeyboardMarkup(keyboard)
 
@@ -70,22 +90,23 @@ class TimeAppointmentAction(BaseAction):
 
     @staticmethod
     async def is_available_slot(session: AsyncSession, user: User, data: AppointmentData, value: str):
-        washers = (await session.scalars(select(Washer))).all()
+        await washers.cache.ensure()
 
-        tmp = data.book_time
-        data.book_time = time.fromisoformat(value)
-        slots = [
-            (await WashersAppointmentAction.is_available_slot(session, user, data, washer.id))[:2]
-            for washer in washers
-        ]
+        with session.no_autoflush:  # Temporary change must not be written (and bump data version)
+            tmp = data.book_time
+            data.book_time = time.fromisoformat(value)
+            slots = [
+                (await WashersAppointmentAction.is_available_slot(session, user, data, washer.id))[:2]
+                for washer in washers.cache.all()
+            ]
 
-        data.book_time = tmp  # Required after temporarily changes
+            data.book_time = tmp  # Required after temporarily changes
 
         return misc.aggregate_appointment_slots(slots)
 
     async def reply_markup(self, session: AsyncSession, user: User, data: AppointmentData, state: int):
         keyboard = []
-        now_dt = datetime.now()
+        now_dt = clock.now()
         for t in const.available_time:
             book_dt = datetime.combine(data.book_date, t)
             if now_dt < book_dt:
@@ -96,7 +117,7 @@ class TimeAppointmentAction(BaseAction):
                     '%s:%s' % (
                         str(t.hour).zfill(2),
                         str(t.minute).zfill(2)),
-                    callback_data=' '.join([str(state), t.isoformat()]))
+                    callback_data=callbacks.encode(user, data, state, t.isoformat()))
                 keyboard.append([keyboard_button])
         return InlineKeyboardMarkup(keyboard)
 
@@ -123,15 +144,19 @@ class WashersAppointmentAction(BaseAction):
         super().__init__('Стиральные машины', 'Выберите стиральные машины')
 
     async def reply_markup(self, session: AsyncSession, user: User, data: AppointmentData, state: int):
-        washers = (await session.scalars(select(Washer))).all()
+        await washers.cache.ensure()
+        waitlist_washer_ids = await waitlist.user_washer_ids(session, user, data.book_date, data.book_time)
 
         keyboard = []
-        for washer in washers:
+        for washer in washers.cache.all():
             is_available, reason = (await self.is_available_slot(session, user, data, washer.id))[:2]
-            sign_char = const.WASHER_SIGN_CHARS[reason][is_available]
+            if not is_available and reason == const.WASHER_IS_ALREADY_BOOKED and washer.id in waitlist_washer_ids:
+                sign_char = const.WAITLIST_SIGN_CHAR
+            else:
+                sign_char = const.WASHER_SIGN_CHARS[reason][is_available]
             keyboard_button = InlineKeyboardButton(
                 (sign_char + ' ' if sign_char else '') + washer.name,
-                callback_data=' '.join([str(state), str(washer.id)])
+                callback_data=callbacks.encode(user, data, state, str(washer.id))
             )
             keyboard.append(keyboard_button)
         return InlineKeyboardMarkup([keyboard])
@@ -144,8 +169,8 @@ class WashersAppointmentAction(BaseAction):
 
     @staticmethod
     async def is_available_slot(session: AsyncSession, user: User, data: AppointmentData, value):
-        now_dt = datetime.now()
-        book_dt = datetime.combine(data.book_date, data.book_time)
+        now_dt = clock.now()
+        book_dt = data.book_at
 
         if now_dt > book_dt - timedelta(hours=const.book_time_left):
             return False, const.APPOINTMENT_IS_RESERVED, None
@@ -153,13 +178,12 @@ class WashersAppointmentAction(BaseAction):
             return False, const.APPOINTMENT_IS_PASSED, None
 
         stmt = select(Appointment).where(
-            Appointment.book_date == data.book_date,
-            Appointment.book_time == data.book_time,
+            Appointment.book_at == data.book_at,
             Appointment.washer_id == int(value))
         appointment = (await session.scalars(stmt)).unique().one_or_none()
         if not appointment:
-            washer = await session.get(Washer, int(value))
-            if not washer.available:
+            await washers.cache.ensure()
+            if not washers.cache.in_service(int(value), book_dt):  # Off or in a maintenance window
                 return False, const.WASHER_IS_NOT_AVAILABLE, None
             else:
                 return True, const.WASHER_IS_AVAILABLE, None
@@ -180,7 +204,7 @@ class WashersAppointmentAction(BaseAction):
                 stmt = select(func.count()) \
                     .where(
                         Appointment.user_id == user.id,
-                        Appointment.passed == False)
+                        ~Appointment.passed)
                 planned_appointments_count = (await session.scalars(stmt)).one()
                 if planned_appointments_count >= const.max_book_washers:
                     return False, locale['max_book_washers'] % const.max_book_washers
@@ -190,14 +214,16 @@ class WashersAppointmentAction(BaseAction):
                         data=data,
                         book_date=data.book_date,
                         book_time=data.book_time,
-                        washer_id=int(value)))
+                        washer=await washers.attach(session, int(value))))
+                emit(session, AppointmentBooked(user.id, data.id, data.book_date, data.book_time, int(value)))
                 await session.commit()
                 return True, ''
             elif reason == const.WASHER_IS_ALREADY_BOOKED:
-                await session.delete(appointment)
-                await session.commit()
-                await session.refresh(data)  # Update relationships
+                await cancel_appointment(session, user, data, appointment)
                 return True, ''
+        elif reason == const.WASHER_IS_ALREADY_BOOKED:  # Booked by other user: join or leave its waitlist
+            await waitlist.toggle(session, user, data.book_date, data.book_time, int(value))
+            return True, ''
         else:  # Not available
             locale_key = const.WASHER_REASON_LOCALE_MAP[reason]
             return False, locale[locale_key]
@@ -220,16 +246,17 @@ class AppointmentForm(BaseForm):
 
         self.reserved = False
         self.passed = False
+        self.notice_title = None  # Form is sent without user request (waitlist, recurring booking)
 
         if self.data.state == len(self.actions) - 1:
-            now_dt = datetime.now()
-            book_dt = datetime.combine(self.data.book_date, self.data.book_time)
+            now_dt = clock.now()
+            book_dt = self.data.book_at
             if now_dt > book_dt - timedelta(hours=const.book_time_left):
                 self.reserved = True
-                print('reserved', self.data)
+                logger.debug('Reserved %s', self.data)  # Of every form built by a fan-out
             elif now_dt > book_dt:
                 self.passed = True
-                print('passed', self.data)
+                logger.debug('Passed %s', self.data)
 
     async def find_exists_datas(self, session: AsyncSession, data: AppointmentData):
         stmt = select(AppointmentData) \
@@ -244,6 +271,9 @@ class AppointmentForm(BaseForm):
 
         return (await session.scalars(stmt)).unique().all()
 
+    def allocation_key(self) -> tuple:
+        return self.data.state, self.data.book_date, self.data.book_time
+
     @property
     @append_locale_arg('appointment_form')
     def title_text(self, locale) -> str:
@@ -251,6 +281,8 @@ class AppointmentForm(BaseForm):
             return '📅 ' + locale['passed_title']
         elif self.reserved:
             return '⌛ ' + locale['reserved_title']
+        elif self.notice_title:
+            return self.notice_title
         else:
             return super(AppointmentForm, self).title_text
 
@@ -268,6 +300,37 @@ class AppointmentForm(BaseForm):
             self.reserved = True
         await super(AppointmentForm, self).close(reason, bot, **kwargs)
 
+    @append_locale_arg('appointment_form')
+    async def notify_promoted(self, bot, locale: dict) -> None:
+        self.notice_title = '🔔 ' + locale['promoted_title']
+        if self.message:  # Form is already in the chat and is updated with others
+            await bot.send_message(
+                chat_id=self.user.chat_id,
+                reply_to_message_id=self.message.id,
+                text='🔔 ' + locale['promoted_title'])
+        else:
+            await self.send(bot)
+
+    @append_locale_arg('washers')
+    async def notify_maintenance(self, context, moves: list[tuple[Appointment, Appointment]], locale: dict) -> None:
+        """Appointments of the form moved to other washers (or cancelled) by lib.washers.relocate"""
+        self.notice_title = '🔧 ' + locale['maintenance_title']
+        text = '🔧 ' + '\n'.join([
+            locale['moved'] % (appointment.washer.name, moved.washer.name)
+            if moved else
+            locale['cancelled'] % appointment.washer.name
+            for appointment, moved in moves
+        ])
+        if self.message:
+            await self.update_message(None, context, allocate=False)
+        else:
+            await self.send(context.bot)
+        await context.bot.send_message(
+            chat_id=self.user.chat_id,
+            reply_to_message_id=self.message.id,
+            parse_mode='Markdown',
+            text=text)
+
     @property
     def finished(self):
         return bool(self.data.washers)
@@ -1,15 +1,40 @@
 
+from __future__ import annotations
+
 import asyncio
+import logging
 from abc import abstractmethod
-from typing import Union
+from collections import Counter
+from typing import Union, TYPE_CHECKING
 
+import lib.clock as clock
 import lib.constants as const
-from lib.models import User, BaseData, Message
+import lib.tracing as tracing
+import lib.fingerprints as fingerprints
+from lib.models import User, BaseData, Message, rollback, read_only
+from sqlalchemy import select, inspect
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import StaleDataError
 
 from telegram import Update
-from telegram.error import TelegramError
-from telegram.ext import ContextTypes
+from telegram.error import TelegramError, BadRequest
+
+if TYPE_CHECKING:  # telegram.ext is heavy and not needed by cron-update.py
+    from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+rendered_versions = {}  # (data class, data id) -> (data version, minute) of the last render in this process
+rendered_versions_size = 10000
+render_metrics = Counter()  # 'rendered', 'skipped' - if_changed renders of an already shown version
+
+
+def remember_render(data: BaseData):
+    key = (data.__class__, data.id)
+    rendered_versions.pop(key, None)
+    rendered_versions[key] = (data.version, clock.minute())
+    if len(rendered_versions) > rendered_versions_size:
+        del rendered_versions[next(iter(rendered_versions))]  # Oldest
 
 
 class BaseMessage:
@@ -55,6 +80,7 @@ class BaseForm:
 
         self.closed = False
         self.error_text = None
+        self.allocation_checked = None  # allocation_key() of the last find_exists_datas
 
     @property
     def message(self):
@@ -68,24 +94,43 @@ class BaseForm:
     async def find_exists_datas(self, session: AsyncSession, data: BaseData):
         pass
 
+    def allocation_key(self) -> tuple:  # Fields of data which find_exists_datas depends on
+        return self.data.state,
+
+    async def load(self, session: AsyncSession) -> None:
+        """Reload data (with appointments, washers, message) only if another writer changed it"""
+        data_class = self.data.__class__
+        with read_only(session, False):  # A stale version of the replica would roll the data back
+            stmt = select(data_class.version) \
+                .where(
+                    data_class.id == self.data.id)
+            version = (await session.scalars(stmt)).one_or_none()
+            # Also a new data: its relationships are not loaded yet
+            if version is not None and (version != self.data.version or inspect(self.data).unloaded):
+                stmt = select(data_class) \
+                    .where(
+                        data_class.id == self.data.id) \
+                    .execution_options(
+                        populate_existing=True)
+                self.data = (await session.scalars(stmt)).unique().one()
+
     def allocate_data_if_necessary(func):
         async def wrapper(self, *args, **kwargs) -> None:
             context = args[1]
             session = context.bot_data['session']
+            # Other datas of the same key are already merged (or allocate=False for foreign forms)
+            if not kwargs.pop('allocate', True) or self.allocation_checked == self.allocation_key():
+                return await func(self, *args, **kwargs)
+
+            self.allocation_checked = self.allocation_key()
             datas = await self.find_exists_datas(session, self.data)
             if datas:
                 for data in datas:
-                    data.allocate_to(self.data)  # 1. Provide to self.data
+                    data.allocate_to(self.data)  # 1. Provide to self.data (collections are moved in memory)
                 await session.commit()
-                await session.refresh(self.data)
 
                 result = await func(self, *args, **kwargs)
 
-                await asyncio.gather(*[  # 2. Refresh old datas before close forms
-                    session.refresh(data)
-                    for data in datas
-                ])
-
                 closed_forms = [
                     # Derived class
                     self.__class__(session, self.user, data) \
@@ -95,7 +140,7 @@ class BaseForm:
                 ]
 
                 removed_datas = [
-                    session.delete(data)  # 3. Remove old datas
+                    session.delete(data)  # 2. Remove old datas
                     for data in datas
                     if data != self.data
                 ]
@@ -130,11 +175,25 @@ class BaseForm:
     async def reset_error(self, context: ContextTypes.DEFAULT_TYPE) -> None:
         self.error_text = None
         update, context = context.job.data
-        await update.effective_message.edit_text(
-            parse_mode='Markdown',
-            text=await self.text(),
-            reply_markup=await self.reply_markup()
-        )
+        text, reply_markup = await self.render()
+        await self.edit(context.bot, text, 'Markdown', reply_markup)
+
+    async def edit(self, bot, text: str, parse_mode: str, reply_markup=None):
+        """Edit the form message, skipped without API call if the same render is already shown"""
+        value = fingerprints.fingerprint(text, parse_mode, reply_markup)
+        if not await fingerprints.claim(self.session, self.message, value):
+            return
+        try:
+            return await bot.edit_message_text(
+                chat_id=self.user.chat_id,
+                message_id=self.message.id,
+                text=text,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup)
+        except TelegramError as e:
+            if not (isinstance(e, BadRequest) and 'not modified' in e.message):
+                await fingerprints.forget(self.session, self.message)  # Render is not shown
+            raise
 
     def fill_kwargs(func):
         async def wrapper(self, *args, **kwargs):
@@ -143,29 +202,40 @@ class BaseForm:
             return await func(self, *args, **kwargs)
         return wrapper
 
+    @tracing.traced('form.close')
     @fill_kwargs
     async def close(self, reason: int, bot, **kwargs) -> None:
         if reason == const.MESSAGE_IS_NOT_RELEVANT:
             self.closed = True
         try:
-            await bot.edit_message_text(
-                chat_id=self.user.chat_id,
-                message_id=self.message.id,
-                text=await self.text(),
-                parse_mode=kwargs.get('parse_mode') or 'Markdown')
+            with read_only(self.session):
+                text = await self.text()
+            await self.edit(bot, text, kwargs.get('parse_mode') or 'Markdown')
         except TelegramError as e:  # Message is not modified ...
             pass
 
+    @tracing.traced('form.button_handler')
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE, value: str):
         session = context.bot_data['session']
-        result, error_text = await self.active_action \
-            .button_handler(session, self.user, self.data, value)
-        print('button_handler', self.data.state, value, self.data)
-        if result:
-            if self.data.state < len(self.actions) - 1:
-                self.data.state += 1
-                await session.commit()
-        elif error_text:
+        state = self.data.state  # Of the pressed button
+        for attempt in range(const.stale_data_retries + 1):
+            try:
+                result, error_text = await self.active_action \
+                    .button_handler(session, self.user, self.data, value)
+                logger.debug('Button %s of state %s: %s', value, self.data.state, self.data)
+                if result:
+                    if self.data.state < len(self.actions) - 1:
+                        self.data.state += 1
+                        await session.commit()
+                break
+            except StaleDataError:  # Data is changed by other writer (cron, waitlist), retry on actual data
+                logger.info('Stale %s, attempt %s', self.data, attempt + 1)
+                await rollback(session, self.user, self.data)  # Only the form is reloaded
+                if attempt == const.stale_data_retries:
+                    raise
+                self.data.state = state
+
+        if not result and error_text:
             self.error_text = error_text
             context.job_queue.run_once(
                 self.reset_error,
@@ -173,19 +243,50 @@ class BaseForm:
                 data=(update, context))
         return result
 
+    @tracing.traced('form.reply')
     @fill_kwargs
     @allocate_data_if_necessary
     async def reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE, **kwargs):
         session = context.bot_data['session']
-        await session.refresh(self.data)
+        await self.load(session)
+        parse_mode = kwargs.get('parse_mode') or 'Markdown'
+        text, reply_markup = await self.render()
         msg = await update.effective_message.reply_text(
-            parse_mode=kwargs.get('parse_mode') or 'Markdown',
-            text=await self.text(),
-            reply_markup=await self.reply_markup())
-
-        self.message = Message(id=msg.id, user_id=self.user.id)
+            parse_mode=parse_mode,
+            text=text,
+            reply_markup=reply_markup)
+
+        self.message = Message(
+            id=msg.id,
+            user_id=self.user.id,
+            fingerprint=fingerprints.fingerprint(text, parse_mode, reply_markup))
         session.add(self.message)
         await session.commit()
+        remember_render(self.data)
+
+    @tracing.traced('form.send')
+    @fill_kwargs
+    async def send(self, bot, **kwargs):  # Form without incoming message (e.g. notification)
+        parse_mode = kwargs.get('parse_mode') or 'Markdown'
+        text, reply_markup = await self.render()
+        msg = await bot.send_message(
+            chat_id=self.user.chat_id,
+            parse_mode=parse_mode,
+            text=text,
+            reply_markup=reply_markup)
+
+        self.message = Message(
+            id=msg.id,
+            user_id=self.user.id,
+            fingerprint=fingerprints.fingerprint(text, parse_mode, reply_markup))
+        self.session.add(self.message)
+        await self.session.commit()
+        remember_render(self.data)
+
+    async def render(self) -> tuple:
+        """Text and keyboard, their queries are read-only (replica, lib/models.py)"""
+        with read_only(self.session):
+            return await self.text(), await self.reply_markup()
 
     async def text(self):
         if self.closed:
@@ -207,17 +308,27 @@ class BaseForm:
         else:
             return None
 
+    @tracing.traced('form.update_message')
     @fill_kwargs
     @allocate_data_if_necessary  # Update arg is necessary for allocate_data_if_necessary
     async def update_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, **kwargs) -> None:
         try:
             session = context.bot_data['session']
-            await session.refresh(self.data)
-            return await context.bot.edit_message_text(
-                chat_id=self.user.chat_id,
-                message_id=self.message.id,
-                text=await self.text(),
-                parse_mode=kwargs.get('parse_mode') or 'Markdown',
-                reply_markup=await self.reply_markup())
+            await self.load(session)
+            # if_changed: the render depends on the data and the time (reserved slots, 'today'),
+            # skip it if the version is already shown in this minute
+            if kwargs.pop('if_changed', False) and not self.error_text and \
+                    rendered_versions.get((self.data.__class__, self.data.id)) == (self.data.version, clock.minute()):
+                render_metrics['skipped'] += 1
+                return
+            render_metrics['rendered'] += 1
+            text, reply_markup = await self.render()
+            result = await self.edit(
+                context.bot,
+                text,
+                kwargs.get('parse_mode') or 'Markdown',
+                reply_markup)
+            remember_render(self.data)
+            return result
         except TelegramError as e:
             pass
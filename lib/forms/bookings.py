@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import lib.clock as clock
+import lib.constants as const
+import lib.callbacks as callbacks
+from lib import misc
+from lib.misc import append_locale_arg
+from lib.models import User, BookingsData, Appointment, Message
+from lib.forms.base import BaseAction, BaseForm
+from lib.forms.appointment import AppointmentForm, cancel_appointment
+
+
+def is_reserved(appointment: Appointment, now_dt: datetime) -> bool:
+    return now_dt > appointment.book_at - timedelta(hours=const.book_time_left)
+
+
+async def upcoming_appointments(session: AsyncSession, user: User) -> list[Appointment]:
+    stmt = select(Appointment) \
+        .where(
+            Appointment.user_id == user.id,
+            ~Appointment.passed) \
+        .order_by(
+            Appointment.book_at,
+            Appointment.washer_id)
+    return (await session.scalars(stmt)).unique().all()
+
+
+class CancelBookingAction(BaseAction):
+    def __init__(self):
+        super().__init__('Записи', 'Мои записи')
+
+    @append_locale_arg('bookings_form')
+    async def button_handler(self, session: AsyncSession, user: User, data: BookingsData, value: str, locale: dict) -> tuple[bool, str]:
+        stmt = select(Appointment) \
+            .where(
+                Appointment.id == int(value),
+                Appointment.user_id == user.id) \
+            .options(
+                joinedload(Appointment.data))
+        appointment = (await session.scalars(stmt)).unique().one_or_none()
+        if not appointment or appointment.passed:
+            return False, locale['not_found']
+        if is_reserved(appointment, clock.now()):
+            return False, locale['appointment_is_reserved']
+
+        appointment_data = appointment.data
+        await cancel_appointment(session, user, appointment_data, appointment)
+        session.info.setdefault('bookings_cancelled', []).append(appointment_data)
+        return True, ''
+
+
+class BookingsForm(BaseForm):
+    """All upcoming bookings of the user in one message, with a cancel button per washer.
+
+    Built from one query of appointments, updated in place by events (lib/subscribers.py).
+    """
+
+    actions = [
+        CancelBookingAction()
+    ]
+
+    __data_class__ = BookingsData
+
+    def __init__(self, *args, **kwargs):
+        super(BookingsForm, self).__init__(*args, **kwargs)
+        self.appointments = None  # Of the last load
+
+    async def find_exists_datas(self, session: AsyncSession, data: BookingsData):  # One list per user
+        stmt = select(BookingsData) \
+            .where(
+                BookingsData.message_id == Message.id,
+                Message.user_id == self.user.id,
+                BookingsData.id != data.id)
+
+        return (await session.scalars(stmt)).unique().all()
+
+    async def load(self, session: AsyncSession) -> None:
+        await super(BookingsForm, self).load(session)
+        self.appointments = await upcoming_appointments(session, self.user)
+
+    @append_locale_arg('bookings_form')
+    async def text(self, locale: dict):
+        if self.closed:
+            return '⌛'
+        if self.appointments is None:
+            await self.load(self.session)
+
+        title = '🚫 ' + self.error_text if self.error_text else '📋 ' + locale['title']
+        if not self.appointments:
+            return '%s\n\n%s' % (title, locale['empty'])
+
+        now_dt = clock.now()
+        lines = []
+        for book_at, appointments in groupby(self.appointments, key=lambda a: a.book_at):
+            appointments = list(appointments)
+            lines.append('%s*%s %s* - %s' % (
+                '⌛ ' if is_reserved(appointments[0], now_dt) else '',
+                misc.date_to_str(book_at.date()),
+                misc.time_to_str(book_at.time()),
+                misc.washers_to_str([appointment.washer for appointment in appointments])))
+        return '%s\n\n%s' % (title, '\n'.join(lines))
+
+    async def reply_markup(self):
+        if self.closed:
+            return None
+        if self.appointments is None:
+            await self.load(self.session)
+
+        now_dt = clock.now()
+        keyboard = [
+            [InlineKeyboardButton(
+                '❌ %s %s - %s' % (
+                    misc.date_button_to_str(appointment.book_date),
+                    misc.time_to_str(appointment.book_time),
+                    appointment.washer.name),
+                callback_data=callbacks.encode(self.user, self.data, self.data.state, str(appointment.id)))]
+            for appointment in self.appointments
+            if not is_reserved(appointment, now_dt)  # Reserved: can not be cancelled
+        ]
+        return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+    async def button_handler(self, update, context, value: str):
+        result = await super(BookingsForm, self).button_handler(update, context, value)
+        # Forms of the cancelled slots, other forms of the slot are refreshed by event subscribers
+        for data in self.session.info.pop('bookings_cancelled', []):
+            await AppointmentForm(self.session, self.user, data).update_message(None, context, allocate=False)
+        return result
@@ -1,13 +1,14 @@
 
 from datetime import timedelta
 from sqlalchemy import select
-from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import AsyncSession
 
 import locales
 import lib.constants as const
+import lib.callbacks as callbacks
+import lib.reminders as reminders
 from lib.forms.base import BaseAction, BaseForm
-from lib.models import User, ReminderData, Reminder, Message
+from lib.models import User, ReminderData, Message
 from lib.misc import timedelta_to_str
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
@@ -18,26 +19,20 @@ class ReminderAction(BaseAction):
         super().__init__('Уведомления', 'Выберите за сколько вас предупредить')
 
     async def reply_markup(self, session: AsyncSession, user: User, data: ReminderData, state: int):
+        mask = await reminders.load_mask(session, user.id)  # One query for all the buttons
         keyboard = []
-        for reminder_td in const.reminder_timedelta:
-            total_seconds = int(reminder_td.total_seconds()) # ROUNDING: float -> int
-            _, reason = (await self.is_available_slot(session, user, data, total_seconds))
-            sign_char = '✅' if reason else None
+        for reminder_td, total_seconds in zip(const.reminder_timedelta, reminders.offsets):
+            sign_char = '✅' if reminders.is_set(mask, total_seconds) else None
             keyboard_button = InlineKeyboardButton(
                 (sign_char + ' ' if sign_char else '') + timedelta_to_str(reminder_td),
-                callback_data=' '.join([str(state), str(total_seconds)])
+                callback_data=callbacks.encode(user, data, state, str(total_seconds))
             )
             keyboard.append(keyboard_button)
         return InlineKeyboardMarkup([keyboard])
 
     @staticmethod
     async def is_available_slot(session: AsyncSession, user: User, data: ReminderData, value):
-        stmt = select(Reminder).filter(
-            Reminder.seconds == int(value),
-            Reminder.user == user
-        )
-        reminder = (await session.scalars(stmt)).one_or_none()
-        return True, bool(reminder)
+        return True, reminders.is_set(await reminders.load_mask(session, user.id), int(value))
 
     def item_stringify(self, data: ReminderData):
         if data.reminders:
@@ -50,26 +45,10 @@ class ReminderAction(BaseAction):
             return '...'
 
     async def button_handler(self, session: AsyncSession, user: User, data: ReminderData, value: str) -> tuple[bool, str]:
-        _, reason = await self.is_available_slot(session, user, data, value)
-
-        if reason:
-            stmt = select(Reminder).filter(
-                Reminder.seconds == int(value),
-                Reminder.user == user
-            )
-            reminder = (await session.scalars(stmt)).one()
-            await session.delete(reminder)
-            await session.commit()
-            return True, ''
-        else:
-            reminder = Reminder(
-                seconds=int(value),
-                user=user,
-                data=data
-            )
-            session.add(reminder)
-            await session.commit()
-            return True, ''
+        if int(value) not in reminders.bits:  # Button of an offset removed from the configuration
+            return False, ''
+        await reminders.toggle(session, user, data, int(value))
+        return True, ''
 
 
 class ReminderForm(BaseForm):
@@ -90,10 +69,7 @@ class ReminderForm(BaseForm):
                 ReminderData.message_id) \
             .where(
                 ReminderData.message_id == Message.id,
-                Message.user_id == self.user.id) \
-            .options(
-                selectinload(ReminderData.reminders)
-            )
+                Message.user_id == self.user.id)  # Reminders are joined (moved by allocate_to)
 
         return (await session.scalars(stmt)).unique().all()
 
@@ -1,5 +1,5 @@
 
-from datetime import date
+from datetime import date, datetime, time, timedelta
 from itertools import zip_longest
 
 from sqlalchemy import select, func
@@ -7,6 +7,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload, selectinload
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+import lib.constants as const
+import lib.callbacks as callbacks
+import lib.summaries as summaries
 from lib import misc
 from lib.models import User, SummaryData, AppointmentData, Appointment, Message
 from lib.forms.base import BaseMessage, BaseAction, BaseForm
@@ -23,14 +26,20 @@ class SummaryDateAction(BaseAction, BaseMessage):
         keyboard = []
         available_dates = list(misc.gen_available_dates(user.role))
 
+        stmt = select(Appointment.book_date, func.count()) \
+            .where(
+                Appointment.book_at >= datetime.combine(available_dates[0], time.min),
+                Appointment.book_at < datetime.combine(available_dates[-1] + timedelta(days=1), time.min)) \
+            .group_by(Appointment.book_date)
+        counts = dict((await session.execute(stmt)).all())
+
         for d in available_dates:
-            stmt = select(func.count()).where(Appointment.book_date == d)
-            appointments_count = (await session.scalars(stmt)).unique().one_or_none()
+            appointments_count = counts.get(d)
             date_str = misc.date_button_to_str(d)
             keyboard_button = InlineKeyboardButton(
                     '%s - %d' % (date_str, appointments_count)
                     if appointments_count else date_str,
-                    callback_data=' '.join([str(state), d.isoformat()]))
+                    callback_data=callbacks.encode(user, data, state, d.isoformat()))
             keyboard.append([keyboard_button])
         return InlineKeyboardMarkup(keyboard)
 
@@ -97,6 +106,23 @@ class SummaryForm(BaseForm):
             .where(
                 SummaryData.message_id == Message.id,
                 Message.user_id == self.user.id,
-                SummaryData.id != data.id)
+                SummaryData.id != data.id,
+                ~summaries.is_live())  # Live summaries are replaced by subscribe
 
         return (await session.execute(stmt)).scalars().all()
+
+    async def subscribe(self, bot, rolling: bool = False) -> None:
+        """Live summary of its date: refreshed by events, the replaced ones are closed"""
+        for data in await summaries.subscribe(self.session, self.user, self.data, rolling):
+            await self.__class__(self.session, self.user, data).close(const.MESSAGE_IS_NOT_RELEVANT, bot)
+            await self.session.delete(data)
+        await self.session.commit()
+
+    async def button_handler(self, update, context, value: str):
+        result = await super(SummaryForm, self).button_handler(update, context, value)
+        if result and self.data.summary_date is not None:  # Date is selected
+            await self.subscribe(context.bot)
+        return result
+
+    def allocation_key(self) -> tuple:
+        return self.data.state, self.data.summary_date
@@ -1,21 +1,36 @@
 
+import os
 import re
-import asyncio
-from datetime import datetime
+import time as timer
+from datetime import datetime, time, timedelta
 
+import locales
+import lib.misc as misc
+import lib.clock as clock
 import lib.constants as const
+import lib.recurring as recurring
 from lib.misc import append_locale_arg
 from lib.forms.appointment import AppointmentForm
 from lib.forms.reminder import ReminderForm
 from lib.forms.summary import SummaryForm
-from lib.models import User, Message, AppointmentData, SummaryData, UserRole, ReminderData, Appointment
-from lib.middlewares import auth_user_middleware, message_form_middleware, user_permission_middleware
+from lib.forms.bookings import BookingsForm
+from lib.models import User, AppointmentData, SummaryData, UserRole, ReminderData, BookingsData, begin_update
+from lib.middlewares import auth_user_middleware, callback_form_middleware, user_permission_middleware, \
+    developer_middleware
 from lib.authorization import authorize
-
-from sqlalchemy import select
+import lib.waitlist as waitlist
+import lib.washers as washers
+import lib.summaries as summaries
+import lib.dedup as dedup
+import lib.logs as logs
+import lib.state as state
+import lib.profiler as profiler
+import lib.diagnostics as diagnostics
+import lib.subscribers  # Registers event subscribers (form and summary refresh, timetable, metrics)
 
 from telegram import Update
-from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, \
+    ApplicationHandlerStop, filters
 
 
 @auth_user_middleware
@@ -98,45 +113,23 @@ async def message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await auth(update, context)
 
 
-@auth_user_middleware
-@message_form_middleware
+@callback_form_middleware
 async def callback_query_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = context.bot_data['session']
     message_form = context.user_data['message_form']
     query = update.callback_query
     await query.answer()
 
-    state, value = query.data.split(' ')
+    callback = context.user_data.pop('callback', None)  # Decoded by callback_form_middleware
+    state, value = (callback.state, callback.value) if callback else query.data.split(' ')
     message_form.data.state = int(state)
     await message_form.button_handler(update, context, value)
     await message_form.update_message(update, context)
 
-    data = message_form.data
-    if isinstance(data, AppointmentData):
-        if data.state == len(message_form.actions) - 1:
-            # Update appointment forms for other users
-            stmt = select(AppointmentData, User).where(
-                AppointmentData.id != data.id,
-                AppointmentData.message_id == Message.id,
-                Message.user_id == User.id)
-
-            appointment_gather = [
-                AppointmentForm(session, user, data).update_message(update, context)
-                for data, user in (await session.execute(stmt)).unique()
-            ]
-            # Update summary forms for moderators
-            stmt = select(SummaryData, User) \
-                .where(
-                    SummaryData.message_id == Message.id,
-                    Message.user_id == User.id)
-
-            summary_gather = [
-                SummaryForm(session, user, data).update_message(update, context)
-                for data, user in (await session.execute(stmt)).unique()
-                if data.message is not None
-            ]
-
-            await asyncio.gather(*appointment_gather, *summary_gather)
+    for appointment in waitlist.pop_promoted(session):  # Notify users who got a cancelled slot
+        await AppointmentForm(session, appointment.user, appointment.data) \
+            .notify_promoted(context.bot)
+    # Forms of other users and summaries are refreshed by event subscribers (lib/subscribers.py)
 
 
 @auth_user_middleware
@@ -158,37 +151,71 @@ async def remind(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @auth_user_middleware
 async def my(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = context.bot_data['session']
-    auth_user = context.user_data['auth_user']
+    user_data = context.user_data
+    auth_user = user_data['auth_user']
+
+    data = BookingsData()
+    session.add(data)
+    await session.commit()
+
+    # One message with all bookings, the previous list is closed (allocate_data_if_necessary)
+    message_form = BookingsForm(session, auth_user, data)
+    await message_form.reply(update, context)
+
+    user_data['message_form'] = message_form
 
-    stmt = select(AppointmentData, User) \
-        .where(
-            AppointmentData.id == Appointment.data_id,
-            AppointmentData.expired == False,
-            AppointmentData.message_id == Message.id,
-            Message.user_id == User.id,
-            User.id == auth_user.id) \
-        .order_by(
-            AppointmentData.book_date,
-            AppointmentData.book_time)
-
-    active_datas = (await session.execute(stmt)).unique().fetchall()
-    if active_datas:
-        # Close old forms
-        closed_forms = asyncio.gather(*[
-            AppointmentForm(session, user, data).close(const.MESSAGE_IS_NOT_RELEVANT, context.bot)
-            for data, user in active_datas
-        ])
-
-        # Reply new forms concurrently
-        for data, user in active_datas:
-            await asyncio.create_task(
-                AppointmentForm(session, user, data).reply(update, context))
-
-        await closed_forms
-    else:
-        await update.effective_message.reply_text(
-            text='На данный момент нет действующих записей'
-        )
+
+@auth_user_middleware
+@append_locale_arg('recurring')
+async def repeat(update: Update, context: ContextTypes.DEFAULT_TYPE, locale: dict):
+    session = context.bot_data['session']
+    auth_user = context.user_data['auth_user']
+    args = context.args or []
+
+    if len(args) == 2 and args[0] == '-':  # /repeat - <number>
+        rules = await recurring.user_rules(session, auth_user)
+        number = int(args[1]) if args[1].isdigit() else 0
+        if 0 < number <= len(rules):
+            await session.delete(rules[number - 1])
+            await session.commit()
+            return await update.effective_message.reply_text(locale['removed'])
+        else:
+            return await update.effective_message.reply_text(locale['not_found'])
+    elif 2 <= len(args) <= 4:  # /repeat <weekday> <time> [washers] [until]
+        try:
+            weekday = misc.parse_weekday(args[0])
+            book_time = time.fromisoformat(args[1])
+            washers_count = int(args[2]) if len(args) > 2 else 1
+            until_date = datetime.strptime(args[3], '%d.%m.%Y').date() if len(args) > 3 else None
+            if book_time not in const.available_time or \
+                    not 0 < washers_count <= const.max_book_washers:
+                raise ValueError
+        except ValueError:
+            return await update.effective_message.reply_text(
+                parse_mode='Markdown',
+                text='%s\n\n%s' % (locale['invalid'], locale['usage']))
+
+        if weekday not in const.available_weekdays[auth_user.role]:
+            return await update.effective_message.reply_text(locale['weekday_is_not_available'])
+
+        rule = await recurring.add_rule(session, auth_user, weekday, book_time, washers_count, until_date)
+        return await update.effective_message.reply_text(
+            locale['added'] % misc.date_to_str(rule.next_date))
+
+    rules = await recurring.user_rules(session, auth_user)
+    rules_text = '\n'.join([
+        locale['rule'] % (
+            i + 1,
+            locales.ru['short_weekdays'][rule.weekday],
+            misc.time_to_str(rule.book_time),
+            rule.washers_count) +
+        (locale['until'] % rule.until_date.strftime('%d.%m.%Y') if rule.until_date else '')
+        for i, rule in enumerate(rules)
+    ])
+    await update.effective_message.reply_text(
+        parse_mode='Markdown',
+        text='%s\n%s\n\n%s' % (locale['rules_title'], rules_text, locale['usage'])
+        if rules else locale['usage'])
 
 
 @auth_user_middleware
@@ -197,7 +224,7 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = context.bot_data['session']
     user_data = context.user_data
     auth_user = user_data['auth_user']
-    now_dt = datetime.now()
+    now_dt = clock.now()
 
     data = SummaryData(summary_date=now_dt.date(), state=1)
     session.add(data)
@@ -205,16 +232,23 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     summary_form = SummaryForm(session, auth_user, data)
     await summary_form.reply(update, context)
+    await summary_form.subscribe(context.bot, rolling=True)  # Live summary, moves to the next day
     user_data['message_form'] = summary_form
 
 
 @auth_user_middleware
 @user_permission_middleware(UserRole.moderator)
-async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@append_locale_arg('summary')
+async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE, locale: dict):
     session = context.bot_data['session']
     user_data = context.user_data
     auth_user = user_data['auth_user']
 
+    if context.args == ['off']:  # /summary off
+        for data in await summaries.unsubscribe(session, auth_user):
+            await SummaryForm(session, auth_user, data).close(const.MESSAGE_IS_NOT_RELEVANT, context.bot)
+        return await update.effective_message.reply_text(locale['unsubscribed'])
+
     data = SummaryData()
     session.add(data)
     await session.commit()
@@ -225,15 +259,178 @@ async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_data['message_form'] = summary_form
 
 
-user_handlers = [
-    CommandHandler('auth', auth),
-    CommandHandler('start', start),
-    CommandHandler('book', book),
-    CommandHandler('remind', remind),
-    CommandHandler('my', my),
-    CommandHandler('today', today),  # Moderator command
-    CommandHandler('summary', summary),  # Moderator command
-    CallbackQueryHandler(callback_query_button),
-    # https://docs.python-telegram-bot.org/en/v20.0a4/examples.echobot.html
-    MessageHandler(filters.TEXT & ~filters.COMMAND, message)
-]
+@auth_user_middleware
+@user_permission_middleware(UserRole.moderator)
+@append_locale_arg('washers')
+async def washer(update: Update, context: ContextTypes.DEFAULT_TYPE, locale: dict):
+    session = context.bot_data['session']
+    args = context.args or []
+
+    if len(args) == 2 and args[0] == '-':  # /washer - <number>
+        windows = await washers.upcoming_windows(session)
+        number = int(args[1]) if args[1].isdigit() else 0
+        if 0 < number <= len(windows):
+            await washers.remove_window(session, windows[number - 1])
+            return await update.effective_message.reply_text(locale['window_removed'])
+        else:
+            return await update.effective_message.reply_text(locale['window_not_found'])
+    elif 2 <= len(args) <= 3:  # /washer <name> on|off, /washer <name> <date> [<time>-<time>]
+        washer = await washers.find(session, args[0])
+        if not washer:
+            return await update.effective_message.reply_text(locale['not_found'])
+
+        if len(args) == 2 and args[1] in ('on', 'off'):
+            await washers.set_available(session, washer, args[1] == 'on')
+            moves = await washers.relocate(session, washer.id) if args[1] == 'off' else {}
+        else:
+            try:
+                start_at = datetime.strptime(args[1], '%d.%m.%Y')
+                end_at = start_at + timedelta(days=1)  # Whole day
+                if len(args) == 3:
+                    start_t, end_t = [time.fromisoformat(t) for t in args[2].split('-')]
+                    start_at, end_at = datetime.combine(start_at, start_t), datetime.combine(start_at, end_t)
+                if end_at <= max(start_at, clock.now()):
+                    raise ValueError
+            except ValueError:
+                return await update.effective_message.reply_text(
+                    parse_mode='Markdown',
+                    text='%s\n\n%s' % (locale['invalid'], locale['usage']))
+
+            await washers.add_window(session, washer, start_at, end_at)
+            moves = await washers.relocate(session, washer.id, start_at, end_at)
+
+        for data, data_moves in moves.items():  # One notice per form
+            user = await session.get(User, data_moves[0][0].user_id)
+            await AppointmentForm(session, user, data).notify_maintenance(context, data_moves)
+
+        moved = [moved for data_moves in moves.values() for _, moved in data_moves]
+        return await update.effective_message.reply_text(
+            parse_mode='Markdown',
+            text=locale['changed'] % (
+                len([m for m in moved if m]),
+                len([m for m in moved if not m])))
+
+    await washers.cache.ensure()
+    washers_text = '\n'.join([
+        locale['washer'] % (w.name, locale['available'] if w.available else locale['not_available'])
+        for w in washers.cache.all()
+    ])
+    windows_text = '\n'.join([
+        locale['window'] % (
+            i + 1,
+            window.washer.name,
+            window.start_at.strftime('%d.%m.%Y %H:%M'),
+            window.end_at.strftime('%d.%m.%Y %H:%M'))
+        for i, window in enumerate(await washers.upcoming_windows(session))
+    ])
+    await update.effective_message.reply_text(
+        parse_mode='Markdown',
+        text='%s\n%s\n\n%s%s' % (
+            locale['washers_title'],
+            washers_text,
+            '%s\n%s\n\n' % (locale['windows_title'], windows_text) if windows_text else '',
+            locale['usage']))
+
+
+@developer_middleware
+@append_locale_arg('developer')
+async def prof(update: Update, context: ContextTypes.DEFAULT_TYPE, locale: dict):
+    args = context.args or []
+    current = profiler.current
+    if args[:1] == ['start'] and len(args) <= 2:
+        if current and current.running:
+            return await update.effective_message.reply_text(locale['profiler_running'])
+        try:
+            duration = min(float(args[1]), const.profiler_max_duration) if len(args) == 2 else 60
+        except ValueError:
+            return await update.effective_message.reply_text(parse_mode='Markdown', text=locale['prof_usage'])
+        profiler.current = profiler.SamplingProfiler(duration=duration)
+        profiler.current.start()  # Samples the thread of this handler: the event loop
+        return await update.effective_message.reply_text(locale['profiler_started'] % duration)
+    elif args == ['stop']:
+        if current is None:
+            return await update.effective_message.reply_text(locale['profiler_not_started'])
+        current.stop()
+        profiler.current = None
+        if not current.samples:
+            return await update.effective_message.reply_text(locale['profiler_no_samples'])
+        top = '\n'.join('%4.1f%% %s' % (share * 100, name) for name, share in current.top(5))
+        return await update.effective_message.reply_document(
+            document=current.collapsed().encode(),
+            filename='profile-%s-%d.collapsed' % (os.getpid(), timer.time()),
+            caption=locale['profiler_stopped'] % (
+                current.samples, current.elapsed, current.cpu_time / current.elapsed * 100, top)[:1024])
+    return await update.effective_message.reply_text(parse_mode='Markdown', text=locale['prof_usage'])
+
+
+@developer_middleware
+async def stats_runtime(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    sections = diagnostics.runtime_stats(context.application)
+    text = '\n\n'.join(
+        '%s\n%s' % (section, '\n'.join('  %s: %s' % (name, value) for name, value in values))
+        for section, values in sections)
+    await update.effective_message.reply_text(parse_mode='Markdown', text='```\n%s\n```' % text)
+
+
+@developer_middleware
+@append_locale_arg('developer')
+async def slow(update: Update, context: ContextTypes.DEFAULT_TYPE, locale: dict):
+    updates = diagnostics.slow_updates.slowest(const.slow_updates_shown)
+    if not updates:
+        return await update.effective_message.reply_text(locale['no_updates'])
+    lines = [
+        '%8.1f ms  %s  %s  %s%s' % (
+            duration * 1000, update_id, datetime.fromtimestamp(finished_at).strftime('%H:%M:%S'), description,
+            '  trace %s' % trace_id if trace_id else '')
+        for duration, update_id, description, finished_at, trace_id in updates
+    ]
+    await update.effective_message.reply_text(
+        parse_mode='Markdown',
+        text='%s\n```\n%s\n```' % (locale['slow_title'] % len(diagnostics.slow_updates.updates), '\n'.join(lines)))
+
+
+async def update_started(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    diagnostics.update_started_at.set(timer.perf_counter())  # Duration of the update (/slow)
+    logs.current_update.set(update.update_id)  # Records of the update (lib/logs.py)
+    clock.freeze_update()  # One "now" for all renders of the update
+    session = context.bot_data['session']
+    if not await dedup.claim(session, update.update_id):  # Redelivered: applied once (e.g. a double toggle)
+        raise ApplicationHandlerStop
+    if update.effective_user:  # Drops user_data of users not seen for long
+        state.users.touch(context.application, update.effective_user.id)
+    state.trim_session(session)  # Nothing of the previous updates is in use
+    # The shared session is pinned to the primary only for the rest of the update which wrote
+    await begin_update(session)
+
+
+async def update_finished(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    diagnostics.update_finished(update)
+    if context.user_data is not None:
+        state.dehydrate(context.user_data)  # Ids between updates, not the ORM objects
+
+
+user_handlers = {
+    -1: [  # Before the handler of the update, stops redelivered updates
+        TypeHandler(Update, update_started)
+    ],
+    0: [
+        CommandHandler('auth', auth),
+        CommandHandler('start', start),
+        CommandHandler('book', book),
+        CommandHandler('remind', remind),
+        CommandHandler('my', my),
+        CommandHandler('repeat', repeat),
+        CommandHandler('today', today),  # Moderator command
+        CommandHandler('summary', summary),  # Moderator command
+        CommandHandler('washer', washer),  # Moderator command
+        CommandHandler('prof', prof),  # Developer command, not in the command list
+        CommandHandler('stats_runtime', stats_runtime),  # Developer command
+        CommandHandler('slow', slow),  # Developer command
+        CallbackQueryHandler(callback_query_button),
+        # https://docs.python-telegram-bot.org/en/v20.0a4/examples.echobot.html
+        MessageHandler(filters.TEXT & ~filters.COMMAND, message)
+    ],
+    1: [  # After the handler of the update
+        TypeHandler(Update, update_finished)
+    ]
+}
@@ -0,0 +1,197 @@
+"""Structured logging of every process, never blocking a handler on log I/O.
+
+Records are filtered (level, per-logger sampling and rate limit) and stamped with the
+update and trace ids in the calling task, then put to a bounded queue: a full queue drops
+the record. A listener thread formats them (JSON lines or text) and writes to stderr or
+to a size-rotated file of the process (LOG_DIR).
+
+    LOG_DIR=logs LOG_SAMPLE=lib.forms=0.1 LOG_RATE=50 python app.py
+"""
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime
+from contextvars import ContextVar
+from typing import Union
+
+import lib.tracing as tracing
+
+current_update: ContextVar[Union[int, None]] = ContextVar('current_update', default=None)
+
+STANDARD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def parse_rates(value: str) -> dict:
+    """'lib.forms=0.1,rmq_consumer=0.5' -> {'lib.forms': 0.1, 'rmq_consumer': 0.5}"""
+    rates = {}
+    for item in filter(None, (value or '').split(',')):
+        name, rate = item.split('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def configured(name: str, values: dict):
+    """Value of the logger or of its nearest configured parent ('lib.forms' of 'lib.forms.base')"""
+    while name:
+        if name in values:
+            return values[name]
+        name = name.rpartition('.')[0]
+    return values.get('')
+
+
+class SamplingFilter(logging.Filter):
+    """Passes a fraction of INFO and DEBUG records of a logger, warnings are never sampled"""
+
+    def __init__(self, rates: dict, rng: random.Random = None):
+        super().__init__()
+        self.rates = rates  # Logger name -> fraction
+        self.rng = rng or random.Random()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = configured(record.name, self.rates)
+        if rate is None or rate >= 1:
+            return True
+        if self.rng.random() >= rate:
+            return False
+        record.sampled = rate
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per logger, the next passed record counts the dropped ones.
+
+    Warnings and errors always pass (spending a token if there is one): an error storm
+    is what the log is read for.
+    """
+
+    def __init__(self, rate: float, burst: float = None, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate  # Records per second
+        self.burst = burst or rate
+        self.clock = clock
+        self.buckets = {}  # Logger name -> [tokens, updated at, dropped]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = self.clock()
+        bucket = self.buckets.get(record.name)
+        if bucket is None:
+            bucket = self.buckets[record.name] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+        elif record.levelno < logging.WARNING:
+            bucket[2] += 1
+            return False
+        if bucket[2]:
+            record.dropped = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():  # update_id, trace_id, extra={...}
+            if key not in STANDARD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Renders the record in the calling task (contextvars, mutable args), drops it on a full queue"""
+
+    def __init__(self, capacity: int):
+        super().__init__(queue.Queue(capacity))
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None  # Picklable, formatted once
+        record.update_id = current_update.get()
+        span = tracing.current_span.get()
+        if span is not None:
+            record.trace_id = span.trace_id
+            record.span_id = span.span_id
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.dropped:
+            record.queue_dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:  # Writer is behind (slow disk), the handler is not
+            self.dropped += 1
+
+
+listener: Union[logging.handlers.QueueListener, None] = None
+
+
+def setup(name: str = None, level: Union[int, str] = None):
+    """Logging of the process: root logger -> queue -> writer thread (stderr or LOG_DIR/<name>.log)"""
+    global listener
+    if listener is not None:
+        return
+
+    name = name or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+
+    log_dir = os.getenv('LOG_DIR')
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        writer = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, name + '.log'),  # One file per process: rotation is not shared
+            maxBytes=int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+            backupCount=int(os.getenv('LOG_BACKUPS', 5)),
+            encoding='utf-8')
+    else:
+        writer = logging.StreamHandler(sys.stderr)
+    writer.setFormatter(
+        logging.Formatter(TEXT_FORMAT) if os.getenv('LOG_FORMAT') == 'text' else JsonFormatter())
+
+    handler = NonBlockingQueueHandler(int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+    sample_rates = parse_rates(os.getenv('LOG_SAMPLE'))
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+    rate = float(os.getenv('LOG_RATE', 100))
+    if rate:
+        handler.addFilter(RateLimitFilter(rate))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # A record per Bot API request
+
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Writes the queued records, e.g. before a process exits"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -1,21 +1,30 @@
 
+import os
+
 from sqlalchemy.orm import selectinload
 
 from lib.forms.appointment import AppointmentForm
 from lib.forms.reminder import ReminderForm
 from lib.forms.summary import SummaryForm
+from lib.forms.bookings import BookingsForm
+import lib.state as state
+import lib.callbacks as callbacks
+import lib.tracing as tracing
 from lib.misc import append_locale_arg
 from lib.models import UserRole, User
 from sqlalchemy import select
 
+MESSAGE_FORMS = [AppointmentForm, ReminderForm, SummaryForm, BookingsForm]
+
 
 def auth_user_middleware(func):
+    @tracing.traced('middleware.auth_user')
     @append_locale_arg()
     async def wrapper(*args, **kwargs):
         update, context, locale = args[:3]
         session = context.bot_data['session']
         user_data = context.user_data
-        if not user_data.get('auth_user'):
+        if not await state.restore_user(session, user_data):  # By chat id for new and evicted users
             stmt = select(User) \
                 .where(
                     User.chat_id == update.effective_message.chat_id) \
@@ -37,6 +46,7 @@ def auth_user_middleware(func):
 
 
 def message_form_middleware(func):
+    @tracing.traced('middleware.message_form')
     async def wrapper(*args, **kwargs):
         update, context = args
         session = context.bot_data['session']
@@ -44,10 +54,13 @@ def message_form_middleware(func):
         auth_user = user_data['auth_user']
         msg_id = update.effective_message.id
 
+        ref = user_data.get('form_ref')
+        if auth_user and not user_data.get('message_form') and ref and ref.message_id == msg_id:
+            await state.restore_form(session, user_data, auth_user, ref)
         if auth_user and (
             not user_data.get('message_form') or  # Not message_form
             user_data['message_form'].message.id != msg_id):  # message_form not for current message
-            for MessageForm in [AppointmentForm, ReminderForm, SummaryForm]:
+            for MessageForm in MESSAGE_FORMS:
                 FormData = MessageForm.__data_class__
                 stmt = select(FormData) \
                     .where(
@@ -60,8 +73,55 @@ def message_form_middleware(func):
     return wrapper
 
 
+def callback_form_middleware(func):
+    """Form and user of a signed button (lib/callbacks.py), legacy buttons are looked up by message"""
+    legacy = auth_user_middleware(message_form_middleware(func))
+
+    @tracing.traced('middleware.callback_form')
+    @append_locale_arg('callbacks')
+    async def wrapper(*args, **kwargs):
+        update, context, locale = args[:3]
+        callback = callbacks.decode(update.callback_query.data)
+        if not callback:
+            return await legacy(*args[:-1], **kwargs)
+
+        session = context.bot_data['session']
+        user_data = context.user_data
+        auth_user = await state.restore_user(session, user_data)
+        if not auth_user:  # The owner of the button, only in its own chat (not a forwarded message)
+            auth_user = await session.get(User, callback.user_id)
+            if not auth_user or auth_user.chat_id != update.effective_chat.id:
+                return await update.callback_query.answer(locale['not_owner'])
+            user_data['auth_user'] = auth_user
+        elif auth_user.id != callback.user_id:
+            return await update.callback_query.answer(locale['not_owner'])
+
+        message_form = user_data.get('message_form')
+        ref = user_data.get('form_ref')
+        if not message_form and ref and ref.form_class.__data_class__ is callback.data_class and \
+                ref.data_id == callback.data_id:
+            message_form = await state.restore_form(session, user_data, auth_user, ref)
+        if not message_form or message_form.data.__class__ is not callback.data_class or \
+                message_form.data.id != callback.data_id:  # From the identity map if it is loaded
+            data = await session.get(callback.data_class, callback.data_id)
+            if not data:
+                return await update.callback_query.answer(locale['not_relevant'])
+            MessageForm = next(F for F in MESSAGE_FORMS if F.__data_class__ is callback.data_class)
+            message_form = user_data['message_form'] = MessageForm(session, auth_user, data)
+
+        if callback.version < message_form.data.version:  # Keyboard is older than the data
+            return await update.callback_query.answer(locale['stale'])
+        elif callback.version > message_form.data.version:  # Changed by other process
+            await message_form.load(session)
+
+        user_data['callback'] = callback
+        return await func(*args[:-1], **kwargs)  # Remove append locale arg
+    return wrapper
+
+
 def user_permission_middleware(*user_roles: UserRole):
     def wrapped(func):
+        @tracing.traced('middleware.user_permission')
         @append_locale_arg('middlewares')
         async def wrapper(*args, **kwargs):
             update, context, locale = args[:3]
@@ -74,3 +134,21 @@ def user_permission_middleware(*user_roles: UserRole):
                 )
         return wrapper
     return wrapped
+
+
+def developer_middleware(func):
+    """Commands of DEVELOPER_USER_ID only (diagnostics of the running process), no auth_user needed.
+
+    A numeric Telegram id: a username can be changed or taken over by another account.
+    """
+    @append_locale_arg('middlewares')
+    async def wrapper(*args, **kwargs):
+        update, context, locale = args[:3]
+        developer = os.getenv('DEVELOPER_USER_ID', '')
+        if developer.isdigit() and update.effective_user and update.effective_user.id == int(developer):
+            return await func(*args[:-1], **kwargs)  # Remove append locale arg
+        else:
+            await update.effective_message.reply_text(
+                locale['user_permission']
+            )
+    return wrapper
@@ -1,14 +1,16 @@
 
 import inspect
 import re
-from datetime import datetime, date, time, timedelta
+from datetime import date, time, timedelta
+from typing import TYPE_CHECKING
 
 import locales
+import lib.clock as clock
 import lib.constants as const
-from lib.models import Washer, UserRole
-
-from telegram.ext import ContextTypes
+from lib.constants import UserRole
 
+if TYPE_CHECKING:  # Annotations only, no models import at runtime
+    from lib.models import Washer
 
 
 def time_to_str(t: time):
@@ -36,7 +38,7 @@ def timedelta_to_str(td: timedelta):
 
 
 def date_to_str(d: date):
-    days_delta = d - date.today()
+    days_delta = d - clock.today()
     if 0 <= days_delta.days < len(locales.ru['shift_days']):
         days_additional = locales.ru['shift_days'][days_delta.days]
     else:
@@ -49,7 +51,7 @@ def date_to_str(d: date):
 
 
 def gen_available_dates(user_role: UserRole):
-    now_dt = datetime.now()
+    now_dt = clock.now()
     d = now_dt.date()
     td = timedelta(days=1)
 
@@ -64,6 +66,14 @@ def gen_available_dates(user_role: UserRole):
         d += td
 
 
+def parse_weekday(s: str) -> int:  # 'пн' or 1..7 -> 0..6
+    if s.lower() in locales.ru['short_weekdays']:
+        return locales.ru['short_weekdays'].index(s.lower())
+    elif s.isdigit() and 1 <= int(s) <= 7:
+        return int(s) - 1
+    raise ValueError(s)
+
+
 def date_button_to_str(d: date):
     return '%s.%s (%s)' % (
         str(d.day).zfill(2),
@@ -72,7 +82,7 @@ def date_button_to_str(d: date):
     )
 
 
-def washers_to_str(washers: list[Washer]):
+def washers_to_str(washers: list['Washer']):
     washers = [
         w.name
         for w in sorted(washers, key=lambda w: w.name)
@@ -1,21 +1,187 @@
 import os
+import time
+import logging
+from contextlib import contextmanager
+from typing import Union
 from datetime import datetime
-from sqlalchemy import Column, ForeignKey, Date, Time, Integer, String, Boolean, Enum, create_engine
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, declared_attr, Session
+from sqlalchemy import Column, ForeignKey, Date, Time, DateTime, Integer, SmallInteger, BigInteger, String, Boolean, Enum, Index, UniqueConstraint
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, declared_attr, validates, Session
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.dialects.mysql import BIGINT
-from sqlalchemy import func
-
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import InvalidRequestError, DBAPIError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy import event, inspect, text, update
+
+import lib.clock as clock
+import lib.tracing as tracing
 from lib.constants import UserRole
 
+logger = logging.getLogger(__name__)
+
 mysql_user = os.getenv('MYSQL_USER')
 mysql_password = os.getenv('MYSQL_PASSWORD')
 mysql_host = os.getenv('MYSQL_HOST')
 mysql_db = os.getenv('MYSQL_DB')
 
-engine = create_async_engine(f'mysql+asyncmy://{mysql_user}:{mysql_password}@{mysql_host}/{mysql_db}')
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+# DATABASE_URL: 'sqlite+aiosqlite://' - in memory (tests), 'sqlite+aiosqlite:///laundry.db' - WAL file
+database_url = os.getenv('DATABASE_URL') or \
+    f'mysql+asyncmy://{mysql_user}:{mysql_password}@{mysql_host}/{mysql_db}'
+
+# DATABASE_REPLICA_URL or MYSQL_REPLICA_HOST: reader of render-only queries (read_only), none by default
+mysql_replica_host = os.getenv('MYSQL_REPLICA_HOST')
+replica_url = os.getenv('DATABASE_REPLICA_URL') or \
+    (f'mysql+asyncmy://{mysql_user}:{mysql_password}@{mysql_replica_host}/{mysql_db}' if mysql_replica_host else None)
+replica_lag_limit = float(os.getenv('REPLICA_LAG_LIMIT', 1))  # Seconds, the primary is used above it
+
+
+def build_engine(url: str):
+    if not url.startswith('sqlite'):
+        return create_async_engine(url)
+
+    in_memory = make_url(url).database in (None, '', ':memory:')
+    sqlite_engine = create_async_engine(
+        url,
+        connect_args={'check_same_thread': False},
+        # One connection holds the memory database, it is shared by all sessions: no rollback
+        # when a session returns it, it would discard the work of the others in progress
+        **({'poolclass': StaticPool, 'pool_reset_on_return': None} if in_memory else {}))
+
+    @event.listens_for(sqlite_engine.sync_engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute('PRAGMA journal_mode=WAL')  # Readers do not block the writer (bot, cron, consumers)
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.close()
+
+    return sqlite_engine
+
+
+def replica_lag(conn) -> Union[float, None]:
+    """Seconds behind the primary, None if replication is stopped"""
+    if conn.dialect.name != 'mysql':
+        return 0.0  # E.g. a copy of the SQLite file, lag is not known
+    try:
+        row = conn.execute(text('SHOW REPLICA STATUS')).mappings().first()
+    except DBAPIError:  # MySQL < 8.0.22
+        row = conn.execute(text('SHOW SLAVE STATUS')).mappings().first()
+    if row is None:
+        return 0.0  # Not a replica (e.g. the primary itself)
+    lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+    return float(lag) if lag is not None else None
+
+
+class ReplicaGuard:
+    """Measured lag of the replica, reads of read_only() blocks fall back to the primary above the limit.
+
+    Checked at most every check_interval seconds, before updates (begin_update) and cron ticks.
+    """
+
+    check_interval = 5
+
+    def __init__(self, engine, lag_limit: float):
+        self.engine = engine
+        self.lag_limit = lag_limit
+        self.lag = None  # Unknown until the first check
+        self.checked_at = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.engine is not None and self.lag is not None and self.lag <= self.lag_limit
+
+    async def check(self):
+        if self.engine is None or \
+                self.checked_at is not None and time.monotonic() - self.checked_at < self.check_interval:
+            return
+        self.checked_at = time.monotonic()
+        try:
+            async with self.engine.connect() as conn:
+                self.lag = await conn.run_sync(replica_lag)
+        except (DBAPIError, OSError):
+            logger.exception('Replica lag is not known, reads go to the primary')
+            self.lag = None
+        if not self.healthy:
+            logger.warning('Replica lag %s s, reads go to the primary', self.lag)
+
+
+class RoutingSession(Session):
+    """Reads of read_only() blocks go to the replica, everything else to the primary.
+
+    A session which wrote (flush, UPDATE/DELETE/INSERT) is pinned to the primary until
+    begin_update: it reads its own writes, the replica may not have them yet.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get('read_only') and not self.info.get('pinned') and not self._flushing and replica.healthy:
+            return replica_engine.sync_engine
+        return engine.sync_engine
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def pin_after_flush(session, flush_context):
+    session.info['pinned'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def pin_after_dml(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['pinned'] = True
+
+
+engine = build_engine(database_url)
+replica_engine = build_engine(replica_url) if replica_url else None
+for traced_engine in filter(None, [engine, replica_engine]):
+    tracing.instrument_engine(traced_engine)
+replica = ReplicaGuard(replica_engine, replica_lag_limit)
+async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession, sync_session_class=RoutingSession)
+
+
+@contextmanager
+def read_only(session: AsyncSession, enabled: bool = True):
+    """Render-only queries of the block may go to the replica (sub-second stale).
+
+    enabled=False: back to the primary inside a read-only block (e.g. version checks of load).
+    """
+    previous = session.info.get('read_only', False)
+    session.info['read_only'] = enabled
+    try:
+        yield session
+    finally:
+        session.info['read_only'] = previous
+
+
+def update_cache(session: AsyncSession) -> dict:
+    """Values loaded once per update (e.g. reminder masks, lib/reminders.py), cleared by begin_update"""
+    return session.info.setdefault('update_cache', {})
+
+
+async def begin_update(session: AsyncSession):
+    """Start of an update (or a cron tick) of a long-lived session: unpin it, drop its cache, check the replica"""
+    session.info.pop('pinned', None)
+    session.info.pop('update_cache', None)
+    await replica.check()
+
+
+class combine_datetime(FunctionElement):
+    """datetime.combine(date, time) in SQL"""
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(combine_datetime)
+def compile_combine_datetime(element, compiler, **kw):
+    return 'TIMESTAMP(%s)' % compiler.process(element.clauses, **kw)
+
+
+@compiles(combine_datetime, 'sqlite')
+def compile_combine_datetime_sqlite(element, compiler, **kw):
+    # Dates and times are ISO strings, concatenation is the format of DateTime values
+    return "(%s || ' ' || %s)" % tuple(compiler.process(clause, **kw) for clause in element.clauses)
 
 Base = declarative_base()
 
@@ -28,10 +194,11 @@ class User(Base):
     last_name = Column(String(60))
     order_number = Column(String(30))
     username = Column(String(60))
-    chat_id = Column(BIGINT(unsigned=True))
+    chat_id = Column(BigInteger().with_variant(BIGINT(unsigned=True), 'mysql'))
     role = Column(Enum(UserRole), default=UserRole.user)
 
     messages = relationship("Message", back_populates="user")
+    recurring_bookings = relationship("RecurringBooking", back_populates="user", order_by="RecurringBooking.id")
     appointments = relationship("Appointment", back_populates="user", lazy="joined")
     reminders = relationship("Reminder", back_populates="user")  # , lazy="dynamic")
 
@@ -39,6 +206,22 @@ class User(Base):
         return f'User(id={self.id!r}, first_name={self.first_name!r}, last_name={self.last_name!r}, order_number={self.order_number!r})'
 
 
+class BookSlotMixin:
+    """Slot as book_date and book_time, and book_at - their combination for indexed range queries"""
+
+    book_date = Column(Date)
+    book_time = Column(Time)
+    book_at = Column(DateTime)  # Set by validate_book_slot
+
+    @validates('book_date', 'book_time')
+    def validate_book_slot(self, key, value):
+        book_date = value if key == 'book_date' else self.book_date
+        book_time = value if key == 'book_time' else self.book_time
+        self.book_at = datetime.combine(book_date, book_time) \
+            if book_date is not None and book_time is not None else None
+        return value
+
+
 class BaseData(Base):
     __abstract__ = True
 
@@ -48,6 +231,14 @@ class BaseData(Base):
 
     id = Column(Integer, primary_key=True)
     state = Column(Integer, default=0)
+    version = Column(Integer, nullable=False, default=1, server_default='1')  # Bumped on every change
+
+    @declared_attr
+    def __mapper_args__(cls):  # Optimistic locking: UPDATE ... WHERE version = <loaded version>
+        return {
+            'version_id_col': cls.__table__.c.version,
+            'version_id_generator': False  # Bumped by bump_data_version (also for collection changes)
+        }
 
     @declared_attr
     def message_id(cls):
@@ -58,40 +249,36 @@ class BaseData(Base):
         return relationship("Message", uselist=False, lazy='joined')
 
 
-class AppointmentData(BaseData):
+class AppointmentData(BookSlotMixin, BaseData):
     __tablename__ = 'appointment_data'
+    __table_args__ = (
+        Index('ix_appointment_data_book_at', 'book_at'),  # Cron pass: forms of slots around now
+        Index('ix_appointment_data_state', 'state'),  # Forms on the date list, refreshed on appointment events
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    book_date = Column(Date)
-    book_time = Column(Time)
     reserved = Column(Boolean, default=False)
+    finished = Column(Boolean, nullable=False, default=False, server_default='0')  # Passed: AppointmentPassed is emitted
 
     appointments = relationship("Appointment", back_populates="data", lazy='joined')
 
     @hybrid_property
     def expired(self):
-        now_dt = datetime.now()
-        return \
-            self.book_date and self.book_time and \
-            now_dt > datetime.combine(self.book_date, self.book_time)
+        return self.book_at is not None and clock.now() > self.book_at
 
     @expired.expression
-    def expired(cls):
-        now_dt = datetime.now()
-        return \
-            cls.book_date and cls.book_time and \
-            now_dt > func.timestamp(cls.book_date, cls.book_time)
+    def expired(cls):  # Not expired: ~AppointmentData.expired (book_at >= now, '== False' is not sargable)
+        return cls.book_at < clock.now()
 
     @property
     def washers(self):
-        return {item.washer for item in self.appointments} \
-            if self.message else None
+        return {item.washer for item in self.appointments}
 
     def allocate_to(self, other_data):  # Provide relationship models to other data
-        for appointment in self.appointments:
-            appointment.data_id = other_data.id
+        for appointment in list(self.appointments):
+            appointment.data = other_data  # Both collections stay loaded
 
     def __repr__(self):
         return f'AppointemntData(id={self.id!r}, message_id={self.message_id})'
@@ -106,8 +293,18 @@ class ReminderData(BaseData):
     reminders = relationship("Reminder", back_populates="data", lazy='joined')
 
     def allocate_to(self, other_data):  # Provide relationship models to other data
-        for reminder in self.reminders:
-            reminder.data_id = other_data.id
+        for reminder in list(self.reminders):
+            reminder.data = other_data  # Both collections stay loaded
+
+
+class BookingsData(BaseData):  # Bookings list of a user (/my), the appointments are not owned
+    __tablename__ = 'bookings_data'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def allocate_to(self, other):
+        pass
 
 
 class SummaryData(BaseData):
@@ -122,6 +319,34 @@ class SummaryData(BaseData):
         pass
 
 
+class SummarySubscription(Base):  # Live summary message of a moderator (lib/summaries.py)
+    __tablename__ = 'summary_subscriptions'
+    __table_args__ = (
+        Index('ix_summary_subscriptions_date', 'summary_date'),  # Refresh on appointment events
+    )
+
+    id = Column(Integer, primary_key=True)
+    rolling = Column(Boolean, nullable=False, default=False)  # Follows the current day (/today)
+    summary_date = Column(Date, nullable=False)  # Shown date, moved every day if rolling
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user = relationship('User', lazy='joined')
+
+    data_id = Column(Integer, ForeignKey('summary_data.id'), nullable=False)
+    data = relationship('SummaryData', lazy='joined')
+
+    def __repr__(self):
+        return f'SummarySubscription(id={self.id}, user_id={self.user_id}, summary_date={self.summary_date}, rolling={self.rolling}, data_id={self.data_id})'
+
+
+@event.listens_for(BaseData, 'before_update', propagate=True)
+def bump_data_version(mapper, connection, target):
+    # Columns or collections (appointments, reminders) changed: other holders of the data must reload it.
+    # The message of a sent form is not a change of its render (buttons carry the version, lib/callbacks.py)
+    if any(attr.history.has_changes() for attr in inspect(target).attrs if attr.key not in ('message_id', 'message')):
+        target.version += 1
+
+
 class Message(Base):
     __tablename__ = 'messages'
 
@@ -130,6 +355,8 @@ class Message(Base):
     user_id = Column(Integer, ForeignKey('users.id'), primary_key=True, nullable=False)
     user = relationship("User", back_populates="messages", uselist=False)
 
+    fingerprint = Column(BigInteger)  # Of the shown render (lib/fingerprints.py)
+
     def __repr__(self):
         return f'Message(id={self.id!r}, user_id={self.user_id!r})'
 
@@ -147,32 +374,31 @@ class Reminder(Base):
     user = relationship("User", back_populates="reminders")
 
 
-class Appointment(Base):
+class Appointment(BookSlotMixin, Base):
     __tablename__ = 'appointments'
+    __table_args__ = (
+        Index('ix_appointments_slot', 'book_at', 'washer_id'),  # Availability of washers
+        Index('ix_appointments_user_book_at', 'user_id', 'book_at'),  # Planned appointments of a user
+    )
 
     id = Column(Integer, primary_key=True)
-    book_date = Column(Date)
-    book_time = Column(Time)
     # rejected_at = Column(DateTime)
 
     @hybrid_property
     def book_datetime(self):
-        dt = datetime.combine(self.book_date, self.book_time)
-        return dt.strftime('%Y-%m-%d %H:%M')
+        return self.book_at.strftime('%Y-%m-%d %H:%M')
 
     @book_datetime.expression
     def book_datetime(cls):
-        return func.timestamp(cls.book_date, cls.book_time)
+        return cls.book_at
 
     @hybrid_property
     def passed(self):
-        now_dt = datetime.now()
-        return now_dt > datetime.combine(self.book_date, self.book_time)
+        return clock.now() > self.book_at
 
     @passed.expression
-    def passed(cls):
-        now_dt = datetime.now()
-        return now_dt > cls.book_datetime
+    def passed(cls):  # Planned: ~Appointment.passed (book_at >= now, '== False' is not sargable)
+        return cls.book_at < clock.now()
 
     data_id = Column(Integer, ForeignKey("appointment_data.id"), nullable=False)
     data = relationship("AppointmentData", back_populates="appointments")
@@ -197,10 +423,157 @@ class Washer(Base):
     def __repr__(self):
         return f'Washer(id={self.id}, name={self.name}, available={self.available})';
 
+
+class WasherMaintenance(Base):  # Out-of-service window of a washer (lib/washers.py)
+    __tablename__ = 'washer_maintenance'
+    __table_args__ = (
+        Index('ix_washer_maintenance_end_at', 'end_at'),  # Cache loads windows that are not over
+    )
+
+    id = Column(Integer, primary_key=True)
+    start_at = Column(DateTime, nullable=False)
+    end_at = Column(DateTime, nullable=False)  # Exclusive
+
+    washer_id = Column(Integer, ForeignKey('washers.id'), nullable=False)
+    washer = relationship('Washer', lazy='joined')
+
+    def __repr__(self):
+        return f'WasherMaintenance(id={self.id}, washer_id={self.washer_id}, start_at={self.start_at}, end_at={self.end_at})'
+
+
+class ScheduledReminder(Base):  # Reminder timetable, maintained by events (lib/timetable.py)
+    __tablename__ = 'scheduled_reminders'
+
+    id = Column(Integer, primary_key=True)
+    notify_at = Column(DateTime, nullable=False, index=True)
+    seconds = Column(Integer, nullable=False)
+
+    book_date = Column(Date, nullable=False)  # Slot, not data: forms of a slot are reallocated
+    book_time = Column(Time, nullable=False)
+    book_at = Column(DateTime)  # Slot for the indexed join with the forms (timetable.due)
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user = relationship('User', lazy='joined')
+
+    def __repr__(self):
+        return f'ScheduledReminder(id={self.id}, notify_at={self.notify_at}, seconds={self.seconds}, user_id={self.user_id}, book_date={self.book_date}, book_time={self.book_time}, book_at={self.book_at})'
+
+
+class SentReminder(Base):  # Sent-log of reminder delivery (lib/delivery.py)
+    __tablename__ = 'sent_reminders'
+    __table_args__ = (
+        # Claimed once: reruns and overlapping cron ticks do not send it again
+        UniqueConstraint('chat_id', 'book_at', 'seconds', 'kind', name='uq_sent_reminders'),
+        Index('ix_sent_reminders_book_at', 'book_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger().with_variant(BIGINT(unsigned=True), 'mysql'), nullable=False)
+    book_at = Column(DateTime, nullable=False)  # Slot
+    seconds = Column(Integer, nullable=False)  # Offset of the reminder before the slot
+    kind = Column(SmallInteger, nullable=False)  # const.REMINDER_USER, const.REMINDER_MODERATOR
+    tick = Column(String(32), nullable=False)  # Delivery which claimed it
+    sent_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'SentReminder(id={self.id}, chat_id={self.chat_id}, book_at={self.book_at}, seconds={self.seconds}, kind={self.kind})'
+
+
+class ProcessedUpdate(Base):  # Shared store of applied update ids (lib/dedup.py)
+    __tablename__ = 'processed_updates'
+
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'ProcessedUpdate(update_id={self.update_id}, processed_at={self.processed_at})'
+
+
+class WaitlistEntry(Base):
+    __tablename__ = 'waitlist'
+    __table_args__ = (
+        # Queue per slot: (book_date, book_time, washer_id) seek, FIFO by id
+        Index('ix_waitlist_slot', 'book_date', 'book_time', 'washer_id', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    book_date = Column(Date, nullable=False)
+    book_time = Column(Time, nullable=False)
+
+    washer_id = Column(Integer, ForeignKey('washers.id'), nullable=False)
+    washer = relationship('Washer', lazy='joined')
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user = relationship('User', lazy='joined')
+
+    def __repr__(self):
+        return f'WaitlistEntry(id={self.id}, user_id={self.user_id}, book_date={self.book_date}, book_time={self.book_time}, washer_id={self.washer_id})'
+
+
+class RecurringBooking(Base):
+    __tablename__ = 'recurring_bookings'
+
+    id = Column(Integer, primary_key=True)
+    weekday = Column(SmallInteger, nullable=False)  # 0 - Monday
+    book_time = Column(Time, nullable=False)
+    washers_count = Column(SmallInteger, nullable=False, default=1)
+    until_date = Column(Date)  # Inclusive, None - without end
+    next_date = Column(Date, nullable=False, index=True)  # Next occurrence to materialize
+
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user = relationship('User', back_populates='recurring_bookings', lazy='joined')
+
+    def __repr__(self):
+        return f'RecurringBooking(id={self.id}, user_id={self.user_id}, weekday={self.weekday}, book_time={self.book_time}, washers_count={self.washers_count}, until_date={self.until_date}, next_date={self.next_date})'
+
+async def rollback(session: AsyncSession, *keep):
+    """Rollback expires every object of the (shared) session: the `keep` objects of the caller are
+    reloaded (a SELECT each), the rest is expunged and loaded again by the next query that needs it"""
+    await session.rollback()
+    kept = {id(obj) for obj in keep}
+    for obj in list(session.identity_map.values()):
+        if id(obj) not in kept:
+            session.expunge(obj)
+    for obj in keep:
+        try:
+            await session.refresh(obj)
+        except InvalidRequestError:  # Removed by other writer
+            session.expunge(obj)
+
+
 async def get_session():
     async with async_session() as session:
         return session
 
+def add_missing_columns(conn):  # create_all creates only missing tables
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(conn.dialect))
+                if column.server_default is not None:
+                    ddl += " DEFAULT '%s'" % column.server_default.arg
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                conn.execute(text(ddl))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(conn)
+
+
 async def init():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+        for model in [AppointmentData, Appointment, ScheduledReminder]:  # book_at of rows created before the column
+            await conn.execute(
+                update(model) \
+                    .where(
+                        model.book_at.is_(None),
+                        model.book_date.isnot(None),
+                        model.book_time.isnot(None)) \
+                    .values(
+                        book_at=combine_datetime(model.book_date, model.book_time)))
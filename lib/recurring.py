@@ -0,0 +1,179 @@
+from collections import defaultdict, Counter
+from datetime import datetime, date, time, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import lib.misc as misc
+import lib.clock as clock
+import lib.washers as washers
+import lib.constants as const
+from lib.misc import append_locale_arg
+from lib.events import emit, AppointmentBooked
+from lib.models import User, UserRole, Appointment, AppointmentData, RecurringBooking
+from lib.forms.appointment import AppointmentForm
+
+
+def next_occurrence(weekday: int, book_time: time, now_dt: datetime) -> date:
+    d = now_dt.date() + timedelta(days=(weekday - now_dt.weekday()) % 7)
+    if now_dt > datetime.combine(d, book_time) - timedelta(hours=const.book_time_left):
+        d += timedelta(days=7)  # Too late for today
+    return d
+
+
+def horizon_end() -> date:
+    return max(
+        max(misc.gen_available_dates(role))
+        for role in UserRole)
+
+
+async def user_rules(session: AsyncSession, user: User) -> list[RecurringBooking]:
+    stmt = select(RecurringBooking) \
+        .where(
+            RecurringBooking.user_id == user.id) \
+        .order_by(
+            RecurringBooking.id)
+    return (await session.scalars(stmt)).unique().all()
+
+
+async def add_rule(session: AsyncSession, user: User, weekday: int, book_time: time,
+                   washers_count: int, until_date: date = None) -> RecurringBooking:
+    rule = RecurringBooking(
+        user_id=user.id,
+        weekday=weekday,
+        book_time=book_time,
+        washers_count=washers_count,
+        until_date=until_date,
+        next_date=next_occurrence(weekday, book_time, clock.now()))
+    session.add(rule)
+    await session.commit()
+    return rule
+
+
+async def load_occupancy(session: AsyncSession, first_date: date, last_date: date):
+    """Occupancy grid: (book_date, book_time) -> {washer_id: user_id}"""
+    stmt = select(
+            Appointment.book_date,
+            Appointment.book_time,
+            Appointment.washer_id,
+            Appointment.user_id) \
+        .where(
+            Appointment.book_at >= datetime.combine(first_date, time.min),
+            Appointment.book_at < datetime.combine(last_date + timedelta(days=1), time.min))
+
+    occupancy = defaultdict(dict)
+    for book_date, book_time, washer_id, user_id in (await session.execute(stmt)).all():
+        occupancy[(book_date, book_time)][washer_id] = user_id
+    return occupancy
+
+
+async def materialize(session: AsyncSession):
+    """Expand due recurring rules into appointments for the available days.
+
+    Everything is inserted with a single commit. Returns the created (user, data)
+    pairs and the failed (rule, book_date, reason) triples for notification.
+    """
+    now_dt = clock.now()
+    last_date = horizon_end()
+
+    stmt = select(RecurringBooking) \
+        .where(
+            RecurringBooking.next_date <= last_date) \
+        .order_by(
+            RecurringBooking.id)
+    rules = (await session.scalars(stmt)).unique().all()
+    if not rules:
+        return [], []
+
+    await washers.cache.ensure()
+
+    occupancy = await load_occupancy(session, now_dt.date(), last_date)
+    planned_counts = Counter(
+        user_id
+        for (book_date, book_time), slot in occupancy.items()
+        if datetime.combine(book_date, book_time) > now_dt
+        for user_id in slot.values())
+
+    created, failed = [], []
+    for rule in rules:
+        available_dates = list(misc.gen_available_dates(rule.user.role))
+        if rule.next_date < now_dt.date():  # Missed ticks
+            rule.next_date = next_occurrence(rule.weekday, rule.book_time, now_dt)
+
+        while rule.next_date <= available_dates[-1] and \
+                (rule.until_date is None or rule.next_date <= rule.until_date):
+            book_date = rule.next_date
+            rule.next_date += timedelta(days=7)
+
+            book_dt = datetime.combine(book_date, rule.book_time)
+            if book_date not in available_dates or \
+                    now_dt > book_dt - timedelta(hours=const.book_time_left):
+                failed.append((rule, book_date, const.RECURRING_SLOT_IS_NOT_AVAILABLE))
+                continue
+
+            slot = occupancy[(book_date, rule.book_time)]
+            if rule.user_id in slot.values():  # Booked by the user himself
+                continue
+
+            free_washers = [
+                washer
+                for washer in washers.cache.all()
+                if washer.id not in slot and washers.cache.in_service(washer.id, book_dt)
+            ]
+            washers_count = min(
+                rule.washers_count,
+                len(free_washers),
+                const.max_book_washers - planned_counts[rule.user_id])
+            if washers_count > 0:
+                data = AppointmentData(
+                    book_date=book_date,
+                    book_time=rule.book_time,
+                    state=2)  # Finished AppointmentForm (washers action)
+                session.add(data)
+                session.add_all([
+                    Appointment(
+                        user_id=rule.user_id,
+                        data=data,
+                        book_date=book_date,
+                        book_time=rule.book_time,
+                        washer=await washers.attach(session, washer.id))
+                    for washer in free_washers[:washers_count]
+                ])
+                slot.update({washer.id: rule.user_id for washer in free_washers[:washers_count]})
+                planned_counts[rule.user_id] += washers_count
+                created.append((rule.user, data))
+
+            if washers_count < rule.washers_count:
+                failed.append((
+                    rule, book_date,
+                    const.RECURRING_MAX_BOOK_WASHERS
+                    if len(free_washers) > washers_count else
+                    const.RECURRING_WASHERS_ARE_BOOKED))
+
+        if rule.until_date is not None and rule.next_date > rule.until_date:
+            await session.delete(rule)  # Last occurrence is materialized
+
+    await session.flush()  # Ids of created forms for events
+    for user, data in created:
+        for appointment in data.appointments:
+            emit(session, AppointmentBooked(
+                user.id, data.id, data.book_date, data.book_time, appointment.washer.id))
+    await session.commit()
+    return created, failed
+
+
+@append_locale_arg('recurring')
+async def notify(session: AsyncSession, bot, created, failed, locale: dict):
+    for user, data in created:
+        form = AppointmentForm(session, user, data)
+        form.notice_title = '🔁 ' + locale['booked_title']
+        await form.send(bot)
+
+    for rule, book_date, reason in failed:
+        await bot.send_message(
+            chat_id=rule.user.chat_id,
+            parse_mode='Markdown',
+            text='🔁 ' + locale['failed'] % (
+                misc.date_to_str(book_date),
+                misc.time_to_str(rule.book_time),
+                locale[const.RECURRING_REASON_LOCALE_MAP[reason]]))
@@ -0,0 +1,85 @@
+from typing import Iterable
+
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import lib.constants as const
+from lib.events import emit, ReminderSet, ReminderUnset
+from lib.models import update_cache, User, Reminder, ReminderData
+
+# Reminder set of a user is a bitmask over the configured offsets: bit i - offsets[i] seconds before a slot
+offsets = [int(reminder_td.total_seconds()) for reminder_td in const.reminder_timedelta]  # ROUNDING: float -> int
+bits = {seconds: 1 << i for i, seconds in enumerate(offsets)}
+
+
+def to_mask(seconds_list: Iterable[int]) -> int:
+    mask = 0
+    for seconds in seconds_list:
+        mask |= bits.get(seconds, 0)  # Offsets removed from the configuration are ignored
+    return mask
+
+
+def to_seconds(mask: int) -> list[int]:
+    return [seconds for seconds in offsets if mask & bits[seconds]]
+
+
+def is_set(mask: int, seconds: int) -> bool:
+    return bool(mask & bits.get(seconds, 0))
+
+
+async def load_masks(session: AsyncSession, user_ids: Iterable[int] = None) -> dict[int, int]:
+    """user id -> reminder mask (all users if user_ids is None), one query per update.
+
+    Masks are kept in the update cache of the session (cleared by begin_update, lib/models.py).
+    """
+    cache = update_cache(session).setdefault('reminder_masks', {})
+    stmt = select(Reminder.user_id, Reminder.seconds)
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        missing = [user_id for user_id in user_ids if user_id not in cache]
+        if not missing:
+            return {user_id: cache[user_id] for user_id in user_ids}
+        stmt = stmt.where(Reminder.user_id.in_(missing))
+        masks = dict.fromkeys(missing, 0)
+    else:
+        masks = {}
+
+    for user_id, seconds in (await session.execute(stmt)).all():
+        masks[user_id] = masks.get(user_id, 0) | bits.get(seconds, 0)
+    cache.update(masks)
+    return masks if user_ids is None else {user_id: cache[user_id] for user_id in user_ids}
+
+
+async def load_mask(session: AsyncSession, user_id: int) -> int:
+    return (await load_masks(session, [user_id]))[user_id]
+
+
+async def toggle(session: AsyncSession, user: User, data: ReminderData, seconds: int) -> bool:
+    """Set or unset one reminder of the user with a single INSERT or DELETE. Commits.
+
+    Returns whether the reminder is set now.
+    """
+    mask = await load_mask(session, user.id)
+    if is_set(mask, seconds):
+        reminder = next((reminder for reminder in data.reminders if reminder.seconds == seconds), None)
+        if reminder:  # Collection of the form changes: its version is bumped
+            data.reminders.remove(reminder)
+            await session.delete(reminder)
+        else:  # Of an other form of the user
+            await session.execute(
+                delete(Reminder).where(
+                    Reminder.user_id == user.id,
+                    Reminder.seconds == seconds))
+        emit(session, ReminderUnset(user.id, seconds))
+        mask &= ~bits[seconds]
+    else:
+        data.reminders.append(
+            Reminder(
+                seconds=seconds,
+                user_id=user.id))
+        emit(session, ReminderSet(user.id, seconds))
+        mask |= bits[seconds]
+    await session.commit()
+
+    update_cache(session)['reminder_masks'][user.id] = mask  # Not before the commit (StaleDataError is retried)
+    return is_set(mask, seconds)
@@ -0,0 +1,111 @@
+"""Per-user state of the long-running processes (app.py, consumers), bounded in memory.
+
+Between updates user_data keeps ids, not ORM objects: the user and the form of the last
+message are restored by the middlewares (session.get, from the identity map while it is
+loaded) and turned back into ids after the update (dehydrate()). Users not seen for
+USER_STATE_TTL seconds, and the least recently seen above USER_STATE_MAX, lose their
+user_data altogether: the next update looks the user up by chat id again. The identity
+map of the shared session is emptied between updates above IDENTITY_MAP_LIMIT objects.
+"""
+import os
+import logging
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from typing import NamedTuple, Union
+
+import lib.clock as clock
+from lib.models import User
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
+
+metrics = Counter()  # 'evicted' users, 'expunged' identity maps
+
+
+class FormRef(NamedTuple):
+    """Form of the last message of the user, instead of the form with its session and data"""
+    message_id: Union[int, None]
+    form_class: type
+    data_id: int
+
+
+class UserStates:
+    """Last update time of every user with user_data, least recent first"""
+
+    def __init__(self, ttl: float, max_users: int):
+        self.ttl = timedelta(seconds=ttl)
+        self.max_users = max_users
+        self.seen: OrderedDict[int, datetime] = OrderedDict()
+
+    def __len__(self):
+        return len(self.seen)
+
+    def touch(self, application, user_id: int):
+        """The user of the current update is the most recent one, expired users are dropped"""
+        now = clock.now()
+        self.seen[user_id] = now
+        self.seen.move_to_end(user_id)
+        while self.seen:
+            oldest, seen_at = next(iter(self.seen.items()))
+            if len(self.seen) <= self.max_users and now - seen_at <= self.ttl:
+                break
+            del self.seen[oldest]
+            application.drop_user_data(oldest)
+            application.drop_chat_data(oldest)  # Private chat of the user: chat id is the user id
+            metrics['evicted'] += 1
+
+
+users = UserStates(
+    float(os.getenv('USER_STATE_TTL', 7 * 24 * 3600)),
+    int(os.getenv('USER_STATE_MAX', 10000)))
+identity_map_limit = int(os.getenv('IDENTITY_MAP_LIMIT', 20000))
+
+
+def primary_key(obj) -> Union[int, None]:
+    """Without loading: objects are expired after a rollback, the update is over"""
+    identity = inspect(obj).identity
+    return identity[0] if identity else None
+
+
+def dehydrate(user_data: dict):
+    """End of the update: ORM objects of user_data are replaced with their ids"""
+    auth_user = user_data.pop('auth_user', None)
+    if auth_user is not None:
+        user_data['auth_user_id'] = primary_key(auth_user)
+    message_form = user_data.pop('message_form', None)
+    data_id = primary_key(message_form.data) if message_form is not None else None
+    if data_id is not None:
+        user_data['form_ref'] = FormRef(
+            inspect(message_form.data).dict.get('message_id'), message_form.__class__, data_id)
+
+
+async def restore_user(session: AsyncSession, user_data: dict) -> Union[User, None]:
+    """User of the update: already restored or by the id of the last update"""
+    auth_user = user_data.get('auth_user')
+    if auth_user is None and user_data.get('auth_user_id'):
+        auth_user = await session.get(User, user_data['auth_user_id'])
+        if auth_user is not None:
+            user_data['auth_user'] = auth_user
+    return auth_user
+
+
+async def restore_form(session: AsyncSession, user_data: dict, auth_user: User, ref: FormRef):
+    """Form of a FormRef (user_data['form_ref']) for the rest of the update, None if its data is deleted"""
+    data = await session.get(ref.form_class.__data_class__, ref.data_id)
+    if data is None:
+        return None
+    message_form = user_data['message_form'] = ref.form_class(session, auth_user, data)
+    return message_form
+
+
+def trim_session(session: AsyncSession):
+    """Between updates: a long-lived session forgets the loaded rows above the limit"""
+    if len(session.identity_map) <= identity_map_limit:
+        return
+    if session.new or session.dirty:  # Not flushed changes are not dropped
+        logger.debug('Identity map of %d objects is not expunged: pending changes', len(session.identity_map))
+        return
+    logger.info('Identity map of %d objects expunged', len(session.identity_map))
+    session.expunge_all()
+    metrics['expunged'] += 1
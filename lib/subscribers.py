@@ -0,0 +1,126 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import select, func, or_
+
+import lib.timetable as timetable
+import lib.summaries as summaries
+import lib.washers as washers
+from lib.events import bus, Event, EventContext, \
+    AppointmentBooked, AppointmentCancelled, AppointmentReserved, AppointmentPassed, \
+    ReminderSet, ReminderUnset, WasherChanged
+from lib.forms.appointment import AppointmentForm
+from lib.forms.summary import SummaryForm
+from lib.forms.bookings import BookingsForm
+from lib.models import User, Message, Appointment, AppointmentData, BookingsData
+
+metrics = Counter()  # Event type name -> count, across all processes
+
+
+@bus.subscribe(AppointmentBooked, AppointmentCancelled)
+async def refresh_appointment_forms(event: AppointmentBooked, context: EventContext):
+    """Appointment forms of other users that show the changed date (or the date list)"""
+    session = context.bot_data['session']
+    stmt = select(AppointmentData, User) \
+        .where(
+            AppointmentData.id != event.data_id,
+            AppointmentData.message_id == Message.id,
+            Message.user_id == User.id)
+    day_at = datetime.combine(event.book_date, time.min)
+    forms = {}  # Two queries, not or_(): each one by its own index (book_at, state)
+    for where in [
+            (AppointmentData.book_at >= day_at, AppointmentData.book_at < day_at + timedelta(days=1)),
+            (AppointmentData.state == 0,)]:
+        for data, user in (await session.execute(stmt.where(*where))).unique():
+            forms[data.id] = data, user
+
+    await asyncio.gather(*[
+        AppointmentForm(session, user, data).update_message(
+            None, context, allocate=False,
+            # Washers of other slot: the form shows only its own data, skipped if its version is shown
+            if_changed=data.state == 2 and data.book_time != event.book_time)
+        for data, user in forms.values()
+    ])
+
+
+@bus.subscribe(WasherChanged, remote=True)
+async def refresh_washer_cache(event: WasherChanged, context: EventContext):
+    await washers.cache.refresh()
+
+
+@bus.subscribe(WasherChanged)
+async def refresh_washer_forms(event: WasherChanged, context: EventContext):
+    """Appointment forms that can show the washer (🔧), unchanged renders are skipped by fingerprints"""
+    await washers.cache.refresh()  # Runs along with refresh_washer_cache, must not render the old state
+    session = context.bot_data['session']
+    stmt = select(AppointmentData, User) \
+        .where(
+            AppointmentData.message_id == Message.id,
+            Message.user_id == User.id) \
+        .where(
+            or_(
+                AppointmentData.book_at.is_(None),
+                ~AppointmentData.expired))
+
+    await asyncio.gather(*[
+        AppointmentForm(session, user, data).update_message(None, context, allocate=False)
+        for data, user in (await session.execute(stmt)).unique()
+    ])
+
+
+@bus.subscribe(AppointmentBooked, AppointmentCancelled, AppointmentPassed)
+async def refresh_summary_forms(event: AppointmentBooked, context: EventContext):
+    """Live summaries of the changed date, one per subscribed moderator (lib/summaries.py)"""
+    session = context.bot_data['session']
+    await asyncio.gather(*[
+        SummaryForm(session, user, data).update_message(None, context, allocate=False)
+        for data, user in await summaries.live(session, event.book_date)
+    ])
+
+
+@bus.subscribe(AppointmentBooked, AppointmentCancelled, AppointmentReserved, AppointmentPassed)
+async def refresh_bookings_forms(event: AppointmentBooked, context: EventContext):
+    """Bookings list (/my) of the user of the appointment, in place"""
+    session = context.bot_data['session']
+    stmt = select(BookingsData, User) \
+        .where(
+            BookingsData.message_id == Message.id,
+            Message.user_id == User.id,
+            User.id == event.user_id)
+
+    await asyncio.gather(*[
+        BookingsForm(session, user, data).update_message(None, context, allocate=False)
+        for data, user in (await session.execute(stmt)).unique()
+    ])
+
+
+@bus.subscribe(AppointmentBooked, AppointmentCancelled, AppointmentPassed)
+async def maintain_appointment_timetable(event: AppointmentBooked, context: EventContext):
+    session = context.bot_data['session']
+    if isinstance(event, AppointmentBooked):
+        await timetable.schedule_slot(session, event.user_id, event.book_date, event.book_time)
+    elif isinstance(event, AppointmentCancelled):
+        stmt = select(func.count()) \
+            .where(
+                Appointment.user_id == event.user_id,
+                Appointment.book_date == event.book_date,
+                Appointment.book_time == event.book_time)
+        if not (await session.scalars(stmt)).one():  # No other washers of the user in the slot
+            await timetable.unschedule_slot(session, event.user_id, event.book_date, event.book_time)
+    else:
+        await timetable.unschedule_slot(session, event.user_id, event.book_date, event.book_time)
+
+
+@bus.subscribe(ReminderSet, ReminderUnset)
+async def maintain_reminder_timetable(event: ReminderSet, context: EventContext):
+    session = context.bot_data['session']
+    if isinstance(event, ReminderSet):
+        await timetable.schedule_reminder(session, event.user_id, event.seconds)
+    else:
+        await timetable.unschedule_reminder(session, event.user_id, event.seconds)
+
+
+@bus.subscribe(Event, remote=True)
+async def count_events(event: Event, context: EventContext):
+    metrics[event.__class__.__name__] += 1
@@ -0,0 +1,105 @@
+from datetime import date
+from typing import Union
+
+from sqlalchemy import select, delete, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from lib.models import User, SummaryData, SummarySubscription
+
+
+async def subscribe(session: AsyncSession, user: User, data: SummaryData, rolling: bool = False) -> list[SummaryData]:
+    """Make the summary the live one of its date (or of the current day if rolling).
+
+    A moderator has one live summary per date and one rolling: the summaries replaced by
+    this one are returned, the caller closes them. Commits.
+    """
+    where = [SummarySubscription.summary_date == data.summary_date]
+    if rolling:
+        where.append(SummarySubscription.rolling == True)
+    stmt = select(SummarySubscription) \
+        .where(
+            SummarySubscription.user_id == user.id,
+            or_(*where)) \
+        .order_by(
+            SummarySubscription.rolling.desc(),
+            SummarySubscription.id)
+    subscriptions = (await session.scalars(stmt)).unique().all()
+
+    replaced = [
+        subscription.data
+        for subscription in subscriptions
+        if subscription.data_id != data.id
+    ]
+    if subscriptions:
+        subscription, *others = subscriptions  # Reused, a rolling one stays rolling
+        for other in others:
+            await session.delete(other)
+        subscription.rolling = subscription.rolling or rolling
+        subscription.summary_date = data.summary_date
+        subscription.data = data
+    else:
+        session.add(
+            SummarySubscription(
+                user_id=user.id,
+                rolling=rolling,
+                summary_date=data.summary_date,
+                data=data))
+    await session.commit()
+    return replaced
+
+
+async def unsubscribe(session: AsyncSession, user: User) -> list[SummaryData]:
+    """Remove live summaries of the moderator, returns them (not updated anymore)"""
+    stmt = select(SummarySubscription) \
+        .where(
+            SummarySubscription.user_id == user.id)
+    subscriptions = (await session.scalars(stmt)).unique().all()
+    for subscription in subscriptions:
+        await session.delete(subscription)
+    await session.commit()
+    return [subscription.data for subscription in subscriptions]
+
+
+def is_live():  # Where clause of live summaries
+    return SummaryData.id.in_(select(SummarySubscription.data_id))
+
+
+async def live(session: AsyncSession, summary_date: date) -> list[tuple[SummaryData, User]]:
+    """Live summaries of the date, one per moderator"""
+    stmt = select(SummaryData, User) \
+        .where(
+            SummarySubscription.data_id == SummaryData.id,
+            SummarySubscription.user_id == User.id,
+            SummarySubscription.summary_date == summary_date)
+    return (await session.execute(stmt)).unique().all()
+
+
+async def live_message_id(session: AsyncSession, user: User, summary_date: date) -> Union[int, None]:
+    stmt = select(SummaryData.message_id) \
+        .where(
+            SummarySubscription.data_id == SummaryData.id,
+            SummarySubscription.user_id == user.id,
+            SummarySubscription.summary_date == summary_date)
+    return (await session.scalars(stmt)).first()
+
+
+async def roll(session: AsyncSession, today: date) -> list[tuple[SummaryData, User]]:
+    """Move rolling summaries to the current day, remove subscriptions of passed dates.
+
+    Returns the moved summaries to update their messages.
+    """
+    stmt = select(SummarySubscription) \
+        .where(
+            SummarySubscription.rolling == True,
+            SummarySubscription.summary_date < today)
+    subscriptions = (await session.scalars(stmt)).unique().all()
+    for subscription in subscriptions:
+        subscription.summary_date = today
+        subscription.data.summary_date = today
+
+    await session.execute(
+        delete(SummarySubscription).where(
+            SummarySubscription.rolling == False,
+            SummarySubscription.summary_date < today))
+    await session.commit()
+    return [(subscription.data, subscription.user) for subscription in subscriptions]
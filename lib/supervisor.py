@@ -0,0 +1,183 @@
+"""Supervisor of the consumer processes of rmq_main.py.
+
+The pool is scaled between min and max workers by the depth of the updates queue and the
+latency reported by consumers (publish to processed). Crashed workers are restarted with
+exponential backoff, workers above the desired count are drained: SIGTERM, the consumer
+finishes its message and exits (killed after drain_timeout).
+"""
+import math
+import json
+import time
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from statistics import mean
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ScalePolicy:
+    min_workers: int = 1
+    max_workers: int = 8
+    target_depth: int = 10  # Ready messages per worker
+    target_latency: float = 1.0  # Seconds from publish to processed, mean of a tick
+    scale_down_delay: float = 30  # Seconds of low load before a worker is drained
+    drain_timeout: float = 30  # Seconds, then the worker is killed
+    backoff_base: float = 1  # Restart delay of the first crash, doubled by every next one
+    backoff_max: float = 60
+    stable_after: float = 60  # Worker which ran so long resets the backoff of its slot
+
+    def desired(self, current: int, depth: int, latency: float = None) -> int:
+        desired = math.ceil(depth / self.target_depth)
+        if latency is not None and latency > self.target_latency:
+            desired = max(desired, current + 1)
+        return min(max(desired, self.min_workers), self.max_workers)
+
+    def backoff(self, crashes: int) -> float:
+        return min(self.backoff_base * 2 ** (crashes - 1), self.backoff_max)
+
+
+class Worker:
+    def __init__(self, number: int, process, started_at: float, crashes: int = 0):
+        self.number = number
+        self.process = process  # Popen-like: poll(), terminate(), kill()
+        self.started_at = started_at
+        self.crashes = crashes  # Consecutive crashes of the slot
+        self.drain_deadline = None
+
+    def __repr__(self):
+        return f'Worker(number={self.number}, started_at={self.started_at:.1f}, crashes={self.crashes})'
+
+
+class Supervisor:
+
+    def __init__(self, broker, spawn, policy: ScalePolicy, clock=time.monotonic):
+        self.broker = broker  # depth(), latencies()
+        self.spawn = spawn  # number -> process
+        self.policy = policy
+        self.clock = clock
+
+        self.workers = {}  # number -> Worker, running
+        self.restarts = {}  # number -> (restart at, crashes), crashed slots waiting for backoff
+        self.draining = []  # Workers stopping after SIGTERM
+        self.low_since = None  # Start of low load (desired below current)
+        self.metrics = Counter()  # spawned, crashed, restarted, drained, killed
+
+    @property
+    def size(self) -> int:  # Slots of the pool, crashed ones count until restarted or cancelled
+        return len(self.workers) + len(self.restarts)
+
+    def start(self, number: int, crashes: int = 0):
+        self.workers[number] = Worker(number, self.spawn(number), self.clock(), crashes)
+        self.metrics['spawned'] += 1
+
+    def free_number(self) -> int:
+        busy = set(self.workers) | set(self.restarts) | {worker.number for worker in self.draining}
+        return next(number for number in range(len(busy) + 1) if number not in busy)
+
+    def reap(self, now: float):
+        for number, worker in list(self.workers.items()):
+            returncode = worker.process.poll()
+            if returncode is None:
+                continue
+            del self.workers[number]
+            crashes = 1 if now - worker.started_at >= self.policy.stable_after else worker.crashes + 1
+            self.restarts[number] = (now + self.policy.backoff(crashes), crashes)
+            self.metrics['crashed'] += 1
+            logger.warning('Worker %s exited with %s, restart in %.1f s', number, returncode, self.policy.backoff(crashes))
+
+        for worker in list(self.draining):
+            if worker.process.poll() is not None:
+                self.draining.remove(worker)
+                self.metrics['drained'] += 1
+            elif now >= worker.drain_deadline:
+                worker.process.kill()
+                self.draining.remove(worker)
+                self.metrics['killed'] += 1
+                logger.warning('Worker %s is not drained in %s s, killed', worker.number, self.policy.drain_timeout)
+
+    def restart_due(self, now: float):
+        for number, (restart_at, crashes) in list(self.restarts.items()):
+            if now >= restart_at:
+                del self.restarts[number]
+                self.start(number, crashes)
+                self.metrics['restarted'] += 1
+
+    def drain(self, worker: Worker, now: float):
+        del self.workers[worker.number]
+        worker.process.terminate()  # rmq_consumer.py stops consuming after the current message
+        worker.drain_deadline = now + self.policy.drain_timeout
+        self.draining.append(worker)
+
+    def scale(self, now: float, desired: int):
+        if desired > self.size:
+            self.low_since = None
+            for _ in range(desired - self.size):
+                self.start(self.free_number())
+            logger.info('Scaled up to %s workers', self.size)
+        elif desired < self.size:
+            if self.low_since is None:
+                self.low_since = now
+            if now - self.low_since < self.policy.scale_down_delay:
+                return
+            self.low_since = now  # One worker per scale_down_delay
+            if self.restarts:  # Crashed slot is not restarted
+                del self.restarts[max(self.restarts)]
+            else:
+                self.drain(self.workers[max(self.workers)], now)
+            logger.info('Scaled down to %s workers', self.size)
+        else:
+            self.low_since = None
+
+    def tick(self) -> tuple:
+        """One supervision pass, returns (queue depth, mean latency or None)"""
+        now = self.clock()
+        self.reap(now)
+        depth = self.broker.depth()
+        latencies = self.broker.latencies()
+        latency = mean(latencies) if latencies else None
+        self.scale(now, self.policy.desired(self.size, depth, latency))
+        self.restart_due(now)
+        return depth, latency
+
+    def stop(self, poll_interval: float = 0.1):
+        """Drain every worker, wait until they exit (killed after drain_timeout)"""
+        now = self.clock()
+        self.restarts.clear()
+        for worker in list(self.workers.values()):
+            self.drain(worker, now)
+        while self.draining:
+            time.sleep(poll_interval)
+            self.reap(self.clock())
+
+    def run(self, interval: float = 1.0, sleep=time.sleep):
+        self.scale(self.clock(), self.policy.min_workers)
+        while True:
+            self.tick()
+            sleep(interval)  # E.g. connection.sleep of pika: heartbeats are processed meanwhile
+
+
+class RabbitBroker:
+    """Depth of the updates queue and latencies published by consumers to the stats queue"""
+
+    max_samples = 10000  # Per tick, the rest is read on the next ones
+
+    def __init__(self, channel, queue: str = 'laundry.updates', stats_queue: str = 'laundry.consumer_stats'):
+        self.channel = channel
+        self.queue = queue
+        self.stats_queue = stats_queue
+        channel.queue_declare(queue=queue)
+        channel.queue_declare(queue=stats_queue)
+
+    def depth(self) -> int:  # Ready messages, not the unacknowledged ones of the consumers
+        return self.channel.queue_declare(queue=self.queue, passive=True).method.message_count
+
+    def latencies(self) -> list[float]:
+        samples = []
+        while len(samples) < self.max_samples:
+            method, properties, body = self.channel.basic_get(self.stats_queue, auto_ack=True)
+            if method is None:
+                break
+            samples.append(json.loads(body)['latency'])
+        return samples
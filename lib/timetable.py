@@ -0,0 +1,94 @@
+from datetime import datetime, date, time, timedelta
+
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import lib.clock as clock
+import lib.reminders as reminders
+from lib.models import Appointment, AppointmentData, Message, ScheduledReminder
+
+
+def scheduled(user_id: int, book_date: date, book_time: time, seconds_list, now_dt: datetime):
+    book_dt = datetime.combine(book_date, book_time)
+    return [
+        ScheduledReminder(
+            notify_at=book_dt - timedelta(seconds=seconds),
+            seconds=seconds,
+            user_id=user_id,
+            book_date=book_date,
+            book_time=book_time,
+            book_at=book_dt)
+        for seconds in seconds_list
+        if book_dt - timedelta(seconds=seconds) > now_dt
+    ]
+
+
+async def planned_slots(session: AsyncSession, user_id: int = None):
+    stmt = select(Appointment.user_id, Appointment.book_date, Appointment.book_time) \
+        .where(
+            ~Appointment.passed) \
+        .distinct()
+    if user_id is not None:
+        stmt = stmt.where(Appointment.user_id == user_id)
+    return (await session.execute(stmt)).all()
+
+
+async def schedule_slot(session: AsyncSession, user_id: int, book_date: date, book_time: time):
+    await unschedule_slot(session, user_id, book_date, book_time)
+    seconds_list = reminders.to_seconds(await reminders.load_mask(session, user_id))
+    session.add_all(scheduled(user_id, book_date, book_time, seconds_list, clock.now()))
+    await session.commit()
+
+
+async def unschedule_slot(session: AsyncSession, user_id: int, book_date: date, book_time: time):
+    await session.execute(
+        delete(ScheduledReminder).where(
+            ScheduledReminder.user_id == user_id,
+            ScheduledReminder.book_date == book_date,
+            ScheduledReminder.book_time == book_time))
+    await session.commit()
+
+
+async def schedule_reminder(session: AsyncSession, user_id: int, seconds: int):
+    await unschedule_reminder(session, user_id, seconds)
+    now_dt = clock.now()
+    for _, book_date, book_time in await planned_slots(session, user_id):
+        session.add_all(scheduled(user_id, book_date, book_time, [seconds], now_dt))
+    await session.commit()
+
+
+async def unschedule_reminder(session: AsyncSession, user_id: int, seconds: int):
+    await session.execute(
+        delete(ScheduledReminder).where(
+            ScheduledReminder.user_id == user_id,
+            ScheduledReminder.seconds == seconds))
+    await session.commit()
+
+
+async def due(session: AsyncSession, notify_at: datetime):
+    """Reminders to send at notify_at, with the form (message) of the slot to reply to"""
+    stmt = select(ScheduledReminder, AppointmentData) \
+        .where(
+            ScheduledReminder.notify_at == notify_at,
+            AppointmentData.book_at == ScheduledReminder.book_at,  # ix_appointment_data_book_at
+            AppointmentData.message_id == Message.id,
+            Message.user_id == ScheduledReminder.user_id)
+    return (await session.execute(stmt)).unique().all()
+
+
+async def remove_passed(session: AsyncSession, now_dt: datetime):
+    await session.execute(
+        delete(ScheduledReminder).where(ScheduledReminder.notify_at < now_dt))
+    await session.commit()
+
+
+async def rebuild(session: AsyncSession):
+    """Full rebuild from appointments and reminders (startup), events keep it up to date after"""
+    await session.execute(delete(ScheduledReminder))
+
+    masks = await reminders.load_masks(session)
+
+    now_dt = clock.now()
+    for user_id, book_date, book_time in await planned_slots(session):
+        session.add_all(scheduled(user_id, book_date, book_time, reminders.to_seconds(masks.get(user_id, 0)), now_dt))
+    await session.commit()
@@ -0,0 +1,270 @@
+"""Trace of an update from the webhook to the Telegram edits.
+
+The producer (rmq_producer.py) starts a trace per update and passes it in the AMQP header
+`traceparent` (W3C format), the consumer continues it: middlewares, form actions, SQL
+statements and Bot API calls are spans of the current span (contextvar, also of the
+tasks created meanwhile, e.g. event subscribers).
+
+Spans are exported to TRACE_FILE (JSONL, one span per line) and/or to TRACE_OTLP_URL
+(OTLP/HTTP JSON, e.g. lib/fake_collector.py), tracing is off without both.
+Critical path of the slowest updates: python trace-report.py spans.jsonl --top 10
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import secrets
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+service = os.getenv('TRACE_SERVICE') or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+batch_size = 512  # Spans per export
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'end', 'attributes')
+
+    def __init__(self, trace_id: str, parent_id: Union[str, None], name: str, attributes: dict):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+
+    def to_dict(self) -> dict:
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'service': service,
+            'start': self.start,
+            'end': self.end,
+            'attributes': self.attributes
+        }
+
+
+class SpanContext:  # Remote parent (traceparent header)
+    def __init__(self, trace_id: str, span_id: str):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+current_span: ContextVar[Union[Span, SpanContext, None]] = ContextVar('current_span', default=None)
+
+
+class FileExporter:
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list[dict]):
+        with open(self.path, 'a') as f:  # One write per batch, processes append to the same file
+            f.write(''.join(json.dumps(span) + '\n' for span in spans))
+
+
+class OtlpExporter:
+    def __init__(self, url: str):
+        self.url = url
+
+    @staticmethod
+    def otlp_value(value) -> dict:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        elif isinstance(value, int):
+            return {'intValue': str(value)}
+        elif isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def export(self, spans: list[dict]):
+        import urllib.request  # Lazy: in the exporter thread, not on startup of every process
+
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+            'scopeSpans': [{
+                'scope': {'name': 'laundry-bot'},
+                'spans': [
+                    {
+                        'traceId': span['traceId'],
+                        'spanId': span['spanId'],
+                        'parentSpanId': span['parentSpanId'] or '',
+                        'name': span['name'],
+                        'kind': 1,
+                        'startTimeUnixNano': str(span['start']),
+                        'endTimeUnixNano': str(span['end']),
+                        'attributes': [
+                            {'key': key, 'value': self.otlp_value(value)}
+                            for key, value in span['attributes'].items()
+                        ]
+                    }
+                    for span in spans
+                ]
+            }]
+        }]}
+        request = urllib.request.Request(
+            self.url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+        urllib.request.urlopen(request, timeout=5).close()
+
+
+class Processor:
+    """Finished spans are batched and exported by a daemon thread, never in the event loop"""
+
+    def __init__(self, exporters: list):
+        self.exporters = exporters
+        self.buffer = []
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def add(self, span: Span):
+        self.buffer.append(span.to_dict())
+        if len(self.buffer) >= batch_size or span.attributes.get('root'):  # Spans ended later wait for the next
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work, name='trace-exporter', daemon=True)
+            self.thread.start()
+        self.queue.put(batch)
+
+    def work(self):
+        while True:
+            batch = self.queue.get()
+            for exporter in self.exporters:
+                try:
+                    exporter.export(batch)
+                except Exception:  # Collector is down: spans are lost, the bot is not affected
+                    logger.exception('Spans are not exported to %s', exporter.__class__.__name__)
+            self.queue.task_done()
+
+    def shutdown(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.join()
+
+
+exporters = []
+if os.getenv('TRACE_FILE'):
+    exporters.append(FileExporter(os.getenv('TRACE_FILE')))
+if os.getenv('TRACE_OTLP_URL'):
+    exporters.append(OtlpExporter(os.getenv('TRACE_OTLP_URL')))
+processor = Processor(exporters) if exporters else None
+if processor:
+    atexit.register(processor.shutdown)
+
+
+def enabled() -> bool:
+    return processor is not None
+
+
+@contextmanager
+def span(name: str, parent: Union[Span, SpanContext, None] = None, **attributes):
+    """Child of parent (default: the current span), a new trace without both"""
+    if processor is None:
+        yield None
+        return
+
+    parent = parent or current_span.get()
+    if parent is None:
+        new_span = Span(secrets.token_hex(16), None, name, attributes)
+    else:
+        new_span = Span(parent.trace_id, parent.span_id, name, attributes)
+    if parent is None or isinstance(parent, SpanContext):
+        new_span.attributes['root'] = True  # Root of the process: its trace is exported when it ends
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.attributes['error'] = e.__class__.__name__
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.end = time.time_ns()
+        processor.add(new_span)
+
+
+@contextmanager
+def child(name: str, **attributes):
+    """Span of the current span, nothing outside of a trace (e.g. a Bot API call of cron without one)"""
+    if processor is None or current_span.get() is None:
+        yield None
+        return
+    with span(name, **attributes) as new_span:
+        yield new_span
+
+
+def traced(name: str):
+    """Decorator of a coroutine function: its calls in a trace are spans"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if processor is None or current_span.get() is None:
+                return await func(*args, **kwargs)
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(name: str, start: int, end: int, **attributes):
+    """Finished span of the current span (e.g. an SQL statement timed by engine events)"""
+    parent = current_span.get()
+    if processor is None or parent is None:
+        return
+    finished = Span(parent.trace_id, parent.span_id, name, attributes)
+    finished.start = start
+    finished.end = end
+    processor.add(finished)
+
+
+def inject() -> Union[str, None]:
+    """traceparent header of the current span"""
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return '00-%s-%s-01' % (parent.trace_id, parent.span_id)
+
+
+def extract(traceparent: Union[str, bytes, None]) -> Union[SpanContext, None]:
+    if not traceparent:
+        return None
+    if isinstance(traceparent, bytes):
+        traceparent = traceparent.decode()
+    parts = traceparent.split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return SpanContext(parts[1], parts[2])
+
+
+def instrument_engine(engine):
+    """SQL statements of the engine are spans of the current span"""
+    from sqlalchemy import event  # Lazy: tracing is imported by the producer without a database
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if processor is not None and current_span.get() is not None:
+            conn.info.setdefault('trace_starts', []).append(time.time_ns())
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('trace_starts')
+        if starts:
+            record('sql', starts.pop(), time.time_ns(), statement=statement[:200], db=engine.url.database or '')
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('trace_starts'):
+            connection.info['trace_starts'].pop()
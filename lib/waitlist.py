@@ -0,0 +1,129 @@
+from datetime import date, time, datetime
+from typing import Union
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import lib.constants as const
+import lib.washers as washers
+from lib.events import emit, AppointmentBooked
+from lib.models import User, Appointment, AppointmentData, Message, WaitlistEntry
+
+
+def slot_where(book_date: date, book_time: time, washer_id: int = None):
+    where = [
+        WaitlistEntry.book_date == book_date,
+        WaitlistEntry.book_time == book_time
+    ]
+    if washer_id is not None:
+        where.append(WaitlistEntry.washer_id == washer_id)
+    return where
+
+
+async def user_washer_ids(session: AsyncSession, user: User, book_date: date, book_time: time) -> set[int]:
+    stmt = select(WaitlistEntry.washer_id) \
+        .where(
+            *slot_where(book_date, book_time),
+            WaitlistEntry.user_id == user.id)
+    return set((await session.scalars(stmt)).all())
+
+
+async def toggle(session: AsyncSession, user: User, book_date: date, book_time: time, washer_id: int) -> bool:
+    """Join the queue of the slot or leave it, returns True if joined"""
+    stmt = delete(WaitlistEntry) \
+        .where(
+            *slot_where(book_date, book_time, washer_id),
+            WaitlistEntry.user_id == user.id)
+    if (await session.execute(stmt)).rowcount:
+        await session.commit()
+        return False
+
+    session.add(
+        WaitlistEntry(
+            user_id=user.id,
+            book_date=book_date,
+            book_time=book_time,
+            washer_id=washer_id))
+    await session.commit()
+    return True
+
+
+def eligible_where(book_date: date):
+    """Queued users who can book the date: a weekday of their role, planned appointments under the limit"""
+    roles = [role for role, weekdays in const.available_weekdays.items() if book_date.weekday() in weekdays]
+    planned_appointments_count = select(func.count()) \
+        .where(
+            Appointment.user_id == WaitlistEntry.user_id,
+            ~Appointment.passed) \
+        .scalar_subquery()
+    return [
+        WaitlistEntry.user_id == User.id,
+        User.role.in_(roles),
+        planned_appointments_count < const.max_book_washers
+    ]
+
+
+async def promote(session: AsyncSession, appointment: Appointment) -> Union[Appointment, None]:
+    """Assign a released slot to the first eligible user in its queue, one query per slot.
+
+    A washer out of service at the slot is not given away. Runs in the caller's transaction
+    (before its commit), so the slot is never seen as free.
+    """
+    await washers.cache.ensure()
+    book_at = datetime.combine(appointment.book_date, appointment.book_time)
+    if not washers.cache.in_service(appointment.washer_id, book_at):
+        return None
+
+    stmt = select(WaitlistEntry) \
+        .where(
+            *slot_where(appointment.book_date, appointment.book_time, appointment.washer_id),
+            WaitlistEntry.user_id != appointment.user_id,
+            *eligible_where(appointment.book_date)) \
+        .order_by(
+            WaitlistEntry.id) \
+        .limit(1)
+
+    entry = (await session.scalars(stmt)).unique().one_or_none()
+    if entry is None:
+        return None
+
+    # Reuse the user's form for this slot (one form per slot), otherwise a new one is sent
+    stmt = select(AppointmentData) \
+        .where(
+            AppointmentData.book_date == entry.book_date,
+            AppointmentData.book_time == entry.book_time,
+            AppointmentData.message_id == Message.id,
+            Message.user_id == entry.user_id) \
+        .order_by(
+            AppointmentData.id.desc()) \
+        .limit(1)
+    data = (await session.scalars(stmt)).unique().one_or_none() or AppointmentData(
+        book_date=entry.book_date,
+        book_time=entry.book_time)
+    data.state = 2  # Finished AppointmentForm (washers action)
+
+    promoted = Appointment(
+        user=entry.user,
+        data=data,
+        book_date=entry.book_date,
+        book_time=entry.book_time,
+        washer=entry.washer)
+    session.add(promoted)
+    await session.delete(entry)
+    await session.flush()  # data.id of a new form
+    emit(session, AppointmentBooked(
+        entry.user_id, data.id, entry.book_date, entry.book_time, entry.washer_id))
+
+    session.info.setdefault('waitlist_promoted', []).append(promoted)
+    return promoted
+
+
+async def remove_passed(session: AsyncSession, today: date):
+    await session.execute(
+        delete(WaitlistEntry).where(WaitlistEntry.book_date < today))
+    await session.commit()
+
+
+def pop_promoted(session: AsyncSession) -> list[Appointment]:
+    """Appointments assigned from the waitlist since the last call, for notification after commit"""
+    return session.info.pop('waitlist_promoted', [])
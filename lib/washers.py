@@ -0,0 +1,185 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Union
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
+
+import lib.clock as clock
+import lib.constants as const
+from lib.events import emit, WasherChanged, AppointmentBooked, AppointmentCancelled
+from lib.models import async_session, rollback, Washer, WasherMaintenance, Appointment, AppointmentData
+
+
+class WasherCache:
+    """Washers and their maintenance windows, shared by the whole process.
+
+    Availability checks of the forms (up to a hundred per render) run on it without
+    queries. Loaded on first use, reloaded on WasherChanged events (lib/subscribers.py).
+    """
+
+    def __init__(self):
+        self.washers = {}  # id -> Washer (detached)
+        self.windows = {}  # washer id -> [(start_at, end_at)], not over yet
+        self.loaded = False
+
+    async def refresh(self):
+        async with async_session() as session:  # Own session: objects are detached, not expired by others
+            washers = (await session.scalars(select(Washer).order_by(Washer.id))).all()
+            stmt = select(
+                    WasherMaintenance.washer_id,
+                    WasherMaintenance.start_at,
+                    WasherMaintenance.end_at) \
+                .where(
+                    WasherMaintenance.end_at > clock.now())
+            windows = defaultdict(list)
+            for washer_id, start_at, end_at in (await session.execute(stmt)).all():
+                windows[washer_id].append((start_at, end_at))
+
+        # Swapped at once, concurrent readers see the old or the new state
+        self.washers = {washer.id: washer for washer in washers}
+        self.windows = dict(windows)
+        self.loaded = True
+
+    async def ensure(self):
+        if not self.loaded:
+            await self.refresh()
+
+    def all(self) -> list[Washer]:
+        return list(self.washers.values())
+
+    def get(self, washer_id: int) -> Union[Washer, None]:
+        return self.washers.get(washer_id)
+
+    def in_service(self, washer_id: int, at: datetime) -> bool:
+        washer = self.washers.get(washer_id)
+        return washer is not None and washer.available and not any(
+            start_at <= at < end_at
+            for start_at, end_at in self.windows.get(washer_id, ()))
+
+
+cache = WasherCache()
+
+
+async def attach(session: AsyncSession, washer_id: int) -> Washer:
+    """Cached washer as an object of the session, without a query (e.g. for a new appointment)"""
+    return await session.merge(cache.get(washer_id), load=False)
+
+
+async def find(session: AsyncSession, name: str) -> Union[Washer, None]:
+    stmt = select(Washer).where(Washer.name == name)
+    return (await session.scalars(stmt)).one_or_none()
+
+
+async def upcoming_windows(session: AsyncSession) -> list[WasherMaintenance]:
+    stmt = select(WasherMaintenance) \
+        .where(
+            WasherMaintenance.end_at > clock.now()) \
+        .order_by(
+            WasherMaintenance.start_at,
+            WasherMaintenance.id)
+    return (await session.scalars(stmt)).unique().all()
+
+
+async def set_available(session: AsyncSession, washer: Washer, available: bool):
+    washer.available = available
+    emit(session, WasherChanged(washer.id))
+    await session.commit()
+    await cache.refresh()
+
+
+async def add_window(session: AsyncSession, washer: Washer, start_at: datetime, end_at: datetime) -> WasherMaintenance:
+    window = WasherMaintenance(
+        washer_id=washer.id,
+        start_at=start_at,
+        end_at=end_at)
+    session.add(window)
+    emit(session, WasherChanged(washer.id))
+    await session.commit()
+    await cache.refresh()
+    return window
+
+
+async def remove_window(session: AsyncSession, window: WasherMaintenance):
+    await session.delete(window)
+    emit(session, WasherChanged(window.washer_id))
+    await session.commit()
+    await cache.refresh()
+
+
+async def relocate(session: AsyncSession, washer_id: int,
+                   start_at: datetime = None, end_at: datetime = None) -> dict[AppointmentData, list[tuple]]:
+    """Move planned appointments of a washer out of service to free washers of the same slots.
+
+    Appointments of slots without a free washer are cancelled. The affected slots are
+    read with one query and everything is written with one commit. Returns
+    data -> [(appointment, moved appointment or None)] of the affected forms for notification.
+    """
+    for attempt in range(const.stale_data_retries + 1):
+        try:
+            return await relocate_once(session, washer_id, start_at, end_at)
+        except StaleDataError:  # A form of the slot is changed by its user meanwhile
+            await rollback(session)  # relocate_once selects the appointments again
+            if attempt == const.stale_data_retries:
+                raise
+
+
+async def relocate_once(session: AsyncSession, washer_id: int, start_at: datetime, end_at: datetime):
+    await cache.ensure()
+    stmt = select(Appointment) \
+        .where(
+            Appointment.washer_id == washer_id,
+            ~Appointment.passed) \
+        .options(
+            joinedload(Appointment.data)) \
+        .order_by(
+            Appointment.book_at,
+            Appointment.id)
+    if start_at is not None:
+        stmt = stmt.where(Appointment.book_at >= start_at)
+    if end_at is not None:
+        stmt = stmt.where(Appointment.book_at < end_at)
+    affected = (await session.scalars(stmt)).unique().all()
+    if not affected:
+        return {}
+
+    stmt = select(Appointment.book_at, Appointment.washer_id) \
+        .where(
+            Appointment.book_at.in_({appointment.book_at for appointment in affected}))
+    occupied = defaultdict(set)  # book_at -> washer ids
+    for book_at, occupied_washer_id in (await session.execute(stmt)).all():
+        occupied[book_at].add(occupied_washer_id)
+
+    moves = defaultdict(list)
+    for appointment in affected:
+        data = appointment.data
+        await session.delete(appointment)
+        if appointment in data.appointments:
+            data.appointments.remove(appointment)
+        emit(session, AppointmentCancelled(
+            appointment.user_id, data.id, appointment.book_date, appointment.book_time, washer_id))
+
+        free_washers = [
+            washer
+            for washer in cache.all()
+            if washer.id not in occupied[appointment.book_at] and
+               cache.in_service(washer.id, appointment.book_at)
+        ]
+        moved = None
+        if free_washers:
+            moved = Appointment(
+                user_id=appointment.user_id,
+                data=data,
+                book_date=appointment.book_date,
+                book_time=appointment.book_time,
+                washer=await attach(session, free_washers[0].id))
+            session.add(moved)
+            occupied[appointment.book_at].add(moved.washer.id)
+            emit(session, AppointmentBooked(
+                appointment.user_id, data.id, appointment.book_date, appointment.book_time, moved.washer.id))
+        moves[data].append((appointment, moved))
+
+    await session.commit()
+    return moves
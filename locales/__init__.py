@@ -1,11 +1,18 @@
-
 import yaml
 
+language_codes = ['ru', 'en']
+
+_loaded = {}
+
+
 def load_locale(filename):
     with open('locales/%s' % filename, 'r', encoding='utf-8') as file:
-        return yaml.load(file.read(), yaml.Loader)
+        return yaml.load(file.read(), getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
-ru = load_locale('ru.yml')
-en = load_locale('en.yml')
 
-language_codes = ['ru', 'en']
+def __getattr__(name):  # Lazy: locales.ru / locales.en are parsed on first access
+    if name not in language_codes:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    if name not in _loaded:
+        _loaded[name] = load_locale('%s.yml' % name)
+    return _loaded[name]
@@ -3,15 +3,19 @@ import asyncio
 import os
 import pwd
 from pathlib import Path
-from crontab import CronTab
+
+from dotenv import load_dotenv
+load_dotenv()
 
 from telegram import BotCommand
 
 import locales
-from app import application
+from lib.bot import build_bot
 
 
 async def set_crontab():
+    from crontab import CronTab  # Lazy: only needed for this step
+
     CWD = Path.cwd()
     PYTHON_PATH = os.environ.get('PYTHON_PATH') or \
                     'env/bin/python3.9'
@@ -35,9 +39,9 @@ async def set_crontab():
         cron.write()
 
 
-async def set_my_commands():
+async def set_my_commands(bot):
     await asyncio.gather(*[
-        application.bot.set_my_commands(
+        bot.set_my_commands(
             [
                 BotCommand(command=cmd, description=desc)
                 for cmd, desc in getattr(locales, language_code)['commands'].items()
@@ -49,9 +53,13 @@ async def set_my_commands():
 
 
 async def main():
-    await asyncio.gather(
-        set_crontab(),
-        set_my_commands())
+    bot = build_bot()  # No Application: only set_my_commands is called
+    try:
+        await asyncio.gather(
+            set_crontab(),
+            set_my_commands(bot))
+    finally:
+        await bot.request.shutdown()
 
 
 if __name__ == '__main__':
@@ -2,6 +2,8 @@
 import os
 import sys
 import json
+import time
+import signal
 import asyncio
 import logging
 
@@ -10,22 +12,28 @@ load_dotenv('.env.test')
 
 import pika
 from telegram import Update
-from telegram.ext import ApplicationBuilder
 
+from lib.bot import build_application, build_bot
+from lib.events import bus, RabbitTransport
 from lib.models import async_session
 from lib.handlers import user_handlers
+import lib.tracing as tracing
+import lib.logs as logs
 
 number = sys.argv[1] if len(sys.argv) > 1 else '#'
 
-connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-channel = connection.channel()
-channel.queue_declare(queue='laundry.updates')
+logs.setup('rmq_consumer-%s' % number)  # File per consumer process (LOG_DIR)
+logger = logging.getLogger('rmq_consumer')
 
-application = ApplicationBuilder() \
-    .token(os.environ['BOT_TOKEN']) \
-    .build()
+application = build_application()
 
 def main():
+    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+    channel = connection.channel()
+    channel.queue_declare(queue='laundry.updates')
+    channel.queue_declare(queue='laundry.consumer_stats')
+    channel.basic_qos(prefetch_count=1)  # Queue depth is the backlog (autoscaling), a drained consumer holds one
+
     loop = asyncio.get_event_loop()
     asyncio.set_event_loop(loop)
 
@@ -33,27 +41,45 @@ def main():
         application.add_handlers(user_handlers)
         await application.initialize()
         await application.start()
+        bus.start(build_bot(), RabbitTransport())  # Fan-out edits through the background pool, as in app.py
 
     loop.run_until_complete(init())
 
     async def callback(ch, method, properties, body):
         data = json.loads(body)
-        async with async_session() as session:
-            application.bot_data['session'] = session
-            await application.process_update(
-                Update.de_json(data, application.bot)
-            )
-        print(" [x] %s Received %s" % (number, data['update_id']))
+        parent = tracing.extract((properties.headers or {}).get('traceparent'))  # Of the webhook (rmq_producer.py)
+        with tracing.span('consume', parent=parent, update_id=data['update_id'], worker=number):
+            async with async_session() as session:
+                application.bot_data['session'] = session
+                await application.process_update(
+                    Update.de_json(data, application.bot)
+                )
+            await bus.drain()  # The loop runs only while a message is processed
+        logger.info('Update %s processed by worker %s', data['update_id'], number)
 
     def receive(ch, method, properties, body):
         loop.run_until_complete(callback(ch, method, properties, body))
+        # Acknowledged when applied: messages of a crashed consumer are redelivered (dedup by update_id)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        published_at = (properties.headers or {}).get('published_at')
+        if published_at:
+            ch.basic_publish(exchange='',
+                             routing_key='laundry.consumer_stats',
+                             body=json.dumps({'worker': number, 'latency': time.time() - published_at}))
 
     channel.basic_consume(queue='laundry.updates',
-                          auto_ack=True,
                           on_message_callback=receive)
 
-    print(' [*] Waiting for messages. To exit press CTRL+C')
+    # SIGTERM of the supervisor (rmq_main.py): finish the current message and exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: connection.add_callback_threadsafe(channel.stop_consuming))
+
+    logger.info('Worker %s is waiting for messages', number)
     channel.start_consuming()
+    loop.run_until_complete(bus.stop())
+    loop.run_until_complete(bus.bot.request.shutdown())
+    loop.run_until_complete(application.stop())
+    loop.run_until_complete(application.shutdown())
+    connection.close()
 
 if __name__ == '__main__':
     try:
@@ -1,4 +1,3 @@
-
 import asyncio
 import subprocess
 import argparse
@@ -6,31 +5,59 @@ import argparse
 from dotenv import load_dotenv
 load_dotenv('.env.test')
 
-from lib.models import init as db_init
+import pika
+
+from lib.models import init as db_init, async_session
+from lib.supervisor import Supervisor, ScalePolicy, RabbitBroker
+import lib.timetable as timetable
+import lib.logs as logs
 
+logs.setup()
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--subprocess', '-s', nargs='?', default=4, type=int)
+parser.add_argument('--subprocess', '-s', nargs='?', default=4, type=int, help='minimum of consumers')
+parser.add_argument('--max-subprocess', '-m', default=8, type=int, help='maximum of consumers')
+parser.add_argument('--target-depth', default=10, type=int, help='queued updates per consumer')
+parser.add_argument('--target-latency', default=1.0, type=float, help='seconds from webhook to processed')
+parser.add_argument('--interval', default=1.0, type=float, help='supervisor tick, seconds')
 
 args = parser.parse_args()
-consumers = []
 
-async def main():
-    global producer
 
+def spawn_consumer(number: int):
+    # Own session: Ctrl+C (SIGINT of the terminal group) reaches only the supervisor, which drains consumers by SIGTERM
+    return subprocess.Popen(['env/bin/python', 'rmq_consumer.py', str(number)], start_new_session=True)
+
+
+async def prepare():
     await db_init()
+    async with async_session() as session:
+        await timetable.rebuild(session)
+
+
+def main():
+    global producer, supervisor
+
+    asyncio.run(prepare())
     producer = subprocess.Popen(['env/bin/python', 'rmq_producer.py'])
-    for i in range(args.subprocess):
-        consumer = subprocess.Popen(['env/bin/python', 'rmq_consumer.py', str(i)])
-        consumers.append(consumer)
 
-    producer.wait()
-    for consumer in consumers:
-        consumer.wait()
+    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+    policy = ScalePolicy(
+        min_workers=args.subprocess,
+        max_workers=max(args.max_subprocess, args.subprocess),
+        target_depth=args.target_depth,
+        target_latency=args.target_latency)
+    supervisor = Supervisor(RabbitBroker(connection.channel()), spawn_consumer, policy)
+    supervisor.run(args.interval, sleep=connection.sleep)
+
 
 if __name__ == '__main__':
+    producer = supervisor = None
     try:
-        asyncio.run(main())
+        main()
     except KeyboardInterrupt:
-        for c in consumers:
-            c.kill()
+        if supervisor:
+            supervisor.stop()  # Consumers finish their messages
+        if producer:
+            producer.terminate()
+            producer.wait()
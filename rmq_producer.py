@@ -1,6 +1,11 @@
 
+import time
 import asyncio
 import json
+import logging
+
+from dotenv import load_dotenv
+load_dotenv('.env.test')
 
 import pika
 
@@ -10,6 +15,13 @@ from starlette.requests import Request
 from starlette.responses import Response
 from starlette.routing import Route
 
+import lib.dedup as dedup
+import lib.tracing as tracing
+import lib.logs as logs
+
+logs.setup()
+logger = logging.getLogger('rmq_producer')
+
 
 port = 8001
 
@@ -24,16 +36,24 @@ async def main():
         """Handle incoming Telegram updates by putting them into the `update_queue`"""
         body = await request.body()
         data = json.loads(body)
+        if not dedup.window.add(data['update_id']):  # Webhook retry of a slow response, consumers check the shared store
+            logger.info('Duplicate update %s', data['update_id'])
+            return Response()
         # user_id = get_user_id_from_update(data)
         # if user_id not in user_workers:
         #     user_counter += 1
         #     worker = AppWorker(user_counter, None, data_queue)
         #     worker.daemon = True
         #     await asyncio.create_task(worker.start())
-        channel.basic_publish(exchange='',
-                              routing_key='laundry.updates',
-                              body=body)
-        print(" [x] Sent %s" % data['update_id'])
+        with tracing.span('webhook', update_id=data['update_id']):  # Trace of the update starts here
+            headers = {'published_at': time.time()}  # Latency of consumers (autoscaling of rmq_main.py)
+            if tracing.enabled():
+                headers['traceparent'] = tracing.inject()
+            channel.basic_publish(exchange='',
+                                  routing_key='laundry.updates',
+                                  properties=pika.BasicProperties(headers=headers),
+                                  body=body)
+        logger.info('Update %s published', data['update_id'])
         return Response()
 
     starlette_app = Starlette(
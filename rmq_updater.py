@@ -3,38 +3,36 @@ import os
 import sys
 import json
 import asyncio
+import logging
 
 from dotenv import load_dotenv
 load_dotenv('.env.test')
 
 import pika
-from telegram.ext import ApplicationBuilder
 
-connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-channel = connection.channel()
-channel.queue_declare(queue='laundry.expired_messages')
+from lib.bot import build_bot
+import lib.logs as logs
 
-application = ApplicationBuilder() \
-    .token(os.environ['BOT_TOKEN']) \
-    .build()
+logs.setup()
+logger = logging.getLogger('rmq_updater')
+
+bot = build_bot()  # No Application: the updater only edits messages
 
 def main():
+    connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
+    channel = connection.channel()
+    channel.queue_declare(queue='laundry.expired_messages')
+
     loop = asyncio.get_event_loop()
     asyncio.set_event_loop(loop)
 
-    async def init():
-        await application.initialize()
-        await application.start()
-
-    loop.run_until_complete(init())
-
     async def callback(ch, method, properties, body):
         data = json.loads(body)
-        await application.bot.edit_message_text(
+        await bot.edit_message_text(
             chat_id=data['chat_id'],
             message_id=data['message_id'],
             text='⌛')
-        print(" [x] Received info about expired message")
+        logger.info('Expired message %s of chat %s', data['message_id'], data['chat_id'])
 
     def receive(ch, method, properties, body):
         loop.run_until_complete(callback(ch, method, properties, body))
@@ -43,7 +41,7 @@ def main():
                           auto_ack=True,
                           on_message_callback=receive)
 
-    print(' [*] Waiting for messages. To exit press CTRL+C')
+    logger.info('Waiting for messages')
     channel.start_consuming()
 
 
@@ -53,8 +51,7 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         try:
             loop = asyncio.get_event_loop()
-            loop.run_until_complete(application.stop())
-            loop.run_until_complete(application.shutdown())
+            loop.run_until_complete(bot.request.shutdown())
             sys.exit(0)
         except SystemExit:
             os._exit(0)
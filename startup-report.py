@@ -0,0 +1,80 @@
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# Cold start budget per entry point, in milliseconds (module import, without main())
+STARTUP_BUDGET = {
+    'app.py': 1500,
+    'cron-update.py': 900,
+    'prepare.py': 500,
+    'rmq_consumer.py': 1500,
+    'rmq_updater.py': 500,
+}
+
+# The entry point is executed with __name__ != '__main__', so only imports and
+# module-level setup are measured
+RUN_ENTRY = 'import runpy, sys; runpy.run_path(sys.argv[1], run_name="__startup__")'
+
+
+def run_entry(entry, importtime=False):
+    env = dict(os.environ)
+    env.setdefault('BOT_TOKEN', '0:startup-report')
+    cmd = [sys.executable, '-B'] + \
+          (['-X', 'importtime'] if importtime else []) + \
+          ['-c', RUN_ENTRY, entry]
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    return proc, elapsed_ms
+
+
+def parse_importtime(stderr):
+    rows = []  # (cumulative_us, self_us, depth, module)
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(cumulative_us), int(self_us), depth, name.strip()))
+    return rows
+
+
+def report(entry, budget_ms, repeat, top):
+    proc, _ = run_entry(entry, importtime=True)
+    if proc.returncode != 0:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else proc.returncode
+        print(f'{entry}: FAILED ({error})\n')
+        return False
+
+    rows = parse_importtime(proc.stderr)
+    imports_ms = sum(r[0] for r in rows if r[2] == 0) / 1000
+    elapsed_ms = min(run_entry(entry)[1] for _ in range(repeat))
+    ok = elapsed_ms <= budget_ms
+
+    print(f'{entry}: {elapsed_ms:.0f} ms (budget {budget_ms} ms, imports {imports_ms:.0f} ms) - '
+          f'{"OK" if ok else "OVER BUDGET"}')
+    for cumulative_us, self_us, depth, name in sorted(rows, reverse=True)[:top]:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {self_us / 1000:7.1f} ms  {name}')
+    print()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time profile and cold start budget of entry points')
+    parser.add_argument('entries', nargs='*', default=list(STARTUP_BUDGET))
+    parser.add_argument('--repeat', '-r', default=3, type=int, help='Cold start runs, the fastest is taken')
+    parser.add_argument('--top', '-t', default=10, type=int, help='Slowest modules to show per entry point')
+    args = parser.parse_args()
+
+    results = [
+        report(entry, STARTUP_BUDGET.get(entry, min(STARTUP_BUDGET.values())), args.repeat, args.top)
+        for entry in args.entries
+    ]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == '__main__':
+    main()
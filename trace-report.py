@@ -0,0 +1,127 @@
+"""Slowest updates of a span file (TRACE_FILE or lib/fake_collector.py) with their critical paths.
+
+The critical path of a trace is the chain of spans the update waited for: from the end of
+the trace back to its start, the latest finishing child of every span on the path.
+
+    python trace-report.py spans.jsonl --top 10
+"""
+import json
+import argparse
+from collections import defaultdict
+
+SHOWN_ATTRIBUTES = ('update_id', 'method', 'worker', 'statement', 'error')
+
+
+def load(path: str) -> dict:
+    traces = defaultdict(dict)  # traceId -> spanId -> span
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                span = json.loads(line)
+                traces[span['traceId']][span['spanId']] = span
+    return traces
+
+
+class Trace:
+    def __init__(self, spans: dict):
+        self.spans = spans
+        self.children = defaultdict(list)
+        self.roots = []
+        for span in spans.values():
+            if span['parentSpanId'] in spans:
+                self.children[span['parentSpanId']].append(span)
+            else:  # Root or parent is lost (process killed before the export)
+                self.roots.append(span)
+        self.roots.sort(key=lambda span: span['start'])
+        self.ends = {}  # spanId -> end of the span and its descendants (e.g. consume after webhook)
+        for root in self.roots:
+            self.subtree_end(root)
+
+        self.start = min(span['start'] for span in spans.values())
+        self.end = max(span['end'] for span in spans.values())
+
+    @property
+    def duration(self) -> int:
+        return self.end - self.start
+
+    @property
+    def update_id(self):
+        return next((
+            span['attributes']['update_id'] for span in self.spans.values()
+            if 'update_id' in span['attributes']), None)
+
+    def subtree_end(self, span: dict) -> int:
+        end = max([span['end']] + [self.subtree_end(child) for child in self.children[span['spanId']]])
+        self.ends[span['spanId']] = end
+        return end
+
+    def critical_path(self, span: dict = None, depth: int = 0) -> list[tuple]:
+        """[(depth, span)] of the span and its critical children, the whole trace without span"""
+        if span is None:
+            path = []
+            cursor = self.end
+            for root in sorted(self.roots, key=lambda s: self.ends[s['spanId']], reverse=True):
+                if self.ends[root['spanId']] <= cursor:
+                    path[:0] = self.critical_path(root)
+                    cursor = root['start']
+            return path
+
+        path = []
+        cursor = self.ends[span['spanId']]
+        for child in sorted(self.children[span['spanId']], key=lambda s: self.ends[s['spanId']], reverse=True):
+            if self.ends[child['spanId']] <= cursor:  # Overlapped children are not waited for
+                path[:0] = self.critical_path(child, depth + 1)
+                cursor = child['start']
+        return [(depth, span)] + path
+
+
+def describe(span: dict) -> str:
+    attributes = ' '.join(
+        '%s=%s' % (key, ' '.join(str(span['attributes'][key]).split())[:80])
+        for key in SHOWN_ATTRIBUTES if key in span['attributes'])
+    return '%s [%s] %s' % (span['name'], span['service'], attributes)
+
+
+def collapse(path: list[tuple]) -> list[tuple]:
+    """[(depth, spans)], repeated leaf spans in a row (e.g. lazy loads of a loop) are one line"""
+    lines = []
+    for depth, span in path:
+        if lines and lines[-1][0] == depth and describe(lines[-1][1][-1]) == describe(span):
+            lines[-1][1].append(span)
+        else:
+            lines.append((depth, [span]))
+    return lines
+
+
+def main(args):
+    traces = [Trace(spans) for spans in load(args.path).values()]
+    if args.name:
+        traces = [trace for trace in traces if any(root['name'] == args.name for root in trace.roots)]
+    traces.sort(key=lambda trace: trace.duration, reverse=True)
+    if not traces:
+        print('No traces in %s' % args.path)
+        return
+
+    durations = sorted(trace.duration for trace in traces)
+    print('%d traces, median %.1f ms, p95 %.1f ms, max %.1f ms' % (
+        len(traces), durations[len(durations) // 2] / 1e6,
+        durations[int(len(durations) * 0.95)] / 1e6, durations[-1] / 1e6))
+
+    for trace in traces[:args.top]:
+        print('\ntrace %s update_id=%s %.1f ms, %d spans' % (
+            trace.roots[0]['traceId'],
+            trace.update_id, trace.duration / 1e6, len(trace.spans)))
+        for depth, spans in collapse(trace.critical_path()):
+            duration = sum(span['end'] - span['start'] for span in spans)
+            print('  %+9.1f ms %9.1f ms %5.1f%%  %s%s%s' % (
+                (spans[0]['start'] - trace.start) / 1e6, duration / 1e6,
+                100 * duration / trace.duration if trace.duration else 100,
+                '  ' * depth, describe(spans[0]), ' x%d' % len(spans) if len(spans) > 1 else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='JSONL file of spans')
+    parser.add_argument('--top', default=10, type=int, help='slowest traces to show')
+    parser.add_argument('--name', default=None, help='only traces with this root span, e.g. webhook')
+    main(parser.parse_args())